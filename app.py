@@ -6,25 +6,82 @@ SMB файловый процессор - Python версия
 """
 
 import os
+import sys
+import asyncio
 import base64
+import bisect
+import errno
+import fnmatch
+import hashlib
+import io
+import json
+import itertools
 import logging
+import mimetypes
+import multiprocessing
+import sqlite3
 import tempfile
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterable, Iterator, List, Optional, Tuple
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import queue
+import random
+import shutil
 import threading
 import time
+import tracemalloc
+import zlib
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from smbprotocol.connection import Connection, Dialects
 from smbprotocol.session import Session
 from smbprotocol.tree import TreeConnect
-from smbprotocol.open import Open, CreateDisposition, CreateOptions, FileAccessMask, ShareAccess
-from smbprotocol.file_info import FileInformationClass
-from smbprotocol.exceptions import SMBResponseException
+from smbprotocol.open import Open, CreateDisposition, CreateOptions, FileAccessMask, ShareAccess, SMB2SetInfoRequest
+from smbprotocol.file_info import (FileAttributes, FileDispositionInformation, FileEndOfFileInformation,
+                                   FileInformationClass, FileRenameInformation)
+from smbprotocol.exceptions import SMBException, SMBConnectionClosed, SMBResponseException
+from smbprotocol.header import NtStatus
+from smbprotocol.change_notify import ChangeNotifyFlags, CompletionFilter, FileAction, FileSystemWatcher
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.fields import format_multipart_header_param
+from urllib3.filepost import encode_multipart_formdata
+from urllib.parse import quote
 from dotenv import load_dotenv
 import uuid
 
+try:
+    # Необязательная зависимость: HTTP/2 клиент для отправки на API
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    # HTTP/2 в httpx работает только с пакетом h2 (httpx[http2]), без него Client(http2=True) падает
+    import h2
+except ImportError:
+    h2 = None
+
+try:
+    # Необязательная зависимость: сжатие тела запроса zstd
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    # Необязательная зависимость: перекодирование изображений перед отправкой
+    from PIL import Image
+except ImportError:
+    Image = None
+
 # Загрузка переменных окружения
 load_dotenv()
 
@@ -48,24 +105,530 @@ API_URL = os.getenv('API_URL')
 PORT = int(os.getenv('PORT', 3000))
 SMB_INPUT_DIR = os.getenv('SMB_INPUT_DIR', 'input')
 SMB_OUTPUT_DIR = os.getenv('SMB_OUTPUT_DIR', 'output')
+# Точка монтирования шары ядром (mount -t cifs); если задана, файлы читаются и переносятся через
+# файловую систему, а не через smbprotocol
+SMB_MOUNT_PATH = os.getenv('SMB_MOUNT_PATH', '')
+# Размер блока чтения (0 - максимальный согласованный с сервером max_read_size)
+SMB_READ_CHUNK_SIZE = int(os.getenv('SMB_READ_CHUNK_SIZE', 0))
+# Сколько READ запросов держать в полёте на одном открытом файле
+SMB_READ_MAX_IN_FLIGHT = max(1, int(os.getenv('SMB_READ_MAX_IN_FLIGHT', 4)))
+# Сколько WRITE запросов держать в полёте на одном записываемом файле
+SMB_WRITE_MAX_IN_FLIGHT = max(1, int(os.getenv('SMB_WRITE_MAX_IN_FLIGHT', 4)))
+# Составные запросы SMB2 (compound): open+read+close, open+rename+close, open+delete+close и
+# open+write+close одним сообщением вместо отдельного обмена на каждую операцию
+SMB_COMPOUND = os.getenv('SMB_COMPOUND', '1').lower() in ('1', 'true', 'yes')
+# Сколько байт читать в составном запросе (не больше max_read_size): файлы до этого размера читаются
+# за один обмен, у более крупных так приходит первый блок, остальное дочитывается обычным путём
+SMB_COMPOUND_READ_SIZE = max(1, int(os.getenv('SMB_COMPOUND_READ_SIZE', 1024 * 1024)))
+# Конвейер обработки: число потоков на каждой стадии и размер очередей между стадиями
+PIPELINE_READERS = max(1, int(os.getenv('PIPELINE_READERS', 2)))
+PIPELINE_ENCODERS = max(1, int(os.getenv('PIPELINE_ENCODERS', 2)))
+PIPELINE_UPLOADERS = max(1, int(os.getenv('PIPELINE_UPLOADERS', 4)))
+PIPELINE_FINALIZERS = max(1, int(os.getenv('PIPELINE_FINALIZERS', 2)))
+PIPELINE_QUEUE_SIZE = max(1, int(os.getenv('PIPELINE_QUEUE_SIZE', 8)))
+# Файлы не больше этого размера читаются целиком на стадии чтения, крупные - потоково при отправке
+PIPELINE_BUFFER_MAX_BYTES = int(os.getenv('PIPELINE_BUFFER_MAX_BYTES', 4 * 1024 * 1024))
+# Учёт выделений памяти через tracemalloc: пик памяти каждого задания в memory_peak_bytes (замедляет работу)
+TRACE_MEMORY = os.getenv('TRACE_MEMORY', '0').lower() in ('1', 'true', 'yes')
+# HTTP клиент API: размер пула keep-alive соединений (по умолчанию = числу потоков отправки),
+# HTTP/2 (нужен пакет httpx[http2]) и таймаут запроса
+API_POOL_SIZE = max(1, int(os.getenv('API_POOL_SIZE', PIPELINE_UPLOADERS)))
+API_HTTP2 = os.getenv('API_HTTP2', '0').lower() in ('1', 'true', 'yes')
+API_TIMEOUT = float(os.getenv('API_TIMEOUT', 10))
+# Повторы отправки на API: число повторов по классам ошибок (сеть/5xx, таймаут, 429/503 с Retry-After)
+API_RETRY_ATTEMPTS = max(0, int(os.getenv('API_RETRY_ATTEMPTS', 3)))
+API_RETRY_TIMEOUT_ATTEMPTS = max(0, int(os.getenv('API_RETRY_TIMEOUT_ATTEMPTS', 1)))
+API_RETRY_THROTTLED_ATTEMPTS = max(0, int(os.getenv('API_RETRY_THROTTLED_ATTEMPTS', 5)))
+# Экспоненциальная задержка между повторами (секунды, со случайным разбросом)
+API_RETRY_BACKOFF = float(os.getenv('API_RETRY_BACKOFF', 0.5))
+API_RETRY_BACKOFF_MAX = float(os.getenv('API_RETRY_BACKOFF_MAX', 30))
+# Предохранитель: после стольких ошибок подряд отправка приостанавливается на API_BREAKER_RESET секунд
+API_BREAKER_THRESHOLD = max(1, int(os.getenv('API_BREAKER_THRESHOLD', 5)))
+API_BREAKER_RESET = float(os.getenv('API_BREAKER_RESET', 30))
+# Папка на шаре для файлов, которые API так и не принял (пусто - файлы остаются в input)
+SMB_DEAD_LETTER_DIR = os.getenv('SMB_DEAD_LETTER_DIR', '')
+# Формат тела запроса с файлом: json ({"filename", "filedata": base64}), binary (содержимое как есть,
+# имя в заголовке API_FILENAME_HEADER) или multipart (multipart/form-data, поле file)
+API_PAYLOAD_FORMAT = os.getenv('API_PAYLOAD_FORMAT', 'json').lower()
+API_FILENAME_HEADER = os.getenv('API_FILENAME_HEADER', 'X-Filename')
+# Сжатие тела запроса (Content-Encoding): пусто - без сжатия, gzip или zstd (нужен пакет zstandard)
+API_CONTENT_ENCODING = os.getenv('API_CONTENT_ENCODING', '').lower()
+API_COMPRESS_LEVEL = int(os.getenv('API_COMPRESS_LEVEL', 6))
+# Перекодирование изображений перед отправкой (нужен Pillow): webp или jpeg, пусто - выключено.
+# Перекодируются файлы с расширениями из IMAGE_REENCODE_EXTENSIONS размером до IMAGE_REENCODE_MAX_BYTES
+IMAGE_REENCODE_FORMAT = os.getenv('IMAGE_REENCODE_FORMAT', '').lower()
+IMAGE_REENCODE_QUALITY = int(os.getenv('IMAGE_REENCODE_QUALITY', 85))
+IMAGE_REENCODE_EXTENSIONS = tuple(
+    ext.strip().lower() for ext in os.getenv('IMAGE_REENCODE_EXTENSIONS', '.bmp,.tiff').split(',') if ext.strip())
+IMAGE_REENCODE_MAX_BYTES = int(os.getenv('IMAGE_REENCODE_MAX_BYTES', 256 * 1024 * 1024))
+# Уменьшение до этого размера по длинной стороне (пиксели, 0 - без уменьшения)
+IMAGE_MAX_DIMENSION = max(0, int(os.getenv('IMAGE_MAX_DIMENSION', 0)))
+# Пул процессов для CPU работы (перекодирование изображений, base64 крупных файлов)
+CPU_POOL_WORKERS = max(1, int(os.getenv('CPU_POOL_WORKERS', os.cpu_count() or 1)))
+# Файлы от этого размера кодируются в base64 в пуле процессов (0 - всегда в потоках конвейера)
+CPU_OFFLOAD_MIN_BYTES = max(0, int(os.getenv('CPU_OFFLOAD_MIN_BYTES', 0)))
+# Пакетная отправка: до API_BATCH_SIZE небольших файлов (1 - выключена) и не больше API_BATCH_MAX_BYTES
+# в одном запросе; формат json (массив объектов) или multipart (multipart/form-data, без base64)
+API_BATCH_SIZE = max(1, int(os.getenv('API_BATCH_SIZE', 1)))
+API_BATCH_MAX_BYTES = max(1, int(os.getenv('API_BATCH_MAX_BYTES', 8 * 1024 * 1024)))
+API_BATCH_FORMAT = os.getenv('API_BATCH_FORMAT', 'json' if API_PAYLOAD_FORMAT == 'json' else 'multipart').lower()
+# Сколько секунд ждать следующий файл, чтобы дополнить неполный пакет
+API_BATCH_LINGER = float(os.getenv('API_BATCH_LINGER', 0.05))
+# Движок обработки по умолчанию: threads (конвейер на потоках) или async (asyncio)
+PROCESS_ENGINE = os.getenv('PROCESS_ENGINE', 'threads').lower()
+# Сколько файлов asyncio движок держит в обработке одновременно
+ASYNC_MAX_IN_FLIGHT = max(1, int(os.getenv('ASYNC_MAX_IN_FLIGHT', 200)))
+# Обход вложенных папок input (например, папок по дням); структура папок повторяется в output
+SMB_INPUT_RECURSIVE = os.getenv('SMB_INPUT_RECURSIVE', '0').lower() in ('1', 'true', 'yes')
+# Размер ответа одного QUERY_DIRECTORY (байты): крупные папки читаются страницами такого размера
+SMB_LIST_PAGE_SIZE = max(4096, int(os.getenv('SMB_LIST_PAGE_SIZE', 65536)))
+# Фильтрация по расширению на стороне сервера, без SMB_INPUT_RECURSIVE. Каждое расширение - отдельный цикл
+# CREATE/QUERY_DIRECTORY/CLOSE, поэтому по умолчанию папка читается одним листингом с фильтром на клиенте;
+# включать, когда изображения - малая доля файлов большой папки
+SMB_LIST_SERVER_FILTER = os.getenv('SMB_LIST_SERVER_FILTER', '0').lower() in ('1', 'true', 'yes')
+# Порядок подачи файлов в обработку: listing (как в листинге) | largest_first | smallest_first
+SCHEDULE_ORDER = os.getenv('SCHEDULE_ORDER', 'listing').lower()
+# Сколько элементов листинга упорядочивать за раз (окно сортировки, листинг при этом продолжает идти потоком)
+SCHEDULE_WINDOW = max(1, int(os.getenv('SCHEDULE_WINDOW', 1000)))
+# Предел суммарного размера файлов в обработке одновременно (байты, 0 - без предела)
+SCHEDULE_MAX_BYTES_IN_FLIGHT = int(os.getenv('SCHEDULE_MAX_BYTES_IN_FLIGHT', 0))
+# Проверка готовности: файлы, которые ещё записываются, откладываются до следующего прогона
+READY_CHECK = os.getenv('READY_CHECK', '1').lower() in ('1', 'true', 'yes')
+# Файл готов, если его размер и время изменения не менялись между прогонами или он не менялся столько секунд
+READY_MIN_AGE = float(os.getenv('READY_MIN_AGE', 10))
+# Через сколько секунд режим наблюдения повторяет прогон, если были отложенные файлы
+READY_RETRY_INTERVAL = float(os.getenv('READY_RETRY_INTERVAL', 15))
+# Режим демона: наблюдение за SMB_INPUT_DIR через SMB2 CHANGE_NOTIFY (или опрос, если не поддерживается)
+WATCH_MODE = os.getenv('WATCH_MODE', '0').lower() in ('1', 'true', 'yes')
+# Пауза после уведомления для накопления пачки изменений (секунды)
+WATCH_DEBOUNCE = float(os.getenv('WATCH_DEBOUNCE', 2))
+# Интервал опроса, если сервер не поддерживает CHANGE_NOTIFY (секунды)
+WATCH_POLL_INTERVAL = float(os.getenv('WATCH_POLL_INTERVAL', 30))
+# Каждые N циклов опроса список файлов читается полностью, даже если время изменения папки не менялось
+WATCH_FULL_RESCAN_EVERY = max(1, int(os.getenv('WATCH_FULL_RESCAN_EVERY', 10)))
+# Каталог данных процесса (журнал обработки); по умолчанию data рядом с app.py, а не текущая папка
+DATA_DIR = os.getenv('DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+# Журнал обработанных файлов (SQLite): повторный запуск не отправляет уже доставленные файлы; пусто - отключён
+LEDGER_PATH = os.getenv('LEDGER_PATH', os.path.join(DATA_DIR, 'processed_ledger.db'))
+# Дедупликация по хешу содержимого: off | skip (не отправлять копию) | reference (отправить ссылку на оригинал)
+DEDUP_MODE = os.getenv('DEDUP_MODE', 'off').lower()
+# Сколько хешей отправленных файлов держать в памяти и в журнале на диске
+DEDUP_MEMORY_SIZE = max(1, int(os.getenv('DEDUP_MEMORY_SIZE', 10000)))
+DEDUP_DISK_SIZE = max(1, int(os.getenv('DEDUP_DISK_SIZE', 1000000)))
+# Сколько завершённых заданий /process хранить для /jobs
+JOB_HISTORY_SIZE = max(1, int(os.getenv('JOB_HISTORY_SIZE', 100)))
+# Границы гистограмм задержек в /metrics (секунды, через запятую)
+METRICS_LATENCY_BUCKETS = tuple(sorted(float(bound) for bound in os.getenv(
+    'METRICS_LATENCY_BUCKETS', '0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30').split(',') if bound.strip()))
+# Пул SMB подключений: размер, время простоя до закрытия, проверка ECHO после простоя
+SMB_POOL_SIZE = max(1, int(os.getenv('SMB_POOL_SIZE', 4)))
+SMB_POOL_IDLE_TIMEOUT = float(os.getenv('SMB_POOL_IDLE_TIMEOUT', 300))
+SMB_POOL_HEALTHCHECK_IDLE = float(os.getenv('SMB_POOL_HEALTHCHECK_IDLE', 30))
+# Переподключение: число попыток и экспоненциальная задержка между ними (секунды)
+SMB_RECONNECT_ATTEMPTS = max(1, int(os.getenv('SMB_RECONNECT_ATTEMPTS', 5)))
+SMB_RECONNECT_BACKOFF = float(os.getenv('SMB_RECONNECT_BACKOFF', 1.0))
+SMB_RECONNECT_BACKOFF_MAX = float(os.getenv('SMB_RECONNECT_BACKOFF_MAX', 30.0))
+# Поведение при совпадении имени в output: overwrite | suffix | skip
+SMB_MOVE_ON_CONFLICT = os.getenv('SMB_MOVE_ON_CONFLICT', 'overwrite').lower()
+
+if SMB_MOVE_ON_CONFLICT not in ('overwrite', 'suffix', 'skip'):
+    logger.warning(f'Неизвестное значение SMB_MOVE_ON_CONFLICT={SMB_MOVE_ON_CONFLICT}, используется overwrite')
+    SMB_MOVE_ON_CONFLICT = 'overwrite'
+
+if DEDUP_MODE not in ('off', 'skip', 'reference'):
+    logger.warning(f'Неизвестное значение DEDUP_MODE={DEDUP_MODE}, дедупликация отключена')
+    DEDUP_MODE = 'off'
+
+if API_PAYLOAD_FORMAT not in ('json', 'binary', 'multipart'):
+    logger.warning(f'Неизвестное значение API_PAYLOAD_FORMAT={API_PAYLOAD_FORMAT}, используется json')
+    API_PAYLOAD_FORMAT = 'json'
+
+if API_HTTP2 and (httpx is None or h2 is None):
+    logger.warning('API_HTTP2 включён, но пакет httpx[http2] не установлен - используется HTTP/1.1')
+    API_HTTP2 = False
+
+if API_CONTENT_ENCODING not in ('', 'gzip', 'zstd'):
+    logger.warning(f'Неизвестное значение API_CONTENT_ENCODING={API_CONTENT_ENCODING}, сжатие отключено')
+    API_CONTENT_ENCODING = ''
+elif API_CONTENT_ENCODING == 'zstd' and zstandard is None:
+    logger.warning('API_CONTENT_ENCODING=zstd, но пакет zstandard не установлен - используется gzip')
+    API_CONTENT_ENCODING = 'gzip'
+
+if IMAGE_REENCODE_FORMAT not in ('', 'webp', 'jpeg'):
+    logger.warning(f'Неизвестное значение IMAGE_REENCODE_FORMAT={IMAGE_REENCODE_FORMAT}, перекодирование отключено')
+    IMAGE_REENCODE_FORMAT = ''
+elif IMAGE_REENCODE_FORMAT and Image is None:
+    logger.warning('IMAGE_REENCODE_FORMAT задан, но пакет Pillow не установлен - перекодирование отключено')
+    IMAGE_REENCODE_FORMAT = ''
+
+if API_BATCH_FORMAT not in ('json', 'multipart'):
+    logger.warning(f'Неизвестное значение API_BATCH_FORMAT={API_BATCH_FORMAT}, используется json')
+    API_BATCH_FORMAT = 'json'
+
+if SCHEDULE_ORDER not in ('listing', 'largest_first', 'smallest_first'):
+    logger.warning(f'Неизвестное значение SCHEDULE_ORDER={SCHEDULE_ORDER}, используется listing')
+    SCHEDULE_ORDER = 'listing'
+
+# Расширения изображений, которые отправляются на API
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff', '.webp')
+
+# Граница multipart выбирается один раз: тело при повторе отправки строится заново и должно
+# совпадать с уже сформированным заголовком Content-Type
+MULTIPART_BOUNDARY = uuid.uuid4().hex
+
+# NTSTATUS, которых нет в smbprotocol: rename между разными томами/шарами; чтение заблокированного диапазона
+STATUS_NOT_SAME_DEVICE = 0xC00000D4
+STATUS_FILE_LOCK_CONFLICT = 0xC0000054
 
 # Проверка обязательных параметров
-if not all([SMB_HOST, SMB_SHARE, API_URL]):
+if not API_URL or not (SMB_MOUNT_PATH or (SMB_HOST and SMB_SHARE)):
     logger.error('Не заполнены все обязательные переменные в .env')
     exit(1)
 
 logger.info(' Конфигурация подключения:')
 logger.info(f' SMB_HOST: {SMB_HOST}')
 logger.info(f' SMB_SHARE: {SMB_SHARE}')
+logger.info(f' SMB MOUNT: {SMB_MOUNT_PATH or "нет (smbprotocol)"}')
 logger.info(f' SMB_USERNAME: {SMB_USERNAME or "(не задан)"}')
 logger.info(f' API_URL: {API_URL}')
 logger.info(f' PORT: {PORT}')
 logger.info(f' INPUT DIR: {SMB_INPUT_DIR}')
 logger.info(f' OUTPUT DIR: {SMB_OUTPUT_DIR}')
+logger.info(f' INPUT RECURSIVE: {"да" if SMB_INPUT_RECURSIVE else "нет"}')
+logger.info(f' MOVE ON CONFLICT: {SMB_MOVE_ON_CONFLICT}')
+logger.info(f' SMB POOL SIZE: {SMB_POOL_SIZE}')
+logger.info(f' SMB COMPOUND: {f"да, чтение до {SMB_COMPOUND_READ_SIZE} байт" if SMB_COMPOUND else "нет"}')
+logger.info(f' API POOL SIZE: {API_POOL_SIZE}, HTTP/2: {"да" if API_HTTP2 else "нет"}')
+logger.info(f' API RETRY: {API_RETRY_ATTEMPTS}/{API_RETRY_TIMEOUT_ATTEMPTS}/{API_RETRY_THROTTLED_ATTEMPTS}, '
+            f'предохранитель {API_BREAKER_THRESHOLD} ошибок / {API_BREAKER_RESET} с')
+logger.info(f' API PAYLOAD: {API_PAYLOAD_FORMAT}, сжатие {API_CONTENT_ENCODING or "нет"}')
+logger.info(f' CPU POOL: {CPU_POOL_WORKERS} процессов, base64 в пуле от {CPU_OFFLOAD_MIN_BYTES or "-"} байт')
+logger.info(f' IMAGE REENCODE: {f"{IMAGE_REENCODE_FORMAT} q={IMAGE_REENCODE_QUALITY}" if IMAGE_REENCODE_FORMAT else "нет"}')
+logger.info(f' API BATCH: {f"{API_BATCH_SIZE} файлов / {API_BATCH_MAX_BYTES} байт, {API_BATCH_FORMAT}" if API_BATCH_SIZE > 1 else "нет"}')
+logger.info(f' DEAD LETTER DIR: {SMB_DEAD_LETTER_DIR or "(не задана)"}')
+logger.info(f' PROCESS ENGINE: {PROCESS_ENGINE}')
+logger.info(f' LEDGER: {LEDGER_PATH or "(отключён)"}')
+logger.info(f' DEDUP: {DEDUP_MODE}')
+logger.info(f' SCHEDULE: {SCHEDULE_ORDER}, окно {SCHEDULE_WINDOW}, '
+            f'предел {SCHEDULE_MAX_BYTES_IN_FLIGHT or "нет"}')
+logger.info(f' READY CHECK: {"да" if READY_CHECK else "нет"}, возраст {READY_MIN_AGE} с')
+logger.info(f' WATCH MODE: {"да" if WATCH_MODE else "нет"}')
+logger.info(f' PIPELINE: read={PIPELINE_READERS} encode={PIPELINE_ENCODERS} '
+            f'upload={PIPELINE_UPLOADERS} finalize={PIPELINE_FINALIZERS} queue={PIPELINE_QUEUE_SIZE}')
+
+if TRACE_MEMORY:
+    tracemalloc.start()
 
 app = Flask(__name__)
 
-class SMBClient:
+@dataclass
+class DirEntry:
+    """Элемент листинга директории"""
+    name: str  # путь относительно директории обхода (вложенные через \\)
+    size: int
+    mtime: datetime
+    is_dir: bool
+
+def mtime_from_ns(ns: int) -> datetime:
+    """Время изменения с файловой системы (нс от эпохи) в виде smbprotocol: naive UTC, до микросекунд.
+    
+    Одно представление у всех хранилищ - ключ журнала не меняется при переключении SMB_MOUNT_PATH.
+    """
+    return datetime(1970, 1, 1) + timedelta(microseconds=ns // 1000)
+
+def _format_metric_value(value) -> str:
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        if value.is_integer() and abs(value) < 1e15:
+            return str(int(value))
+        return repr(value)
+    return str(value)
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metric:
+    """Метрика Prometheus (counter, gauge или histogram) с набором меток.
+    
+    Значения хранятся по кортежам значений меток. Если задан collect, значения gauge
+    считаются в момент выдачи /metrics: collect() -> {значения меток: значение}.
+    """
+    
+    def __init__(self, name: str, help_text: str, kind: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = (), collect=None):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.collect = collect
+        self._values = {}
+        self._lock = threading.Lock()
+        if not labels and collect is None:
+            # Метрика без меток видна в /metrics сразу, с нулевым значением
+            self._values[()] = self._empty()
+    
+    def _empty(self):
+        return [[0] * len(self.buckets), 0.0, 0] if self.kind == 'histogram' else 0
+    
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+    
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+    
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+    
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = self._empty()
+            # Граница включается в свою корзину (le - less or equal)
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+    
+    @contextmanager
+    def timer(self, **labels):
+        """Замер длительности блока (наблюдение записывается и при исключении)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+    
+    def _format_labels(self, key: tuple, **extra) -> str:
+        pairs = list(zip(self.labels, key)) + list(extra.items())
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{label}="{_escape_label(value)}"' for label, value in pairs) + '}'
+    
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        if self.collect is not None:
+            values = self.collect()
+        else:
+            with self._lock:
+                values = {key: ([list(value[0]), value[1], value[2]] if self.kind == 'histogram' else value)
+                          for key, value in self._values.items()}
+        for key, value in sorted(values.items()):
+            labels = self._format_labels(key)
+            if self.kind != 'histogram':
+                lines.append(f'{self.name}{labels} {_format_metric_value(value)}')
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{self._format_labels(key, le=_format_metric_value(bound))} {cumulative}')
+            lines.append(f'{self.name}_bucket{self._format_labels(key, le="+Inf")} {count}')
+            lines.append(f'{self.name}_sum{labels} {_format_metric_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+class MetricsRegistry:
+    """Метрики процесса для /metrics в текстовом формате Prometheus"""
+    
+    def __init__(self):
+        self._metrics = []
+    
+    def _register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+    
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Metric:
+        return self._register(Metric(name, help_text, 'counter', labels))
+    
+    def gauge(self, name: str, help_text: str, labels: Tuple[str, ...] = (), collect=None) -> Metric:
+        return self._register(Metric(name, help_text, 'gauge', labels, collect=collect))
+    
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = METRICS_LATENCY_BUCKETS) -> Metric:
+        return self._register(Metric(name, help_text, 'histogram', labels, buckets))
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f'Ошибка сбора метрики {metric.name}: {e}')
+        return '\n'.join(lines) + '\n'
+
+# Метрики процесса (/metrics)
+metrics = MetricsRegistry()
+smb_request_seconds = metrics.histogram(
+    'smb_processor_smb_request_seconds', 'Задержка запросов SMB (от отправки до ответа) по операциям', ('op',))
+smb_read_bytes = metrics.counter('smb_processor_smb_read_bytes_total', 'Байт прочитано с SMB')
+smb_written_bytes = metrics.counter('smb_processor_smb_written_bytes_total', 'Байт записано на SMB')
+api_request_seconds = metrics.histogram('smb_processor_api_request_seconds', 'Длительность POST на API')
+api_responses = metrics.counter(
+    'smb_processor_api_responses_total', 'Ответы API по HTTP коду (timeout/error - ответа не было)', ('code',))
+runs_finished = metrics.counter('smb_processor_runs_total', 'Завершённые прогоны обработки')
+run_files = metrics.histogram('smb_processor_run_files', 'Файлов в прогоне обработки',
+                              buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000))
+run_seconds = metrics.histogram('smb_processor_run_seconds', 'Длительность прогона обработки',
+                                buckets=(1, 5, 10, 30, 60, 300, 900, 1800, 3600))
+file_results = metrics.counter('smb_processor_files_total', 'Файлы по итогу обработки', ('result',))
+processed_bytes = metrics.counter('smb_processor_processed_bytes_total', 'Байт в успешно обработанных файлах')
+api_retry_count = metrics.counter('smb_processor_api_retries_total', 'Повторы отправки на API')
+
+def observe_api_response(started: float, outcome):
+    """Учёт запроса к API в /metrics: outcome - HTTP код ответа или исключение"""
+    if isinstance(outcome, int):
+        code = str(outcome)
+    elif getattr(outcome, 'response', None) is not None:
+        code = str(outcome.response.status_code)
+    elif isinstance(outcome, requests.Timeout) or (httpx is not None and isinstance(outcome, httpx.TimeoutException)):
+        code = 'timeout'
+    else:
+        code = 'error'
+    api_request_seconds.observe(time.perf_counter() - started)
+    api_responses.inc(code=code)
+
+class StorageBackend:
+    """Хранилище входных и выходных файлов: SMB шара или её замена (например, в бенчмарке).
+    
+    Пул подключений, конвейер и наблюдение за папкой работают только через эти методы.
+    Подкласс реализует connect, iter_directory, make_directories, iter_file_chunks, write_file,
+    delete_file и rename; обход, чтение целиком и перенос построены поверх них.
+    Пути относительные, с обратными слэшами; ошибки операций над файлами - исключения
+    (NTSTATUS или OSError), ошибки подключения распознаёт is_connection_error().
+    """
+    
+    connected = False
+    
+    def connect(self) -> bool:
+        raise NotImplementedError
+    
+    def disconnect(self):
+        self.connected = False
+    
+    def is_healthy(self, probe: bool = False) -> bool:
+        return self.connected
+    
+    def open_directory(self, directory: str):
+        """Открытая директория для CHANGE_NOTIFY; без поддержки наблюдение переходит на опрос"""
+        raise NotImplementedError('Хранилище не поддерживает CHANGE_NOTIFY')
+    
+    def directory_mtime(self, directory: str) -> Optional[int]:
+        """Время последнего изменения директории; None - неизвестно, опрос делает полный листинг"""
+        return None
+    
+    def iter_directory(self, directory: str = '', pattern: str = '*',
+                       page_size: Optional[int] = None) -> Iterator[DirEntry]:
+        """Элементы одной директории по мере чтения; ошибки пробрасываются вызывающему"""
+        raise NotImplementedError
+    
+    def walk(self, directory: str = '', recursive: bool = True,
+             patterns: Optional[Iterable[str]] = None) -> Iterator[DirEntry]:
+        """Обход директории (и вложенных, если recursive); имена относительно directory.
+        
+        Генератор: первые элементы доступны до окончания обхода. Недоступная вложенная папка
+        пропускается с ошибкой в логе, ошибка корневой пробрасывается.
+        patterns - шаблоны поиска (*.jpg), которые фильтрует хранилище; при рекурсивном обходе
+        не применяются, так как шаблон отсекает и вложенные папки.
+        """
+        root = self._clean_path(directory)
+        if patterns and not recursive:
+            # Каждый шаблон - отдельный листинг; один файл может подойти под несколько (короткие имена 8.3)
+            seen = set()
+            for pattern in patterns:
+                for entry in self.iter_directory(root, pattern):
+                    if entry.name.lower() not in seen:
+                        seen.add(entry.name.lower())
+                        yield entry
+            return
+        
+        pending = deque([''])
+        while pending:
+            relative = pending.popleft()
+            path = f"{root}\\{relative}" if root and relative else (root or relative)
+            try:
+                for entry in self.iter_directory(path):
+                    if relative:
+                        entry.name = f"{relative}\\{entry.name}"
+                    if entry.is_dir and recursive:
+                        pending.append(entry.name)
+                    yield entry
+            except Exception as e:
+                if not relative or is_connection_error(e):
+                    raise
+                logger.error(f'Ошибка чтения директории {path}: {e}')
+    
+    def list_files(self, directory: str = '') -> List[str]:
+        """Получение списка файлов в директории"""
+        try:
+            return [entry.name for entry in self.iter_directory(directory)]
+            
+        except Exception as e:
+            logger.error(f'Ошибка получения списка файлов из {directory}: {e}')
+            return []
+    
+    def make_directories(self, directory: str):
+        """Создание директории вместе с недостающими родительскими (как mkdir -p)"""
+        raise NotImplementedError
+    
+    def iter_file_chunks(self, file_path: str, chunk_size: Optional[int] = None,
+                         max_in_flight: Optional[int] = None, info: Optional[dict] = None) -> Iterator[memoryview]:
+        """Потоковое чтение файла блоками; в info записываются size и mtime. Ошибки пробрасываются.
+        
+        mtime - naive UTC datetime, как в ответе SMB CREATE (см. mtime_from_ns): по нему журнал
+        узнаёт уже отправленные файлы.
+        """
+        raise NotImplementedError
+    
+    def read_file(self, file_path: str) -> Optional[bytes]:
+        """Чтение файла"""
+        try:
+            return b''.join(self.iter_file_chunks(file_path))
+            
+        except Exception as e:
+            logger.error(f'Ошибка чтения файла {file_path}: {e}')
+            return None
+    
+    def write_file(self, file_path: str, data, size: Optional[int] = None) -> bool:
+        """Запись файла: bytes-like или итератор блоков; size - ожидаемый размер"""
+        raise NotImplementedError
+    
+    def delete_file(self, file_path: str) -> bool:
+        raise NotImplementedError
+    
+    def rename(self, src_path: str, dst_path: str, on_conflict: str = 'overwrite',
+               max_suffix: int = 1000) -> Optional[str]:
+        """Переименование внутри хранилища; on_conflict как у SMB_MOVE_ON_CONFLICT. Итоговый путь или None"""
+        raise NotImplementedError
+    
+    def move(self, src_path: str, dst_path: str, on_conflict: str = 'overwrite',
+             data: Optional[bytes] = None) -> Optional[str]:
+        """Перемещение файла; data - уже прочитанное содержимое (нужно, только если перенос - копирование)"""
+        return self.rename(src_path, dst_path, on_conflict)
+    
+    @staticmethod
+    def _clean_path(file_path: str) -> str:
+        """Приведение пути к виду, который ожидает SMB (обратные слэши, без краевых)"""
+        return file_path.replace('/', '\\').strip('\\')
+    
+    @staticmethod
+    def _with_suffix(clean_path: str, index: int) -> str:
+        """Имя с числовым суффиксом: dir\\name.jpg -> dir\\name (1).jpg"""
+        directory, _, name = clean_path.rpartition('\\')
+        stem, dot, ext = name.rpartition('.')
+        if not stem:
+            stem, dot, ext = name, '', ''
+        new_name = f"{stem} ({index}){dot}{ext}"
+        return f"{directory}\\{new_name}" if directory else new_name
+
+class SMBClient(StorageBackend):
     """SMB3 клиент для работы с файлами"""
     
     def __init__(self):
@@ -77,6 +640,8 @@ class SMBClient:
         self.connection = None
         self.session = None
         self.tree = None
+        # Дополнительные подключения к другим шарам того же сервера (для move)
+        self.extra_trees = {}
         self.connected = False
         
     def connect(self):
@@ -131,6 +696,9 @@ class SMBClient:
     def disconnect(self):
         """Отключение от SMB сервера"""
         try:
+            for tree in self.extra_trees.values():
+                tree.disconnect()
+            self.extra_trees = {}
             if self.tree:
                 self.tree.disconnect()
             if self.session:
@@ -142,71 +710,383 @@ class SMBClient:
         except Exception as e:
             logger.error(f'Ошибка при отключении от SMB3: {e}')
     
-    def list_files(self, directory: str = '') -> List[str]:
-        """Получение списка файлов в директории"""
+    def is_healthy(self, probe: bool = False) -> bool:
+        """Проверка, что подключение живо; probe=True - дополнительно SMB2 ECHO на сервер"""
+        if not self.connected or self.connection is None:
+            return False
+        transport = getattr(self.connection, 'transport', None)
+        if transport is not None and not transport.connected:
+            return False
+        if probe:
+            try:
+                self.connection.echo(sid=self.session.session_id, timeout=10)
+            except Exception as e:
+                logger.warning(f'SMB3 подключение не отвечает на ECHO: {e}')
+                return False
+        return True
+    
+    def open_directory(self, directory: str) -> Open:
+        """Открытие директории (для CHANGE_NOTIFY); вызывающий отвечает за close()"""
+        if not self.connected:
+            raise Exception("Нет подключения к SMB3")
+        
+        dir_open = Open(self.tree, self._clean_path(directory))
+        dir_open.create(
+            CreateDisposition.FILE_OPEN,
+            FileAccessMask.GENERIC_READ,
+            CreateOptions.FILE_DIRECTORY_FILE,
+            share_access=ShareAccess.FILE_SHARE_READ | ShareAccess.FILE_SHARE_WRITE | ShareAccess.FILE_SHARE_DELETE
+        )
+        return dir_open
+    
+    def directory_mtime(self, directory: str) -> Optional[int]:
+        """Время последнего изменения директории (меняется при добавлении/переименовании файлов)"""
         try:
-            if not self.connected:
-                raise Exception("Нет подключения к SMB3")
-            
-            # Формируем путь для поиска
-            search_path = directory.replace('/', '\\').strip('\\') if directory else ""
-            
-            # Открываем директорию для чтения
-            file_open = Open(self.tree, search_path)
-            file_open.create(
-                CreateDisposition.FILE_OPEN,
+            dir_open = self.open_directory(directory)
+            # Атрибуты приходят в ответе на CREATE, листинг не нужен
+            last_write_time = dir_open.last_write_time
+            dir_open.close()
+            return last_write_time
+        except Exception as e:
+            logger.error(f'Ошибка чтения атрибутов директории {directory}: {e}')
+            return None
+    
+    def iter_directory(self, directory: str = '', pattern: str = '*',
+                       page_size: Optional[int] = None) -> Iterator[DirEntry]:
+        """Постраничный листинг одной директории: QUERY_DIRECTORY повторяется до STATUS_NO_MORE_FILES.
+        
+        Элементы отдаются по мере прихода страниц, без накопления всего списка в памяти.
+        Ошибки пробрасываются вызывающему.
+        """
+        if not self.connected:
+            raise Exception("Нет подключения к SMB3")
+        
+        page_size = min(page_size or SMB_LIST_PAGE_SIZE, self.connection.max_transact_size)
+        dir_open = self.open_directory(directory)
+        try:
+            while True:
+                try:
+                    with smb_request_seconds.timer(op='list'):
+                        page = dir_open.query_directory(pattern, FileInformationClass.FILE_DIRECTORY_INFORMATION,
+                                                        max_output=page_size)
+                except SMBResponseException as e:
+                    if e.status in (NtStatus.STATUS_NO_MORE_FILES, NtStatus.STATUS_NO_SUCH_FILE):
+                        return
+                    raise
+                for info in page:
+                    name = info['file_name'].get_value().decode('utf-16-le')
+                    if name in ('.', '..'):
+                        continue
+                    yield DirEntry(
+                        name=name,
+                        size=info['end_of_file'].get_value(),
+                        mtime=info['last_write_time'].get_value(),
+                        is_dir=info['file_attributes'].has_flag(FileAttributes.FILE_ATTRIBUTE_DIRECTORY)
+                    )
+        finally:
+            dir_open.close()
+    
+    def make_directories(self, directory: str, tree: Optional[TreeConnect] = None):
+        """Создание директории вместе с недостающими родительскими (как mkdir -p)"""
+        parts = self._clean_path(directory).split('\\')
+        for depth in range(1, len(parts) + 1):
+            dir_open = Open(tree or self.tree, '\\'.join(parts[:depth]))
+            dir_open.create(
+                CreateDisposition.FILE_OPEN_IF,
                 FileAccessMask.GENERIC_READ,
                 CreateOptions.FILE_DIRECTORY_FILE,
-                share_access=ShareAccess.FILE_SHARE_READ | ShareAccess.FILE_SHARE_WRITE
+                share_access=ShareAccess.FILE_SHARE_READ | ShareAccess.FILE_SHARE_WRITE | ShareAccess.FILE_SHARE_DELETE
             )
-            
-            # Получаем список файлов
-            files_info = file_open.query_directory("*", FileInformationClass.FILE_DIRECTORY_INFORMATION)
-            
-            files = []
-            for file_info in files_info:
-                if file_info.file_name not in ['.', '..']:
-                    files.append(file_info.file_name)
-            
-            file_open.close()
-            return files
-            
-        except Exception as e:
-            logger.error(f'Ошибка получения списка файлов из {directory}: {e}')
-            return []
+            dir_open.close()
     
-    def read_file(self, file_path: str) -> Optional[bytes]:
-        """Чтение файла"""
+    def _credit_charge(self, length: int) -> int:
+        """Количество кредитов SMB2, которое потребует запрос READ/WRITE указанной длины"""
+        if not self.connection.supports_multi_credit:
+            return 1
+        return (max(0, length - 1) // 65536) + 1
+    
+    def _credits_available(self) -> int:
+        """Свободные кредиты в окне последовательности соединения"""
+        window = self.connection.sequence_window
+        return window['high'] - window['low']
+    
+    def _receive_read(self, message) -> memoryview:
+        """Данные ответа на READ без копирования - срез памяти над телом ответа.
+        
+        Разбор через SMB2ReadResponse в smbprotocol копирует блок данных при распаковке и при get_value().
+        """
+        payload = self.connection.receive(message)['data'].get_value()
+        # Тело ответа READ: StructureSize(2) DataOffset(1) Reserved(1) DataLength(4) ...;
+        # DataOffset отсчитывается от начала заголовка SMB2 (64 байта)
+        data_length = int.from_bytes(payload[4:8], 'little')
+        if not data_length:
+            return memoryview(b'')
+        data_offset = payload[2] - 64
+        return memoryview(payload)[data_offset:data_offset + data_length]
+    
+    def _can_compound(self, payload: int = 0) -> bool:
+        """Составной запрос возможен: он включён и в окне хватает кредитов на все его части"""
+        return SMB_COMPOUND and self._credits_available() >= self._credit_charge(payload) + 2
+    
+    def _compound(self, file_open: Open, messages: list) -> list:
+        """Отправка запросов к одному файлу одним сообщением SMB2 (related compound).
+        
+        messages - пары (запрос, функция разбора ответа), как их возвращают методы Open с send=False.
+        Первым идёт CREATE, следующие запросы сервер выполняет над открытым им файлом. Ответы
+        забираются все, даже после ошибки, чтобы не оставлять их в соединении; первая ошибка
+        пробрасывается (при ошибке CREATE остальные запросы завершаются с тем же статусом).
+        """
+        tree = file_open.tree_connect
+        sent = self.connection.send_compound([message for message, _ in messages], tree.session.session_id,
+                                             tree.tree_connect_id, related=True)
+        results = []
+        error = None
+        for message, (_, receive) in zip(sent, messages):
+            try:
+                results.append(receive(message))
+            except Exception as e:
+                results.append(None)
+                error = error or e
+        if error is not None:
+            raise error
+        return results
+    
+    def _open_compound(self, file_open: Open, create: tuple, operations: list, payload: int = 0,
+                       close: bool = True) -> list:
+        """Открытие файла, операции над ним и закрытие за один обмен с сервером.
+        
+        create - результат Open.create(..., send=False), operations - функции, которые строят
+        следующие запросы (пары запрос/разбор ответа). Без составных запросов (выключены или не
+        хватает кредитов) те же запросы отправляются по одному. Возвращает результаты operations.
+        close=False оставляет файл открытым - закрывает вызывающий, в том числе при ошибке.
+        """
+        if self._can_compound(payload):
+            messages = [create] + [operation() for operation in operations]
+            if close:
+                messages.append(file_open.close(send=False))
+            results = self._compound(file_open, messages)[1:]
+            return results[:-1] if close else results
+        
+        session_id = file_open.tree_connect.session.session_id
+        tree_id = file_open.tree_connect.tree_connect_id
+        message, receive = create
+        receive(self.connection.send(message, session_id, tree_id))
         try:
-            if not self.connected:
-                raise Exception("Нет подключения к SMB3")
-            
-            # Формируем правильный путь
-            clean_path = file_path.replace('/', '\\').strip('\\')
-            
-            file_open = Open(self.tree, clean_path)
+            results = []
+            for operation in operations:
+                # Запрос строится после CREATE - с настоящим file_id открытого файла
+                message, receive = operation()
+                results.append(receive(self.connection.send(message, session_id, tree_id)))
+            return results
+        finally:
+            if close:
+                file_open.close()
+    
+    def _read_compound(self, clean_path: str, length: int, info: Optional[dict]) -> Tuple[memoryview, int]:
+        """Чтение начала файла составным запросом CREATE + READ + CLOSE; возвращает данные и размер файла"""
+        file_open = Open(self.tree, clean_path)
+        
+        def receive_read(message):
+            try:
+                return self._receive_read(message)
+            except SMBResponseException as e:
+                # Пустой файл: READ с нулевого смещения завершается STATUS_END_OF_FILE
+                if e.status == NtStatus.STATUS_END_OF_FILE:
+                    return memoryview(b'')
+                raise
+        
+        create = file_open.create(
+            CreateDisposition.FILE_OPEN,
+            FileAccessMask.GENERIC_READ,
+            share_access=ShareAccess.FILE_SHARE_READ,
+            send=False
+        )
+        read_request, _ = file_open.read(0, length, send=False)
+        data, = self._open_compound(file_open, create, [lambda: (read_request, receive_read)], payload=length)
+        # Размер и время изменения - из ответа на CREATE, разобранного в том же обмене
+        if info is not None:
+            info['size'] = file_open.end_of_file
+            info['mtime'] = file_open.last_write_time
+        return data, file_open.end_of_file
+    
+    def iter_file_chunks(self, file_path: str, chunk_size: Optional[int] = None,
+                         max_in_flight: Optional[int] = None, info: Optional[dict] = None) -> Iterator[memoryview]:
+        """Потоковое чтение файла блоками не больше max_read_size.
+        
+        Держит до max_in_flight запросов READ в полёте (в пределах доступных кредитов SMB2)
+        и отдаёт блоки по порядку, как только они приходят. Блоки - memoryview над ответами
+        сервера, без промежуточных копий. Ошибки пробрасываются вызывающему.
+        Если передан info, в него записываются size и mtime файла из ответа на CREATE.
+        Начало файла (SMB_COMPOUND_READ_SIZE) читается составным запросом вместе с открытием
+        и закрытием - мелкий файл целиком за один обмен с сервером.
+        """
+        if not self.connected:
+            raise Exception("Нет подключения к SMB3")
+        
+        clean_path = self._clean_path(file_path)
+        max_read_size = self.connection.max_read_size
+        chunk_size = min(chunk_size or SMB_READ_CHUNK_SIZE or max_read_size, max_read_size)
+        max_in_flight = max_in_flight or SMB_READ_MAX_IN_FLIGHT
+        
+        next_offset = 0
+        compound_size = min(SMB_COMPOUND_READ_SIZE, max_read_size)
+        if self._can_compound(compound_size):
+            with smb_request_seconds.timer(op='read'):
+                data, file_size = self._read_compound(clean_path, compound_size, info)
+            smb_read_bytes.inc(len(data))
+            if data:
+                yield data
+            if len(data) >= file_size:
+                return
+            # Файл крупнее - остаток читается через отдельно открытый файл
+            next_offset = len(data)
+        
+        file_open = Open(self.tree, clean_path)
+        with smb_request_seconds.timer(op='open'):
             file_open.create(
                 CreateDisposition.FILE_OPEN,
                 FileAccessMask.GENERIC_READ,
                 share_access=ShareAccess.FILE_SHARE_READ
             )
+        
+        pending = deque()
+        try:
+            # Размер файла приходит в ответе на CREATE, отдельный QUERY_INFO не нужен
+            file_size = file_open.end_of_file
+            if info is not None:
+                info['size'] = file_size
+                info['mtime'] = file_open.last_write_time
+            session_id = self.session.session_id
+            tree_id = self.tree.tree_connect_id
             
-            # Получаем размер файла
-            file_info = file_open.query_info(FileInformationClass.FILE_STANDARD_INFORMATION)
-            file_size = file_info.end_of_file
-            
-            # Читаем файл
-            data = file_open.read(0, file_size)
+            while next_offset < file_size or pending:
+                # Досылаем запросы, пока есть место в окне и кредиты
+                while next_offset < file_size and len(pending) < max_in_flight:
+                    length = min(chunk_size, file_size - next_offset)
+                    if pending and self._credits_available() < self._credit_charge(length):
+                        break
+                    read_request, receive = file_open.read(next_offset, length, send=False)
+                    message = self.connection.send(read_request, session_id, tree_id)
+                    pending.append((next_offset, length, message, receive, time.perf_counter()))
+                    next_offset += length
+                
+                offset, length, message, receive, sent_at = pending.popleft()
+                data = self._receive_read(message)
+                smb_request_seconds.observe(time.perf_counter() - sent_at, op='read')
+                
+                if len(data) < length:
+                    # Сервер может вернуть меньше запрошенного - дочитываем хвост блока синхронно
+                    buffer = bytearray(data)
+                    while len(buffer) < length:
+                        try:
+                            tail = file_open.read(offset + len(buffer), length - len(buffer))
+                        except SMBResponseException as e:
+                            if e.status == NtStatus.STATUS_END_OF_FILE:
+                                break
+                            raise
+                        if not tail:
+                            break
+                        buffer += tail
+                    data = memoryview(buffer)
+                
+                smb_read_bytes.inc(len(data))
+                yield data
+                
+                if len(data) < length:
+                    # Файл укоротился во время чтения - дальше читать нечего
+                    break
+        finally:
+            # Забираем ответы на оставшиеся запросы (ранний выход/ошибка), чтобы не оставлять их в соединении
+            for _, _, message, receive, _ in pending:
+                try:
+                    receive(message)
+                except Exception:
+                    pass
             file_open.close()
-            
-            return data
-            
-        except Exception as e:
-            logger.error(f'Ошибка чтения файла {file_path}: {e}')
-            return None
     
-    def write_file(self, file_path: str, data: bytes) -> bool:
-        """Запись файла"""
+    @staticmethod
+    def _iter_blocks(data, block_size: int) -> Iterator[bytes]:
+        """Нарезка данных на блоки bytes по block_size: bytes-like или итератор блоков любого размера.
+        
+        smbprotocol принимает для WRITE только bytes - копируется по одному блоку, а не весь файл.
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            with memoryview(data) as view:
+                for offset in range(0, len(view), block_size):
+                    yield bytes(view[offset:offset + block_size])
+            return
+        
+        buffer = bytearray()
+        for chunk in data:
+            if not buffer and len(chunk) == block_size:
+                # Блоки читателя уже нужного размера (max_read_size = max_write_size) - без склейки
+                yield bytes(chunk)
+                continue
+            buffer += chunk
+            while len(buffer) >= block_size:
+                yield bytes(buffer[:block_size])
+                del buffer[:block_size]
+        if buffer:
+            yield bytes(buffer)
+    
+    @staticmethod
+    def _end_of_file_info(size: int) -> FileEndOfFileInformation:
+        end_of_file = FileEndOfFileInformation()
+        end_of_file['end_of_file'] = size
+        return end_of_file
+    
+    def _write_blocks(self, file_open: Open, blocks: Iterable[bytes], max_in_flight: Optional[int] = None) -> int:
+        """Запись блоков подряд с начала открытого файла; возвращает число записанных байт.
+        
+        Держит до max_in_flight запросов WRITE в полёте, пока хватает кредитов SMB2, и забирает
+        ответы по порядку. Ошибки пробрасываются вызывающему.
+        """
+        max_in_flight = max_in_flight or SMB_WRITE_MAX_IN_FLIGHT
+        session_id = file_open.tree_connect.session.session_id
+        tree_id = file_open.tree_connect.tree_connect_id
+        
+        def complete(message, receive, length, sent_at):
+            count = receive(message)
+            smb_request_seconds.observe(time.perf_counter() - sent_at, op='write')
+            if count != length:
+                raise Exception(f'Сервер записал {count} байт из {length}')
+            smb_written_bytes.inc(count)
+        
+        pending = deque()
+        offset = 0
+        try:
+            for block in blocks:
+                # Ждём ответы на ранние запросы, пока окно заполнено или не хватает кредитов
+                while pending and (len(pending) >= max_in_flight
+                                   or self._credits_available() < self._credit_charge(len(block))):
+                    complete(*pending.popleft())
+                message, receive = file_open.write(block, offset, send=False)
+                pending.append((self.connection.send(message, session_id, tree_id), receive, len(block),
+                                time.perf_counter()))
+                offset += len(block)
+            while pending:
+                complete(*pending.popleft())
+        finally:
+            # Забираем ответы на оставшиеся запросы (ошибка), чтобы не оставлять их в соединении
+            for message, receive, _, _ in pending:
+                try:
+                    receive(message)
+                except Exception:
+                    pass
+        return offset
+    
+    def write_file(self, file_path: str, data, tree: Optional[TreeConnect] = None,
+                   size: Optional[int] = None, max_in_flight: Optional[int] = None) -> bool:
+        """Запись файла блоками не больше max_write_size.
+        
+        data - bytes, bytearray, memoryview или итератор блоков (например, iter_file_chunks другого
+        файла): блоки пишутся по мере поступления, до max_in_flight запросов WRITE в полёте.
+        size - ожидаемый размер, под который место выделяется заранее (для bytes-like - длина
+        данных). Файл из одного блока пишется составным запросом CREATE + WRITE + CLOSE.
+        Если запись оборвалась после создания файла, недописанный файл удаляется: иначе
+        остался бы файл полного (выделенного заранее) размера с нулями в конце.
+        """
+        created = False
         try:
             if not self.connected:
                 raise Exception("Нет подключения к SMB3")
@@ -214,23 +1094,58 @@ class SMBClient:
             # Формируем правильный путь
             clean_path = file_path.replace('/', '\\').strip('\\')
             
-            file_open = Open(self.tree, clean_path)
-            file_open.create(
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                size = len(data)
+            blocks = self._iter_blocks(data, self.connection.max_write_size)
+            first = next(blocks, b'')
+            second = next(blocks, None)
+            
+            file_open = Open(tree or self.tree, clean_path)
+            create_request, receive_create = file_open.create(
                 CreateDisposition.FILE_OVERWRITE_IF,  # Создаем или перезаписываем
                 FileAccessMask.GENERIC_WRITE,
-                share_access=ShareAccess.FILE_SHARE_READ
+                share_access=ShareAccess.FILE_SHARE_READ,
+                send=False
             )
             
-            file_open.write(data, 0)
-            file_open.close()
+            def receive_created(message):
+                nonlocal created
+                result = receive_create(message)
+                created = True
+                return result
+            
+            create = (create_request, receive_created)
+            
+            if second is None:
+                # Мелкий файл: CREATE + WRITE + CLOSE одним составным запросом
+                operations = [lambda: file_open.write(first, 0, send=False)] if first else []
+                with smb_request_seconds.timer(op='write'):
+                    self._open_compound(file_open, create, operations, payload=len(first))
+                smb_written_bytes.inc(len(first))
+                return True
+            
+            # Открытие и выделение места под весь файл одним обменом: сервер не наращивает файл по блокам
+            preallocate = [lambda: self._set_info_request(file_open, self._end_of_file_info(size))] if size else []
+            try:
+                self._open_compound(file_open, create, preallocate, close=False)
+                written = self._write_blocks(file_open, itertools.chain([first, second], blocks), max_in_flight)
+                if size and written != size:
+                    # Данных пришло не столько, сколько ожидалось - выставляем фактический размер
+                    set_info, receive = self._set_info_request(file_open, self._end_of_file_info(written))
+                    receive(self.connection.send(set_info, file_open.tree_connect.session.session_id,
+                                                 file_open.tree_connect.tree_connect_id))
+            finally:
+                file_open.close()
             
             return True
             
         except Exception as e:
             logger.error(f'Ошибка записи файла {file_path}: {e}')
+            if created:
+                self.delete_file(file_path, tree=tree)
             return False
     
-    def delete_file(self, file_path: str) -> bool:
+    def delete_file(self, file_path: str, tree: Optional[TreeConnect] = None) -> bool:
         """Удаление файла"""
         try:
             if not self.connected:
@@ -239,16 +1154,19 @@ class SMBClient:
             # Формируем правильный путь
             clean_path = file_path.replace('/', '\\').strip('\\')
             
-            file_open = Open(self.tree, clean_path)
-            file_open.create(
+            file_open = Open(tree or self.tree, clean_path)
+            create = file_open.create(
                 CreateDisposition.FILE_OPEN,
                 FileAccessMask.DELETE,
-                share_access=ShareAccess.FILE_SHARE_DELETE
+                share_access=ShareAccess.FILE_SHARE_DELETE,
+                send=False
             )
             
-            # Помечаем файл для удаления
-            file_open.set_info({"delete_pending": True})
-            file_open.close()
+            # Помечаем файл для удаления; CREATE + SET_INFO + CLOSE одним составным запросом
+            disposition = FileDispositionInformation()
+            disposition['delete_pending'] = True
+            with smb_request_seconds.timer(op='delete'):
+                self._open_compound(file_open, create, [lambda: self._set_info_request(file_open, disposition)])
             
             return True
             
@@ -256,132 +1174,3040 @@ class SMBClient:
             logger.error(f'Ошибка удаления файла {file_path}: {e}')
             return False
 
-# Глобальный SMB клиент
-smb_client = SMBClient()
-
-def initialize_smb():
-    """Инициализация SMB подключения"""
-    try:
-        success = smb_client.connect()
-        if success:
-            # Проверяем доступность корневой директории
-            root_files = smb_client.list_files('')
-            logger.info(f' Доступные папки/файлы в корне SMB: {root_files}')
-        return success
-    except Exception as e:
-        logger.error(f' Ошибка подключения к SMB-шаре при инициализации: {e}')
-        logger.error(f' Подключение к \\\\{SMB_HOST}\\{SMB_SHARE}')
-        return False
-
-def is_image_file(filename: str) -> bool:
-    """Проверка, является ли файл изображением"""
-    image_extensions = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff', '.webp'}
-    return Path(filename).suffix.lower() in image_extensions
-
-def process_files():
-    """Основная функция обработки файлов"""
-    logger.info('[PROCESS] Запуск обработки файлов из SMB')
+    def _split_unc(self, path: str):
+        """Разбор UNC пути \\\\host\\share\\dir -> (host, share, dir); для относительного пути host/share = None"""
+        normalized = path.replace('/', '\\')
+        if not normalized.startswith('\\\\'):
+            return None, None, self._clean_path(normalized)
+        parts = normalized.strip('\\').split('\\', 2)
+        host = parts[0]
+        share = parts[1] if len(parts) > 1 else ''
+        rest = parts[2] if len(parts) > 2 else ''
+        return host, share, rest
     
-    input_path = SMB_INPUT_DIR
-    output_path = SMB_OUTPUT_DIR
+    def _get_tree(self, share: str) -> TreeConnect:
+        """TreeConnect к другой шаре того же сервера в рамках текущей сессии"""
+        if share.lower() == self.share_name.lower():
+            return self.tree
+        tree = self.extra_trees.get(share.lower())
+        if tree is None:
+            tree = TreeConnect(self.session, f"\\\\{self.server_name}\\{share}")
+            tree.connect()
+            self.extra_trees[share.lower()] = tree
+        return tree
     
-    try:
-        # Тест записи
-        test_file = f"{input_path}\\.__smb_test__.txt"
-        test_data = b'test'
+    def _set_info_request(self, file_open: Open, info) -> tuple:
+        """Запрос SMB2 SET_INFO и функция получения ответа - как у методов Open с send=False"""
+        set_info = SMB2SetInfoRequest()
+        set_info['info_type'] = info.INFO_TYPE
+        set_info['file_info_class'] = info.INFO_CLASS
+        set_info['file_id'] = file_open.file_id
+        set_info['buffer'] = info
+        # receive() бросает SMBResponseException при ненулевом NTSTATUS
+        return set_info, self.connection.receive
+    
+    @staticmethod
+    def _rename_info(target: str, replace_if_exists: bool) -> FileRenameInformation:
+        rename_info = FileRenameInformation()
+        rename_info['replace_if_exists'] = replace_if_exists
+        rename_info['file_name'] = target
+        return rename_info
+    
+    def _set_rename_info(self, file_open: Open, target: str, replace_if_exists: bool):
+        """Отправка SMB2 SET_INFO с FileRenameInformation для открытого файла"""
+        set_info, receive = self._set_info_request(file_open, self._rename_info(target, replace_if_exists))
+        with smb_request_seconds.timer(op='rename'):
+            receive(self.connection.send(set_info, self.session.session_id, self.tree.tree_connect_id))
+    
+    def _rename_compound(self, clean_src: str, target: str, replace_if_exists: bool):
+        """Переименование составным запросом CREATE + SET_INFO + CLOSE; ошибки пробрасываются"""
+        file_open = Open(self.tree, clean_src)
+        create = file_open.create(
+            CreateDisposition.FILE_OPEN,
+            FileAccessMask.DELETE,
+            share_access=ShareAccess.FILE_SHARE_DELETE,
+            send=False
+        )
+        rename_info = self._rename_info(target, replace_if_exists)
+        with smb_request_seconds.timer(op='rename'):
+            self._open_compound(file_open, create, [lambda: self._set_info_request(file_open, rename_info)])
+    
+    def rename(self, src_path: str, dst_path: str, on_conflict: str = 'overwrite',
+               max_suffix: int = 1000) -> Optional[str]:
+        """Серверное переименование/перемещение файла внутри шары без передачи данных.
         
-        logger.info(f'[PROCESS] Проверка записи: создание тестового файла {test_file}')
-        if smb_client.write_file(test_file, test_data):
-            logger.info('[PROCESS] Тестовый файл создан')
-            
-            logger.info(f'[PROCESS] Удаление тестового файла {test_file}')
-            if smb_client.delete_file(test_file):
-                logger.info('[PROCESS] Тестовый файл удалён')
+        on_conflict: overwrite - заменить существующий файл, suffix - добавить " (N)" к имени,
+        skip - оставить исходный файл на месте. Возвращает итоговый путь или None.
+        Исключение STATUS_NOT_SAME_DEVICE пробрасывается, чтобы move() мог перейти на копирование.
+        """
+        if not self.connected:
+            logger.error(f'Ошибка переименования файла {src_path}: нет подключения к SMB3')
+            return None
         
-        # Получение списка файлов
-        logger.info(f'[PROCESS] Чтение списка файлов из {input_path}')
-        files = smb_client.list_files(input_path)
-        logger.info(f'[PROCESS] Найдено файлов: {len(files)}')
+        clean_src = self._clean_path(src_path)
+        clean_dst = self._clean_path(dst_path)
         
-        # Фильтрация изображений
-        image_files = [f for f in files if is_image_file(f)]
+        if self._can_compound():
+            # Обычный случай - цель свободна и папка есть: весь rename за один обмен с сервером
+            try:
+                self._rename_compound(clean_src, clean_dst, replace_if_exists=(on_conflict == 'overwrite'))
+                return clean_dst
+            except SMBResponseException as e:
+                if e.status == STATUS_NOT_SAME_DEVICE:
+                    raise
+                if e.status not in (NtStatus.STATUS_OBJECT_NAME_COLLISION, NtStatus.STATUS_OBJECT_PATH_NOT_FOUND):
+                    logger.error(f'Ошибка переименования файла {src_path} -> {dst_path}: {e}')
+                    return None
+                # Конфликт имён или нет папки назначения - разбираемся на открытом файле ниже
+            except Exception as e:
+                logger.error(f'Ошибка переименования файла {src_path} -> {dst_path}: {e}')
+                return None
         
-        if not image_files:
-            logger.info(' Нет изображений для обработки')
-            return {'message': 'Нет изображений для обработки'}
+        try:
+            file_open = Open(self.tree, clean_src)
+            file_open.create(
+                CreateDisposition.FILE_OPEN,
+                FileAccessMask.DELETE,
+                share_access=ShareAccess.FILE_SHARE_DELETE
+            )
+        except Exception as e:
+            logger.error(f'Ошибка открытия файла {src_path} для переименования: {e}')
+            return None
         
-        # Обработка каждого изображения
-        for file in image_files:
-            full_path = f"{input_path}\\{file}"
-            output_full_path = f"{output_path}\\{file}"
-            
-            logger.info(f'[PROCESS] Чтение файла: {full_path}')
-            buffer = smb_client.read_file(full_path)
-            
-            if not buffer:
-                logger.error(f'[PROCESS] Ошибка чтения файла {file}')
-                continue
-            
-            logger.info(f'[PROCESS] Файл {file} прочитан, размер {len(buffer)} байт')
-            
-            # Кодирование в base64
-            base64_data = base64.b64encode(buffer).decode('utf-8')
-            
-            # Отправка на API
-            logger.info(f'[PROCESS] Отправка изображения {file} на API в JSON...')
+        try:
+            target = clean_dst
+            attempt = 0
+            created_parent = False
+            while True:
+                try:
+                    self._set_rename_info(file_open, target, replace_if_exists=(on_conflict == 'overwrite'))
+                    return target
+                except SMBResponseException as e:
+                    if e.status == NtStatus.STATUS_OBJECT_PATH_NOT_FOUND and '\\' in clean_dst and not created_parent:
+                        # Вложенной папки (например, папки дня) ещё нет в output - создаём и повторяем
+                        self.make_directories(clean_dst.rpartition('\\')[0])
+                        created_parent = True
+                        continue
+                    if e.status != NtStatus.STATUS_OBJECT_NAME_COLLISION:
+                        raise
+                    if on_conflict == 'skip':
+                        logger.warning(f'Файл {target} уже существует, перенос {src_path} пропущен')
+                        return None
+                    attempt += 1
+                    if attempt > max_suffix:
+                        logger.error(f'Не удалось подобрать свободное имя для {clean_dst}')
+                        return None
+                    target = self._with_suffix(clean_dst, attempt)
+        except SMBResponseException as e:
+            if e.status == STATUS_NOT_SAME_DEVICE:
+                raise
+            logger.error(f'Ошибка переименования файла {src_path} -> {dst_path}: {e}')
+            return None
+        except Exception as e:
+            logger.error(f'Ошибка переименования файла {src_path} -> {dst_path}: {e}')
+            return None
+        finally:
             try:
-                response = requests.post(
-                    API_URL,
-                    json={
-                        'filename': file,
-                        'filedata': base64_data
-                    },
-                    headers={'Content-Type': 'application/json'},
-                    timeout=10
-                )
-                response.raise_for_status()
-                logger.info(f'[PROCESS] Файл {file} успешно отправлен на API')
-            except requests.RequestException as e:
-                logger.error(f'[PROCESS] Ошибка при отправке файла {file}: {e}')
-                continue
-            
-            # Перемещение файла
-            logger.info(f'[PROCESS] Перенос файла в папку output: {file}')
+                file_open.close()
+            except Exception:
+                pass
+    
+    def move(self, src_path: str, dst_path: str, on_conflict: str = 'overwrite',
+             data: Optional[bytes] = None) -> Optional[str]:
+        """Перемещение файла: rename на стороне сервера, копирование+удаление только для другой шары.
+        
+        data - уже прочитанное содержимое файла, чтобы не читать его повторно при копировании.
+        """
+        host, share, dst_rel = self._split_unc(dst_path)
+        
+        if host is not None and host.lower() != self.server_name.lower():
+            logger.error(f'Перемещение на другой сервер не поддерживается: {dst_path}')
+            return None
+        
+        if share is None or share.lower() == self.share_name.lower():
             try:
-                if smb_client.write_file(output_full_path, buffer):
-                    if smb_client.delete_file(full_path):
-                        logger.info(f'[PROCESS] Файл {file} перемещён в output')
-                    else:
-                        logger.error(f'[PROCESS] Ошибка при удалении исходного файла {file}')
-                else:
-                    logger.error(f'[PROCESS] Ошибка при записи файла {file} в output')
-            except Exception as e:
-                logger.error(f'[PROCESS] Ошибка при переносе файла {file}: {e}')
+                return self.rename(src_path, dst_rel, on_conflict)
+            except SMBResponseException:
+                # STATUS_NOT_SAME_DEVICE: цель на другом томе, rename невозможен
+                logger.info(f'Серверный rename недоступен для {src_path}, используется копирование')
         
-        return {'message': 'Все изображения отправлены и перемещены в output'}
+        return self._copy_and_delete(src_path, dst_rel, share, on_conflict, data)
+    
+    def _copy_and_delete(self, src_path: str, dst_rel: str, share: Optional[str],
+                         on_conflict: str, data: Optional[bytes]) -> Optional[str]:
+        """Резервный путь move(): запись копии в целевую шару и удаление исходного файла"""
+        try:
+            tree = self._get_tree(share) if share else self.tree
+        except Exception as e:
+            logger.error(f'Ошибка подключения к шаре {share}: {e}')
+            return None
         
-    except Exception as error:
-        logger.error(f'[PROCESS] Ошибка выполнения процесса: {error}')
-        raise error
-
-@app.route('/process', methods=['GET'])
-def process_endpoint():
-    """Endpoint для обработки файлов"""
-    try:
-        result = process_files()
-        return jsonify(result)
-    except Exception as e:
-        logger.error(f'[PROCESS] Ошибка выполнения процесса: {e}')
-        return jsonify({'error': str(e)}), 500
-
-@app.route('/health', methods=['GET'])
-def health_check():
-    """Endpoint для проверки здоровья сервиса"""
-    return jsonify({'status': 'healthy', 'timestamp': '2025-06-25 02:26:44'})
-
-if __name__ == '__main__':
+        if on_conflict != 'overwrite' and self._exists(dst_rel, tree):
+            if on_conflict == 'skip':
+                logger.warning(f'Файл {dst_rel} уже существует, перенос {src_path} пропущен')
+                return None
+            for index in range(1, 1001):
+                candidate = self._with_suffix(dst_rel, index)
+                if not self._exists(candidate, tree):
+                    dst_rel = candidate
+                    break
+            else:
+                logger.error(f'Не удалось подобрать свободное имя для {dst_rel}')
+                return None
+        
+        if '\\' in dst_rel:
+            try:
+                self.make_directories(dst_rel.rpartition('\\')[0], tree=tree)
+            except Exception as e:
+                logger.error(f'Ошибка создания папки для {dst_rel}: {e}')
+                return None
+        
+        if data is not None:
+            written = self.write_file(dst_rel, data, tree=tree)
+        else:
+            # Копия идёт потоком: блоки исходного файла пишутся в целевой по мере чтения,
+            # файл целиком в памяти не держится
+            info = {}
+            chunks = self.iter_file_chunks(src_path, info=info)
+            try:
+                # Первый блок: файл открыт, размер для выделения места известен
+                first = next(chunks, None)
+            except Exception as e:
+                logger.error(f'Ошибка чтения файла {src_path}: {e}')
+                return None
+            try:
+                head = [first] if first is not None else []
+                written = self.write_file(dst_rel, itertools.chain(head, chunks), tree=tree, size=info.get('size'))
+            finally:
+                chunks.close()
+        if not written:
+            return None
+        if not self.delete_file(src_path):
+            return None
+        return dst_rel
+    
+    def _exists(self, file_path: str, tree: Optional[TreeConnect] = None) -> bool:
+        """Проверка существования файла"""
+        try:
+            file_open = Open(tree or self.tree, self._clean_path(file_path))
+            file_open.create(
+                CreateDisposition.FILE_OPEN,
+                FileAccessMask.FILE_READ_ATTRIBUTES,
+                share_access=ShareAccess.FILE_SHARE_READ | ShareAccess.FILE_SHARE_WRITE | ShareAccess.FILE_SHARE_DELETE
+            )
+            file_open.close()
+            return True
+        except SMBResponseException as e:
+            if e.status in (NtStatus.STATUS_OBJECT_NAME_NOT_FOUND, NtStatus.STATUS_OBJECT_PATH_NOT_FOUND):
+                return False
+            raise
+
+class LocalMountClient(StorageBackend):
+    """Шара, смонтированная ядром (mount -t cifs): листинг, чтение и перенос через файловую систему.
+    
+    Кэширование, чтение с упреждением, multi-credit I/O и подписание выполняет CIFS клиент ядра,
+    а не smbprotocol в пространстве пользователя. Пути - относительно точки монтирования.
+    CHANGE_NOTIFY недоступен, режим наблюдения работает опросом.
+    """
+    
+    def __init__(self, root: str = SMB_MOUNT_PATH):
+        self.root = root
+        self.connected = False
+    
+    def connect(self):
+        """Проверка доступности точки монтирования"""
+        try:
+            if not os.path.isdir(self.root):
+                raise FileNotFoundError(f'Папка {self.root} не найдена')
+            self.connected = True
+            return True
+        except Exception as e:
+            logger.error(f'❌ Ошибка доступа к смонтированной шаре {self.root}: {e}')
+            self.connected = False
+            return False
+    
+    def is_healthy(self, probe: bool = False) -> bool:
+        if not self.connected:
+            return False
+        if probe:
+            try:
+                os.stat(self.root)
+            except OSError as e:
+                logger.warning(f'Смонтированная шара {self.root} недоступна: {e}')
+                return False
+        return True
+    
+    def _local_path(self, path: str) -> str:
+        clean_path = self._clean_path(path)
+        return os.path.join(self.root, *clean_path.split('\\')) if clean_path else self.root
+    
+    def directory_mtime(self, directory: str) -> Optional[int]:
+        try:
+            return os.stat(self._local_path(directory)).st_mtime_ns
+        except OSError as e:
+            logger.error(f'Ошибка чтения атрибутов директории {directory}: {e}')
+            return None
+    
+    def iter_directory(self, directory: str = '', pattern: str = '*',
+                       page_size: Optional[int] = None) -> Iterator[DirEntry]:
+        """Листинг через os.scandir: тип элемента без отдельного запроса, размер и время - stat"""
+        if not self.connected:
+            raise Exception("Нет доступа к смонтированной шаре")
+        
+        with os.scandir(self._local_path(directory)) as entries:
+            for entry in entries:
+                if pattern != '*' and not fnmatch.fnmatch(entry.name.lower(), pattern.lower()):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                yield DirEntry(
+                    name=entry.name,
+                    size=stat.st_size,
+                    mtime=mtime_from_ns(stat.st_mtime_ns),
+                    is_dir=entry.is_dir(follow_symlinks=False)
+                )
+    
+    def make_directories(self, directory: str):
+        os.makedirs(self._local_path(directory), exist_ok=True)
+    
+    def iter_file_chunks(self, file_path: str, chunk_size: Optional[int] = None,
+                         max_in_flight: Optional[int] = None, info: Optional[dict] = None) -> Iterator[memoryview]:
+        """Потоковое чтение файла: readinto прямо в буфер блока, без промежуточных копий.
+        
+        Параллельные запросы к серверу делает CIFS клиент ядра (упреждающее чтение), поэтому
+        max_in_flight не используется. Ошибки пробрасываются вызывающему.
+        """
+        if not self.connected:
+            raise Exception("Нет доступа к смонтированной шаре")
+        
+        chunk_size = chunk_size or SMB_READ_CHUNK_SIZE or 1024 * 1024
+        with smb_request_seconds.timer(op='open'):
+            file = open(self._local_path(file_path), 'rb', buffering=0)
+        with file:
+            stat = os.fstat(file.fileno())
+            if info is not None:
+                info['size'] = stat.st_size
+                info['mtime'] = mtime_from_ns(stat.st_mtime_ns)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            
+            remaining = stat.st_size
+            while remaining > 0:
+                # Каждый блок - свой буфер: конвейер может держать несколько блоков одновременно
+                buffer = bytearray(min(chunk_size, remaining))
+                with smb_request_seconds.timer(op='read'):
+                    count = file.readinto(buffer)
+                if not count:
+                    # Файл укоротился во время чтения - дальше читать нечего
+                    break
+                smb_read_bytes.inc(count)
+                remaining -= count
+                yield memoryview(buffer)[:count]
+    
+    def write_file(self, file_path: str, data, size: Optional[int] = None) -> bool:
+        """Запись файла: bytes-like или итератор блоков (например, iter_file_chunks другого файла)"""
+        try:
+            if not self.connected:
+                raise Exception("Нет доступа к смонтированной шаре")
+            
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                data = [data]
+            written = 0
+            path = self._local_path(file_path)
+            with smb_request_seconds.timer(op='write'):
+                with open(path, 'wb') as file:
+                    try:
+                        for chunk in data:
+                            file.write(chunk)
+                            written += len(chunk)
+                    except BaseException:
+                        # Недописанный файл не оставляем
+                        file.close()
+                        os.remove(path)
+                        raise
+            smb_written_bytes.inc(written)
+            return True
+            
+        except Exception as e:
+            logger.error(f'Ошибка записи файла {file_path}: {e}')
+            return False
+    
+    def delete_file(self, file_path: str) -> bool:
+        try:
+            with smb_request_seconds.timer(op='delete'):
+                os.remove(self._local_path(file_path))
+            return True
+        except Exception as e:
+            logger.error(f'Ошибка удаления файла {file_path}: {e}')
+            return False
+    
+    def _free_target(self, clean_dst: str, on_conflict: str, src_path: str, max_suffix: int) -> Optional[str]:
+        """Путь назначения с учётом on_conflict; None - перенос пропускается"""
+        target = clean_dst
+        attempt = 0
+        while on_conflict != 'overwrite' and os.path.lexists(self._local_path(target)):
+            if on_conflict == 'skip':
+                logger.warning(f'Файл {target} уже существует, перенос {src_path} пропущен')
+                return None
+            attempt += 1
+            if attempt > max_suffix:
+                logger.error(f'Не удалось подобрать свободное имя для {clean_dst}')
+                return None
+            target = self._with_suffix(clean_dst, attempt)
+        return target
+    
+    def rename(self, src_path: str, dst_path: str, on_conflict: str = 'overwrite',
+               max_suffix: int = 1000) -> Optional[str]:
+        """Переименование через os.replace (на сервере - SMB2 rename, данные не передаются).
+        
+        Свободное имя для suffix/skip проверяется перед переименованием: одновременный перенос
+        в то же имя другим клиентом не отслеживается. OSError EXDEV (цель на другой точке
+        монтирования) пробрасывается, чтобы move() мог перейти на копирование.
+        """
+        if not self.connected:
+            logger.error(f'Ошибка переименования файла {src_path}: нет доступа к смонтированной шаре')
+            return None
+        
+        source = self._local_path(src_path)
+        try:
+            target = self._free_target(self._clean_path(dst_path), on_conflict, src_path, max_suffix)
+            if target is None:
+                return None
+            destination = self._local_path(target)
+            with smb_request_seconds.timer(op='rename'):
+                try:
+                    os.replace(source, destination)
+                except FileNotFoundError:
+                    if not os.path.lexists(source):
+                        raise
+                    # Вложенной папки (например, папки дня) ещё нет в output - создаём и повторяем
+                    os.makedirs(os.path.dirname(destination), exist_ok=True)
+                    os.replace(source, destination)
+            return target
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                raise
+            logger.error(f'Ошибка переименования файла {src_path} -> {dst_path}: {e}')
+            return None
+    
+    def move(self, src_path: str, dst_path: str, on_conflict: str = 'overwrite',
+             data: Optional[bytes] = None) -> Optional[str]:
+        """Перемещение: os.replace, а если цель смонтирована отдельно - копирование и удаление.
+        
+        Копия делается shutil.copyfile (в Linux - os.sendfile, данные не проходят через Python)
+        во временный файл рядом с целью и переименовывается в неё, только если записана целиком.
+        """
+        if dst_path.replace('/', '\\').startswith('\\\\'):
+            logger.error(f'UNC путь назначения не поддерживается для смонтированной шары: {dst_path}')
+            return None
+        try:
+            return self.rename(src_path, dst_path, on_conflict)
+        except OSError:
+            logger.info(f'rename недоступен для {src_path} (другая точка монтирования), используется копирование')
+        
+        try:
+            target = self._free_target(self._clean_path(dst_path), on_conflict, src_path, 1000)
+            if target is None:
+                return None
+            destination = self._local_path(target)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            partial = f'{destination}.partial'
+            try:
+                with smb_request_seconds.timer(op='write'):
+                    shutil.copyfile(self._local_path(src_path), partial)
+                os.replace(partial, destination)
+            except OSError:
+                if os.path.lexists(partial):
+                    os.remove(partial)
+                raise
+        except OSError as e:
+            logger.error(f'Ошибка копирования файла {src_path} -> {dst_path}: {e}')
+            return None
+        if not self.delete_file(src_path):
+            return None
+        return target
+
+def is_connection_error(error: Exception) -> bool:
+    """Ошибка транспорта/сессии (в отличие от NTSTATUS ошибки конкретной операции)"""
+    if isinstance(error, (SMBResponseException, FileNotFoundError, FileExistsError, PermissionError,
+                          IsADirectoryError, NotADirectoryError)):
+        # Ошибка операции над конкретным файлом (у хранилищ на файловой системе - OSError)
+        return False
+    return isinstance(error, (OSError, SMBConnectionClosed, SMBException))
+
+class FileNotReady(Exception):
+    """Файл ещё записывается (открыт другим клиентом) - обработка откладывается до следующего прогона"""
+
+def raise_if_busy(name: str, error: Exception):
+    """Преобразование отказа в открытии/чтении из-за другого клиента в FileNotReady"""
+    busy = isinstance(error, SMBResponseException) and error.status in (
+        NtStatus.STATUS_SHARING_VIOLATION, STATUS_FILE_LOCK_CONFLICT)
+    # Смонтированная шара: CIFS клиент ядра отдаёт STATUS_SHARING_VIOLATION как EBUSY
+    busy = busy or isinstance(error, OSError) and error.errno == errno.EBUSY
+    if READY_CHECK and busy:
+        raise FileNotReady(f'Файл {name} занят другим клиентом') from error
+
+class SMBConnectionPool:
+    """Потокобезопасный пул аутентифицированных SMB3 подключений.
+    
+    Каждый поток берёт себе отдельное подключение (Connection/Session/TreeConnect),
+    при выдаче проверяет его состояние, при обрыве переподключается с экспоненциальной
+    задержкой, а простаивающие подключения закрывает. factory создаёт подключение -
+    SMBClient или другой StorageBackend.
+    """
+    
+    def __init__(self, size: int = SMB_POOL_SIZE, factory=SMBClient,
+                 idle_timeout: float = SMB_POOL_IDLE_TIMEOUT,
+                 healthcheck_idle: float = SMB_POOL_HEALTHCHECK_IDLE,
+                 reconnect_attempts: int = SMB_RECONNECT_ATTEMPTS,
+                 backoff: float = SMB_RECONNECT_BACKOFF,
+                 backoff_max: float = SMB_RECONNECT_BACKOFF_MAX):
+        self.size = size
+        self.factory = factory
+        self.idle_timeout = idle_timeout
+        self.healthcheck_idle = healthcheck_idle
+        self.reconnect_attempts = reconnect_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        # Свободные подключения: (клиент, время возврата в пул)
+        self._idle = deque()
+        self._in_use = 0
+        self._closed = False
+        self._reaper = None
+    
+    def acquire(self, timeout: Optional[float] = None) -> StorageBackend:
+        """Выдача рабочего подключения (блокируется, если все заняты)"""
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError('Нет свободных SMB подключений в пуле')
+        try:
+            client = self._checkout_idle()
+            if client is None:
+                client = self._connect_new()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use += 1
+        self._start_reaper()
+        return client
+    
+    def release(self, client: StorageBackend, broken: bool = False):
+        """Возврат подключения в пул; broken=True - подключение закрывается"""
+        with self._lock:
+            self._in_use -= 1
+            keep = not broken and not self._closed and client.is_healthy()
+            if keep:
+                self._idle.append((client, time.monotonic()))
+        if not keep:
+            self._disconnect(client)
+        self._slots.release()
+    
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None):
+        """Контекстный менеджер: with pool.connection() as client: ..."""
+        client = self.acquire(timeout)
+        broken = False
+        try:
+            yield client
+        except Exception as e:
+            broken = is_connection_error(e)
+            raise
+        finally:
+            self.release(client, broken=broken)
+    
+    @contextmanager
+    def dedicated(self):
+        """Отдельное подключение вне пула (с теми же повторами) для долгих операций.
+        
+        Не занимает слот пула: например, наблюдение за папкой держит подключение всё время
+        работы и не должно мешать обработке, которой нужны подключения пула.
+        """
+        client = self._connect_new()
+        try:
+            yield client
+        finally:
+            self._disconnect(client)
+    
+    def close(self):
+        """Закрытие всех свободных подключений пула"""
+        with self._lock:
+            self._closed = True
+            idle = [client for client, _ in self._idle]
+            self._idle.clear()
+        for client in idle:
+            self._disconnect(client)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': self.size, 'idle': len(self._idle), 'in_use': self._in_use}
+    
+    def _checkout_idle(self) -> Optional[StorageBackend]:
+        """Последнее возвращённое живое подключение (LIFO - реже простаивает до таймаута)"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                client, released_at = self._idle.pop()
+            idle_for = time.monotonic() - released_at
+            if idle_for < self.idle_timeout and client.is_healthy(probe=idle_for >= self.healthcheck_idle):
+                return client
+            self._disconnect(client)
+    
+    def _connect_new(self) -> StorageBackend:
+        """Новое подключение с повторами и экспоненциальной задержкой"""
+        for attempt in range(self.reconnect_attempts):
+            client = self.factory()
+            try:
+                if client.connect():
+                    return client
+            except (SMBException, OSError) as e:
+                logger.error(f'❌ Ошибка подключения к SMB3: {e}')
+            self._disconnect(client)
+            if attempt + 1 < self.reconnect_attempts:
+                delay = min(self.backoff_max, self.backoff * (2 ** attempt))
+                logger.warning(f'Повторное подключение к SMB3 через {delay:.1f} с '
+                               f'(попытка {attempt + 2}/{self.reconnect_attempts})')
+                time.sleep(delay)
+        raise SMBConnectionClosed(f'Не удалось подключиться к SMB3 после {self.reconnect_attempts} попыток')
+    
+    @staticmethod
+    def _disconnect(client: StorageBackend):
+        try:
+            client.disconnect()
+        except Exception:
+            pass
+    
+    def _start_reaper(self):
+        """Фоновый поток, закрывающий подключения, простаивающие дольше idle_timeout"""
+        with self._lock:
+            if self._reaper is not None or self.idle_timeout <= 0:
+                return
+            self._reaper = threading.Thread(target=self._reap_idle, name='smb-pool-reaper', daemon=True)
+        self._reaper.start()
+    
+    def _reap_idle(self):
+        interval = max(1.0, self.idle_timeout / 2)
+        while not self._closed:
+            time.sleep(interval)
+            now = time.monotonic()
+            with self._lock:
+                expired = [item for item in self._idle if now - item[1] >= self.idle_timeout]
+                for item in expired:
+                    self._idle.remove(item)
+            for client, _ in expired:
+                logger.info('Закрытие простаивающего SMB3 подключения')
+                self._disconnect(client)
+
+# Глобальный пул SMB подключений
+smb_pool = SMBConnectionPool(factory=LocalMountClient if SMB_MOUNT_PATH else SMBClient)
+
+def initialize_smb():
+    """Инициализация SMB подключения"""
+    try:
+        with smb_pool.connection() as smb_client:
+            # Проверяем доступность корневой директории
+            root_files = smb_client.list_files('')
+            logger.info(f' Доступные папки/файлы в корне SMB: {root_files}')
+        return True
+    except Exception as e:
+        logger.error(f' Ошибка подключения к SMB-шаре при инициализации: {e}')
+        if SMB_MOUNT_PATH:
+            logger.error(f' Точка монтирования: {SMB_MOUNT_PATH}')
+        else:
+            logger.error(f' Подключение к \\\\{SMB_HOST}\\{SMB_SHARE}')
+        return False
+
+def is_image_file(filename: str) -> bool:
+    """Проверка, является ли файл изображением"""
+    return Path(filename).suffix.lower() in IMAGE_EXTENSIONS
+
+def api_filename(name: str) -> str:
+    """Имя файла для API: без вложенных папок input (day\\a.jpg -> a.jpg)"""
+    return name.rpartition('\\')[2]
+
+# Расширение имени файла после перекодирования
+REENCODE_EXTENSIONS = {'webp': '.webp', 'jpeg': '.jpg'}
+
+def needs_reencode(filename: str) -> bool:
+    """Файл перекодируется перед отправкой (IMAGE_REENCODE_FORMAT)"""
+    return bool(IMAGE_REENCODE_FORMAT) and filename.lower().endswith(IMAGE_REENCODE_EXTENSIONS)
+
+def buffer_limit(filename: str) -> int:
+    """До какого размера файл читается целиком: перекодируемые файлы нужны в памяти полностью"""
+    if needs_reencode(filename):
+        return max(PIPELINE_BUFFER_MAX_BYTES, IMAGE_REENCODE_MAX_BYTES)
+    return PIPELINE_BUFFER_MAX_BYTES
+
+def reencode_image(data: bytes, fmt: str, quality: int, max_dimension: int) -> Optional[bytes]:
+    """Перекодирование изображения, выполняется в процессе пула.
+    
+    Возвращает None, если результат без уменьшения не меньше исходного файла.
+    У многостраничных TIFF перекодируется первая страница.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        resized = bool(max_dimension) and max(image.size) > max_dimension
+        if resized:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        if fmt == 'jpeg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, format=fmt.upper(), quality=quality)
+    result = output.getvalue()
+    if not resized and len(result) >= len(data):
+        return None
+    return result
+
+class CountingIterator:
+    """Обёртка над итератором блоков, считающая прочитанные байты (и, если передан hasher, хеш содержимого)"""
+    
+    def __init__(self, chunks: Iterable[bytes], hasher=None):
+        self._chunks = iter(chunks)
+        self.bytes_read = 0
+        self.hasher = hasher
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self) -> bytes:
+        chunk = next(self._chunks)
+        self.bytes_read += len(chunk)
+        if self.hasher is not None:
+            self.hasher.update(chunk)
+        return chunk
+    
+    @property
+    def digest(self) -> Optional[str]:
+        """Хеш прочитанного содержимого (полный только после чтения файла до конца)"""
+        return self.hasher.hexdigest() if self.hasher is not None else None
+    
+    def close(self):
+        """Закрытие исходного генератора (освобождает открытый на SMB файл)"""
+        close = getattr(self._chunks, 'close', None)
+        if close:
+            close()
+
+def iter_base64(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Инкрементальное base64 кодирование потока блоков.
+    
+    Каждый блок кодируется по границе 3 байт через memoryview, без копирования блока;
+    остаток в 1-2 байта дополняется началом следующего блока, поэтому склейка
+    результатов совпадает с base64 всего файла.
+    """
+    remainder = b''
+    for chunk in chunks:
+        view = memoryview(chunk)
+        if remainder:
+            need = 3 - len(remainder)
+            if len(view) < need:
+                remainder += bytes(view)
+                continue
+            yield base64.b64encode(remainder + bytes(view[:need]))
+            view = view[need:]
+        cut = len(view) - len(view) % 3
+        remainder = bytes(view[cut:])
+        if cut:
+            yield base64.b64encode(view[:cut])
+    if remainder:
+        yield base64.b64encode(remainder)
+
+def iter_json_body(filename: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Тело запроса {"filename": ..., "filedata": "<base64>"} по частям"""
+    yield b'{"filename": ' + json.dumps(filename).encode('utf-8') + b', "filedata": "'
+    yield from iter_base64(chunks)
+    yield b'"}'
+
+def iter_multipart_body(filename: str, chunks: Iterable[bytes], boundary: str = MULTIPART_BOUNDARY) -> Iterator[bytes]:
+    """Тело multipart/form-data с одним полем file по частям; содержимое файла идёт без base64"""
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    yield (f'--{boundary}\r\n'
+           f'Content-Disposition: form-data; name="file"; {format_multipart_header_param("filename", filename)}\r\n'
+           f'Content-Type: {content_type}\r\n\r\n').encode('utf-8')
+    yield from chunks
+    yield f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+def iter_payload_body(filename: str, chunks: Iterable[bytes], fmt: str = API_PAYLOAD_FORMAT) -> Iterator[bytes]:
+    """Тело запроса с одним файлом в формате API_PAYLOAD_FORMAT по частям"""
+    if fmt == 'binary':
+        return iter(chunks)
+    if fmt == 'multipart':
+        return iter_multipart_body(filename, chunks)
+    return iter_json_body(filename, chunks)
+
+def payload_headers(filename: str, fmt: str = API_PAYLOAD_FORMAT) -> dict:
+    """Заголовки запроса для тела iter_payload_body()"""
+    if fmt == 'binary':
+        # Значение заголовка - только ASCII, поэтому имя передаётся URL-кодированным (UTF-8)
+        return {'Content-Type': 'application/octet-stream', API_FILENAME_HEADER: quote(filename, safe='')}
+    if fmt == 'multipart':
+        return {'Content-Type': f'multipart/form-data; boundary={MULTIPART_BOUNDARY}'}
+    return {'Content-Type': 'application/json'}
+
+def _attach_shared(name: str) -> shared_memory.SharedMemory:
+    """Подключение процесса пула к блоку родителя без регистрации в resource_tracker.
+    
+    Блок удаляет родитель; регистрация из процесса пула (до Python 3.13 её не отключить
+    параметром track) удаляла бы его запись в общем трекере или сам блок при выходе процесса.
+    Процесс пула однопоточный, поэтому временная подмена register безопасна.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+def _json_body_shared(filename: str, source: str, size: int, target: str) -> int:
+    """Сборка JSON тела в процессе пула: исходный файл и результат - в блоках shared memory.
+    
+    base64 кодируется прямо из блока исходного файла, без копии в bytes.
+    """
+    source_block = _attach_shared(source)
+    target_block = _attach_shared(target)
+    try:
+        position = 0
+        parts = iter_json_body(filename, [source_block.buf[:size]])
+        try:
+            for part in parts:
+                target_block.buf[position:position + len(part)] = part
+                position += len(part)
+        finally:
+            # Генератор держит memoryview блока - закрываем до close()
+            parts.close()
+        return position
+    finally:
+        source_block.close()
+        target_block.close()
+
+def _reencode_shared(source: str, size: int, fmt: str, quality: int, max_dimension: int) -> Optional[bytes]:
+    block = _attach_shared(source)
+    try:
+        data = block.buf[:size]
+        try:
+            return reencode_image(data, fmt, quality, max_dimension)
+        finally:
+            data.release()
+    finally:
+        block.close()
+
+class CPUPool:
+    """Пул процессов для CPU работы: base64 кодирование крупных файлов и перекодирование изображений.
+    
+    Из-за GIL кодирование в потоке конвейера тормозит остальные потоки. Содержимое файла
+    передаётся процессу через блок shared memory, а не сериализацией bytes; JSON тело процесс
+    пишет во второй блок, размер которого известен заранее.
+    """
+    
+    def __init__(self, workers: int = CPU_POOL_WORKERS, min_bytes: int = CPU_OFFLOAD_MIN_BYTES):
+        self.workers = workers
+        self.min_bytes = min_bytes
+        self._executor = None
+        self._lock = threading.Lock()
+    
+    def executor(self) -> ProcessPoolExecutor:
+        """Пул процессов создаётся при первом использовании"""
+        with self._lock:
+            if self._executor is None:
+                # fork из процесса с работающими потоками (пулы SMB, Flask) может унаследовать
+                # захваченные блокировки, и процесс пула зависает - процессы порождаются через forkserver
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=self.mp_context())
+            return self._executor
+    
+    @staticmethod
+    def mp_context():
+        methods = multiprocessing.get_all_start_methods()
+        return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    
+    def offloads(self, size: int) -> bool:
+        """Кодирование файла такого размера выполняется в пуле процессов"""
+        return self.min_bytes > 0 and size >= self.min_bytes
+    
+    def json_body(self, filename: str, chunks: List[bytes], size: int) -> bytes:
+        """JSON тело {"filename", "filedata"} прочитанного целиком файла, собранное в процессе пула"""
+        body_size = len(b'{"filename": , "filedata": ""}') + len(json.dumps(filename).encode('utf-8'))
+        body_size += 4 * ((size + 2) // 3)
+        source = self._share(chunks, size)
+        target = shared_memory.SharedMemory(create=True, size=body_size)
+        try:
+            length = self.executor().submit(_json_body_shared, filename, source.name, size, target.name).result()
+            # Единственная копия тела: блок удаляется сразу после возврата
+            return bytes(target.buf[:length])
+        finally:
+            for block in (source, target):
+                block.close()
+                block.unlink()
+    
+    def reencode(self, filename: str, chunks: List[bytes]) -> Tuple[str, List[bytes]]:
+        """Перекодирование файла (IMAGE_REENCODE_FORMAT); возвращает имя для API и содержимое.
+        
+        При ошибке или если перекодирование не уменьшило файл возвращается исходный файл.
+        """
+        size = sum(len(chunk) for chunk in chunks)
+        source = self._share(chunks, size)
+        try:
+            result = self.executor().submit(
+                _reencode_shared, source.name, size,
+                IMAGE_REENCODE_FORMAT, IMAGE_REENCODE_QUALITY, IMAGE_MAX_DIMENSION
+            ).result()
+        except Exception as e:
+            logger.error(f'[PROCESS] Ошибка перекодирования файла {filename}: {e}, отправляется исходный файл')
+            return filename, chunks
+        finally:
+            source.close()
+            source.unlink()
+        if result is None:
+            return filename, chunks
+        logger.info(f'[PROCESS] Файл {filename} перекодирован в {IMAGE_REENCODE_FORMAT}: {size} -> {len(result)} байт')
+        return os.path.splitext(filename)[0] + REENCODE_EXTENSIONS[IMAGE_REENCODE_FORMAT], [result]
+    
+    @staticmethod
+    def _share(chunks: List[bytes], size: int) -> shared_memory.SharedMemory:
+        """Копирование блоков файла в новый блок shared memory"""
+        block = shared_memory.SharedMemory(create=True, size=size)
+        position = 0
+        for chunk in chunks:
+            block.buf[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        return block
+    
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+# Общий пул процессов для CPU работы
+cpu_pool = CPUPool()
+
+def payload_bytes(filename: str, chunks: List[bytes], fmt: str = API_PAYLOAD_FORMAT) -> bytes:
+    """Тело запроса для прочитанного целиком файла; base64 крупных файлов - в пуле процессов"""
+    if fmt == 'json':
+        size = sum(len(chunk) for chunk in chunks)
+        if cpu_pool.offloads(size):
+            return cpu_pool.json_body(filename, chunks, size)
+    return b''.join(iter_payload_body(filename, chunks, fmt))
+
+def iter_compressed(chunks: Iterable[bytes], encoding: str = API_CONTENT_ENCODING) -> Iterator[bytes]:
+    """Потоковое сжатие тела запроса gzip или zstd"""
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=API_COMPRESS_LEVEL).compressobj()
+    else:
+        # wbits=31 - формат gzip (заголовок и контрольная сумма)
+        compressor = zlib.compressobj(API_COMPRESS_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def compress_body(body, headers: Optional[dict] = None, encoding: str = API_CONTENT_ENCODING):
+    """Сжатие тела запроса по API_CONTENT_ENCODING; возвращает тело и заголовки"""
+    headers = headers or {'Content-Type': 'application/json'}
+    if not encoding:
+        return body, headers
+    headers = dict(headers, **{'Content-Encoding': encoding})
+    if isinstance(body, bytes):
+        return b''.join(iter_compressed([body], encoding)), headers
+    return iter_compressed(body, encoding), headers
+
+@dataclass
+class UploadTiming:
+    """Время одного запроса к API: установка соединения (TCP+TLS) и передача/ответ"""
+    handshake_sec: float = 0.0
+    transfer_sec: float = 0.0
+    new_connections: int = 0
+    # Тело ответа API - по нему разбирается результат пакетной отправки
+    response: bytes = b''
+
+# Время установки соединений, открытых текущим потоком во время текущего запроса
+_handshake_local = threading.local()
+
+def _record_handshake(duration: float):
+    _handshake_local.seconds = getattr(_handshake_local, 'seconds', 0.0) + duration
+    _handshake_local.count = getattr(_handshake_local, 'count', 0) + 1
+
+def _pop_handshake():
+    seconds = getattr(_handshake_local, 'seconds', 0.0)
+    count = getattr(_handshake_local, 'count', 0)
+    _handshake_local.seconds = 0.0
+    _handshake_local.count = 0
+    return seconds, count
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        _record_handshake(time.perf_counter() - started)
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        _record_handshake(time.perf_counter() - started)
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter, замеряющий время установки новых TCP/TLS соединений"""
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
+
+class HttpxHandshakeTrace:
+    """Подсчёт времени TCP/TLS рукопожатий по trace событиям httpcore (extensions={'trace': ...})"""
+    
+    def __init__(self):
+        self._started = None
+        self.seconds = 0.0
+        self.count = 0
+    
+    def __call__(self, event_name: str, info: dict):
+        if event_name in ('connection.connect_tcp.started', 'connection.start_tls.started'):
+            self._started = time.perf_counter()
+        elif event_name in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+            if self._started is not None:
+                self.seconds += time.perf_counter() - self._started
+                self._started = None
+            if event_name == 'connection.connect_tcp.complete':
+                self.count += 1
+    
+    async def async_trace(self, event_name: str, info: dict):
+        """Вариант для httpx.AsyncClient - там trace должен быть корутиной"""
+        self(event_name, info)
+    
+    def timing(self, elapsed: float, response: bytes = b'') -> UploadTiming:
+        return UploadTiming(self.seconds, max(0.0, elapsed - self.seconds), self.count, response)
+
+def map_httpx_error(error: Exception) -> requests.RequestException:
+    """Приведение ошибок httpx к исключениям requests, которые обрабатывает конвейер"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return requests.HTTPError(str(error), response=error.response)
+    if isinstance(error, httpx.TimeoutException):
+        return requests.Timeout(str(error))
+    return requests.ConnectionError(str(error))
+
+class APIUploader:
+    """Общий HTTP клиент для отправки на API.
+    
+    Держит пул keep-alive соединений размером с число потоков отправки, чтобы
+    TCP/TLS рукопожатие выполнялось один раз на соединение, а не на каждый файл.
+    При API_HTTP2 и установленном httpx запросы мультиплексируются по HTTP/2.
+    """
+    
+    def __init__(self, url: str = None, pool_size: int = API_POOL_SIZE,
+                 http2: bool = API_HTTP2, timeout: float = API_TIMEOUT):
+        self.url = url or API_URL
+        self.timeout = timeout
+        self.http2 = http2 and httpx is not None and h2 is not None
+        if http2 and not self.http2:
+            logger.warning('HTTP/2 запрошен, но пакет httpx[http2] не установлен - используется HTTP/1.1')
+        
+        if self.http2:
+            self.client = httpx.Client(
+                http2=True,
+                timeout=timeout,
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+            )
+        else:
+            self.client = requests.Session()
+            adapter = _TimedHTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+            self.client.mount('http://', adapter)
+            self.client.mount('https://', adapter)
+    
+    def post(self, body, headers: Optional[dict] = None) -> UploadTiming:
+        """POST тела (bytes или итератор частей); ошибки - исключения requests"""
+        headers = headers or {'Content-Type': 'application/json'}
+        if self.http2:
+            return self._post_httpx(body, headers)
+        
+        _pop_handshake()
+        started = time.perf_counter()
+        try:
+            response = self.client.post(self.url, data=body, headers=headers, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            observe_api_response(started, e)
+            raise
+        observe_api_response(started, response.status_code)
+        elapsed = time.perf_counter() - started
+        handshake, connections = _pop_handshake()
+        return UploadTiming(handshake, max(0.0, elapsed - handshake), connections, response.content)
+    
+    def _post_httpx(self, body, headers: dict) -> UploadTiming:
+        trace = HttpxHandshakeTrace()
+        started = time.perf_counter()
+        try:
+            response = self.client.post(self.url, content=body, headers=headers, extensions={'trace': trace})
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            observe_api_response(started, e)
+            raise map_httpx_error(e) from e
+        observe_api_response(started, response.status_code)
+        return trace.timing(time.perf_counter() - started, response.content)
+    
+    def close(self):
+        self.client.close()
+
+# Общий HTTP клиент для отправки на API
+api_uploader = APIUploader()
+
+def upload_body(body, headers: Optional[dict] = None) -> UploadTiming:
+    """Отправка готового тела запроса на API (bytes или итератор частей), по умолчанию JSON"""
+    return api_uploader.post(*compress_body(body, headers))
+
+class APIUnavailable(FileNotReady):
+    """API недоступен (предохранитель разомкнут) - файл остаётся в input до следующего прогона"""
+
+class BatchItemError(requests.RequestException):
+    """API принял пакет, но отверг отдельный файл в нём"""
+
+class BatchItemUnconfirmed(requests.RequestException):
+    """API вернул результаты по файлам пакета, но не по этому файлу: он остаётся в input до следующего прогона"""
+
+class RetryPolicy:
+    """Решение о повторе отправки по классу ошибки"""
+    
+    THROTTLED_STATUSES = (429, 503)
+    SERVER_STATUSES = (408, 425, 500, 502, 504)
+    # Ответы, означающие, что API отверг сам файл - повтор не поможет, файл уходит в dead letter
+    REJECTED_STATUSES = (400, 413, 415, 422)
+    
+    def __init__(self, attempts: int = API_RETRY_ATTEMPTS, timeout_attempts: int = API_RETRY_TIMEOUT_ATTEMPTS,
+                 throttled_attempts: int = API_RETRY_THROTTLED_ATTEMPTS,
+                 backoff: float = API_RETRY_BACKOFF, backoff_max: float = API_RETRY_BACKOFF_MAX):
+        self.limits = {
+            'connection': attempts,
+            'server': attempts,
+            'timeout': timeout_attempts,
+            'throttled': throttled_attempts,
+        }
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+    
+    @classmethod
+    def classify(cls, error: requests.RequestException) -> str:
+        """connection | timeout | throttled | server | rejected | other"""
+        if isinstance(error, BatchItemError):
+            return 'rejected'
+        response = getattr(error, 'response', None)
+        if response is not None:
+            if response.status_code in cls.THROTTLED_STATUSES:
+                return 'throttled'
+            if response.status_code in cls.SERVER_STATUSES:
+                return 'server'
+            if response.status_code in cls.REJECTED_STATUSES:
+                return 'rejected'
+            return 'other'
+        if isinstance(error, requests.Timeout):
+            return 'timeout'
+        if isinstance(error, requests.ConnectionError):
+            return 'connection'
+        return 'other'
+    
+    def next_delay(self, attempt: int, error: requests.RequestException) -> Optional[float]:
+        """Пауза перед повтором номер attempt + 1 или None, если повторять не нужно"""
+        if attempt >= self.limits.get(self.classify(error), 0):
+            return None
+        retry_after = self.retry_after(getattr(error, 'response', None))
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # Full jitter: одновременно упавшие потоки не повторяют запрос синхронно
+        return random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt)))
+    
+    @staticmethod
+    def retry_after(response) -> Optional[float]:
+        """Значение заголовка Retry-After в секундах (число или HTTP дата)"""
+        value = response.headers.get('Retry-After') if response is not None else None
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+class CircuitBreaker:
+    """Предохранитель отправки на API.
+    
+    После threshold ошибок подряд (сеть, таймаут, 5xx, 429) размыкается: файлы не отправляются
+    и откладываются, пока не пройдёт reset_timeout. Затем пропускается один пробный запрос:
+    успех замыкает предохранитель, ошибка снова размыкает его.
+    """
+    
+    def __init__(self, threshold: int = API_BREAKER_THRESHOLD, reset_timeout: float = API_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+    
+    def is_open(self) -> bool:
+        """Разомкнут и время пробного запроса ещё не пришло"""
+        with self._lock:
+            return self.state == 'open' and time.monotonic() - self._opened_at < self.reset_timeout
+    
+    def before_request(self) -> bool:
+        """Разрешение на запрос; бросает APIUnavailable, если запрос отправлять нельзя.
+        
+        Возвращает True, если этот запрос - пробный.
+        """
+        with self._lock:
+            if self.state == 'closed':
+                return False
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self._probing = False
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True
+                logger.info('[API] Пробный запрос после паузы предохранителя')
+                return True
+        raise APIUnavailable('API недоступен, отправка приостановлена')
+    
+    def abort_probe(self):
+        """Пробный запрос не дошёл до API (ошибка чтения тела, отмена) - пробным будет следующий"""
+        with self._lock:
+            if self.state == 'half_open':
+                self._probing = False
+    
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logger.info('[API] API снова доступен, отправка возобновлена')
+            self.state = 'closed'
+            self._failures = 0
+            self._probing = False
+    
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == 'half_open' or (self.state == 'closed' and self._failures >= self.threshold):
+                logger.error(f'[API] API недоступен, отправка приостановлена на {self.reset_timeout} с')
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+                self._probing = False
+    
+    def record(self, error: requests.RequestException):
+        """Учёт ошибки: отказ API в приёме конкретного файла не говорит о недоступности API"""
+        if RetryPolicy.classify(error) in ('connection', 'timeout', 'server', 'throttled'):
+            self.record_failure()
+        else:
+            self.record_success()
+    
+    @contextmanager
+    def guard(self):
+        """Запрос к API через предохранитель: разрешение перед отправкой и учёт результата после"""
+        probe = self.before_request()
+        try:
+            yield
+        except requests.RequestException as e:
+            self.record(e)
+            raise
+        except BaseException:
+            # Ошибка не от API ничего не говорит о его доступности, но пробный запрос не должен
+            # остаться незавершённым - иначе предохранитель навсегда застрянет в half_open
+            if probe:
+                self.abort_probe()
+            raise
+        self.record_success()
+
+# Общие политика повторов и предохранитель отправки на API
+api_retry = RetryPolicy()
+api_breaker = CircuitBreaker()
+
+def retry_delay(name: str, attempt: int, error: requests.RequestException,
+                stats: Optional['PipelineStats'] = None) -> Optional[float]:
+    """Пауза перед повтором неудачной отправки или None, если повторять не нужно"""
+    delay = api_retry.next_delay(attempt, error)
+    if delay is not None:
+        if stats is not None:
+            stats.add('api_retries')
+        logger.warning(f'[PROCESS] Ошибка отправки файла {name}: {error}, повтор через {delay:.1f} с')
+    return delay
+
+def upload_with_retry(name: str, make_body, stats: Optional['PipelineStats'] = None,
+                      headers: Optional[dict] = None) -> UploadTiming:
+    """Отправка с повторами по api_retry через api_breaker.
+    
+    make_body(attempt) возвращает тело для попытки: потоковое тело одноразовое, поэтому для
+    повтора его нужно построить заново.
+    """
+    attempt = 0
+    while True:
+        try:
+            with api_breaker.guard():
+                timing = upload_body(make_body(attempt), headers)
+        except requests.RequestException as e:
+            delay = retry_delay(name, attempt, e, stats)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+            continue
+        if stats is not None:
+            stats.add('api_requests')
+        return timing
+
+def should_dead_letter(error: requests.RequestException) -> bool:
+    """Файл нужно убрать в dead letter: API отверг его или повторы исчерпаны при работающем API"""
+    if not SMB_DEAD_LETTER_DIR:
+        return False
+    kind = RetryPolicy.classify(error)
+    if kind == 'rejected':
+        return True
+    return kind in ('connection', 'timeout', 'server', 'throttled') and not api_breaker.is_open()
+
+def move_to_dead_letter(pool: 'SMBConnectionPool', task: 'FileTask', error: Exception,
+                        stats: 'PipelineStats') -> Optional[str]:
+    """Перенос файла задачи в SMB_DEAD_LETTER_DIR и запись рядом причины (name.error.txt).
+    
+    Файл задачи должен быть уже закрыт: открытый на чтение файл нельзя переименовать.
+    """
+    name = task.name
+    target = f"{SMB_DEAD_LETTER_DIR}\\{name}"
+    try:
+        with pool.connection() as client:
+            moved_path = client.move(task.path, target, 'suffix')
+            if moved_path:
+                reason = f'{time.strftime("%Y-%m-%d %H:%M:%S")} {type(error).__name__}: {error}\n'
+                client.write_file(f"{moved_path}.error.txt", reason.encode('utf-8'))
+    except Exception as e:
+        logger.error(f'[PROCESS] Ошибка переноса файла {name} в {SMB_DEAD_LETTER_DIR}: {e}')
+        return None
+    if moved_path:
+        stats.add('dead_lettered')
+        logger.warning(f'[PROCESS] Файл {name} перемещён в {moved_path}: API его не принял')
+    return moved_path
+
+def upload_file_stream(filename: str, chunks: Iterable[bytes]) -> UploadTiming:
+    """Потоковая отправка файла на API (chunked transfer encoding) в формате API_PAYLOAD_FORMAT.
+    
+    В памяти одновременно находится только текущий блок (и его base64 представление для json).
+    """
+    return upload_body(iter_payload_body(filename, chunks), payload_headers(filename))
+
+def batch_body(parts: List[Tuple[str, bytes]], fmt: str = API_BATCH_FORMAT) -> Tuple[bytes, str]:
+    """Тело пакетного запроса и его Content-Type.
+    
+    json - массив [{"filename": ..., "filedata": ...}, ...], части - готовые JSON тела файлов;
+    multipart - поле files на каждый файл, части - содержимое файлов без base64.
+    """
+    if fmt == 'multipart':
+        return encode_multipart_formdata([
+            ('files', (name, data, mimetypes.guess_type(name)[0] or 'application/octet-stream'))
+            for name, data in parts
+        ])
+    return b'[' + b', '.join(data for _, data in parts) + b']', 'application/json'
+
+def batch_part(filename: str, chunks: Iterable[bytes], fmt: str = API_BATCH_FORMAT) -> bytes:
+    """Часть пакета для batch_body(): JSON тело файла или его содержимое для multipart"""
+    if fmt == 'multipart':
+        return b''.join(chunks)
+    return payload_bytes(filename, chunks, 'json')
+
+# Результат файла, для которого в ответе API нет записи: приём файла не подтверждён
+BATCH_ITEM_UNCONFIRMED = object()
+
+def _batch_item_error(result):
+    if result is BATCH_ITEM_UNCONFIRMED:
+        return result
+    if isinstance(result, bool):
+        return None if result else 'файл не принят'
+    if not isinstance(result, dict):
+        return None
+    status = result.get('status')
+    if result.get('ok') is False or result.get('error') or (isinstance(status, int) and status >= 400):
+        return str(result.get('error') or f'статус {status}')
+    return None
+
+def batch_item_errors(response: bytes, names: List[str]) -> list:
+    """Результат пакетной отправки по каждому файлу: None - файл принят, иначе причина отказа.
+    
+    API может вернуть массив результатов (или {"results": [...]}) в порядке файлов пакета или
+    с полем filename. Результат с "ok": false, "error" или "status" >= 400 - отказ. Только ответ
+    2xx совсем без результатов по файлам означает, что приняты все файлы. Файл, для которого
+    в ответе нет результата (или имя которого встречается в пакете не один раз), получает
+    BATCH_ITEM_UNCONFIRMED: он не принят и не отвергнут.
+    """
+    try:
+        results = json.loads(response) if response else None
+    except ValueError:
+        results = None
+    if isinstance(results, dict):
+        results = results.get('results')
+    if not isinstance(results, list):
+        return [None] * len(names)
+    
+    by_name = {item['filename']: item for item in results if isinstance(item, dict) and 'filename' in item}
+    if by_name:
+        # Результат по имени нельзя отнести к одному из файлов с одинаковым именем
+        counts = Counter(names)
+        items = [by_name.get(name, BATCH_ITEM_UNCONFIRMED) if counts[name] == 1 else BATCH_ITEM_UNCONFIRMED
+                 for name in names]
+    else:
+        items = [results[index] if index < len(results) else BATCH_ITEM_UNCONFIRMED for index in range(len(names))]
+    missing = sum(item is BATCH_ITEM_UNCONFIRMED for item in items)
+    if missing:
+        logger.warning(f'[PROCESS] API не вернул результат для {missing} из {len(names)} файлов пакета, '
+                       f'они остаются в input до следующего прогона')
+    return [_batch_item_error(item) for item in items]
+
+class ProcessedLedger:
+    """Журнал обработанных файлов в SQLite (WAL).
+    
+    Ключ - путь, размер и время изменения файла; для каждого файла хранится достигнутая стадия
+    (uploaded - отправлен на API, moved - перенесён в output). Файл со стадией uploaded при
+    повторном запуске сразу переносится, без повторной отправки.
+    """
+    
+    STAGE_UPLOADED = 'uploaded'
+    STAGE_MOVED = 'moved'
+    
+    def __init__(self, path: str = LEDGER_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+        if not path:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            # В режиме WAL NORMAL не теряет целостность, а fsync выполняется только на checkpoint
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                ' path TEXT NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' mtime TEXT NOT NULL,'
+                ' content_hash TEXT,'
+                ' stage TEXT NOT NULL,'
+                ' updated_at REAL NOT NULL,'
+                ' PRIMARY KEY (path, size, mtime))'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS hashes ('
+                ' content_hash TEXT PRIMARY KEY,'
+                ' filename TEXT NOT NULL,'
+                ' delivered_at REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS hashes_delivered_at ON hashes (delivered_at)')
+            self._hash_inserts = 0
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f'Ошибка открытия журнала {path}: {e}, журнал отключён')
+            self._db = None
+    
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+    
+    @staticmethod
+    def _key(path: str, size: int, mtime) -> tuple:
+        return path.lower(), size, str(mtime)
+    
+    def get_stage(self, path: str, size: int, mtime) -> Optional[str]:
+        """Достигнутая стадия файла или None, если файл ещё не обрабатывался"""
+        if self._db is None:
+            return None
+        try:
+            with self._lock:
+                row = self._db.execute(
+                    'SELECT stage FROM files WHERE path = ? AND size = ? AND mtime = ?',
+                    self._key(path, size, mtime)
+                ).fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f'Ошибка чтения журнала для {path}: {e}')
+            return None
+    
+    def mark(self, path: str, size: int, mtime, stage: str, content_hash: Optional[str] = None):
+        """Запись достигнутой стадии файла"""
+        if self._db is None:
+            return
+        try:
+            with self._lock:
+                self._db.execute(
+                    'INSERT INTO files (path, size, mtime, content_hash, stage, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (path, size, mtime) DO UPDATE SET '
+                    'stage = excluded.stage, updated_at = excluded.updated_at, '
+                    'content_hash = COALESCE(excluded.content_hash, files.content_hash)',
+                    (*self._key(path, size, mtime), content_hash, stage, time.time())
+                )
+        except sqlite3.Error as e:
+            logger.error(f'Ошибка записи в журнал для {path}: {e}')
+    
+    def find_hash(self, content_hash: str) -> Optional[str]:
+        """Имя файла, с которым содержимое с таким хешем уже было отправлено"""
+        if self._db is None:
+            return None
+        try:
+            with self._lock:
+                row = self._db.execute(
+                    'SELECT filename FROM hashes WHERE content_hash = ?', (content_hash,)
+                ).fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f'Ошибка чтения хеша из журнала: {e}')
+            return None
+    
+    def remember_hash(self, content_hash: str, filename: str, limit: int = DEDUP_DISK_SIZE):
+        """Запоминание хеша отправленного файла; таблица ограничена limit самыми свежими записями"""
+        if self._db is None:
+            return
+        try:
+            with self._lock:
+                # Для уже известного хеша сохраняется имя оригинала, обновляется только время
+                self._db.execute(
+                    'INSERT INTO hashes (content_hash, filename, delivered_at) VALUES (?, ?, ?) '
+                    'ON CONFLICT (content_hash) DO UPDATE SET delivered_at = excluded.delivered_at',
+                    (content_hash, filename, time.time())
+                )
+                self._hash_inserts += 1
+                # Обрезка старых записей не на каждой вставке, а пачками
+                if self._hash_inserts % 1000 == 0:
+                    self._db.execute(
+                        'DELETE FROM hashes WHERE content_hash IN ('
+                        ' SELECT content_hash FROM hashes ORDER BY delivered_at DESC LIMIT -1 OFFSET ?)',
+                        (limit,)
+                    )
+        except sqlite3.Error as e:
+            logger.error(f'Ошибка записи хеша в журнал: {e}')
+    
+    def close(self):
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+                self._db = None
+
+# Глобальный журнал обработанных файлов
+ledger = ProcessedLedger()
+
+class DedupCache:
+    """Кеш хешей (BLAKE2b) отправленных файлов: LRU в памяти поверх таблицы hashes журнала.
+    
+    Промах по хешу закрепляет его за файлом до add()/release(): одинаковые файлы из одного
+    прогона ждут отправки первого, а не уходят на API параллельно.
+    Без журнала (LEDGER_PATH='') работает только кеш в памяти.
+    """
+    
+    def __init__(self, mode: str = DEDUP_MODE, store: ProcessedLedger = None,
+                 memory_size: int = DEDUP_MEMORY_SIZE):
+        self.mode = mode
+        self.store = store
+        self.memory_size = memory_size
+        self._lock = threading.Lock()
+        self._recent = OrderedDict()
+        self._pending = {}
+    
+    @property
+    def enabled(self) -> bool:
+        return self.mode != 'off'
+    
+    def hasher(self):
+        """Новый потоковый хешер или None, если дедупликация отключена"""
+        return hashlib.blake2b(digest_size=20) if self.enabled else None
+    
+    def lookup(self, content_hash: str) -> Optional[str]:
+        """Имя ранее отправленного файла с тем же содержимым.
+        
+        None - промах: хеш закреплён за вызывающим, он обязан вызвать add() или release().
+        """
+        while True:
+            with self._lock:
+                filename = self._recent.get(content_hash)
+                if filename is not None:
+                    self._recent.move_to_end(content_hash)
+                    return filename
+                in_flight = self._pending.get(content_hash)
+                if in_flight is None:
+                    filename = self.store.find_hash(content_hash) if self.store is not None else None
+                    if filename is None:
+                        self._pending[content_hash] = threading.Event()
+                        return None
+            if filename is not None:
+                self._remember_recent(content_hash, filename)
+                return filename
+            # Такой же файл сейчас отправляется - ждём его результата
+            in_flight.wait()
+    
+    def add(self, content_hash: str, filename: str):
+        """Запоминание отправленного файла (снимает закрепление хеша)"""
+        self._remember_recent(content_hash, filename)
+        if self.store is not None:
+            self.store.remember_hash(content_hash, filename)
+        self.release(content_hash)
+    
+    def release(self, content_hash: str):
+        """Снятие закрепления без отправки (ошибка): следующий ожидающий файл будет отправлен сам"""
+        with self._lock:
+            in_flight = self._pending.pop(content_hash, None)
+        if in_flight is not None:
+            in_flight.set()
+    
+    def _remember_recent(self, content_hash: str, filename: str):
+        with self._lock:
+            self._recent.setdefault(content_hash, filename)
+            self._recent.move_to_end(content_hash)
+            while len(self._recent) > self.memory_size:
+                self._recent.popitem(last=False)
+
+# Глобальный кеш дедупликации
+dedup_cache = DedupCache(store=ledger)
+
+def reference_body(filename: str, original: str, content_hash: str) -> bytes:
+    """JSON ссылка на уже отправленный файл с тем же содержимым (режим DEDUP_MODE=reference)"""
+    return json.dumps({
+        'filename': filename,
+        'duplicate_of': original,
+        'content_hash': content_hash,
+    }).encode('utf-8')
+
+def dedup_resolve(name: str, chunks: CountingIterator, stats: 'PipelineStats'):
+    """Проверка полностью прочитанного файла по кешу хешей.
+    
+    Возвращает (пропустить отправку, тело-ссылку или None).
+    """
+    content_hash = chunks.digest
+    if content_hash is None:
+        return False, None
+    original = dedup_cache.lookup(content_hash)
+    if original is None:
+        stats.add('dedup_misses')
+        return False, None
+    stats.add('dedup_hits')
+    if dedup_cache.mode == 'skip':
+        logger.info(f'[PROCESS] Файл {name} совпадает с уже отправленным {original}, отправка пропущена')
+        return True, None
+    logger.info(f'[PROCESS] Файл {name} совпадает с уже отправленным {original}, отправляется ссылка')
+    return False, reference_body(api_filename(name), original, content_hash)
+
+class ReadinessTracker:
+    """Определение файлов, запись которых, вероятно, ещё идёт, по листингу.
+    
+    Файл готов, если его размер и время изменения совпадают с прошлым листингом или он не
+    менялся min_age секунд (по часам сервера относительно локальных). Открытие файла на чтение
+    без FILE_SHARE_WRITE дополнительно отсекает файлы, которые держит открытыми писатель.
+    """
+    
+    def __init__(self, min_age: float = READY_MIN_AGE, max_entries: int = 100000):
+        self.min_age = min_age
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()
+    
+    def is_ready(self, entry: DirEntry) -> bool:
+        if not READY_CHECK or entry.mtime is None:
+            # Размер и время неизвестны (имена из режима наблюдения) - остаётся проверка открытием
+            return True
+        key = entry.name.lower()
+        state = (entry.size, entry.mtime)
+        with self._lock:
+            previous = self._seen.get(key)
+            self._seen[key] = state
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+        if previous is not None:
+            return previous == state
+        age = (datetime.now(timezone.utc).replace(tzinfo=None) - entry.mtime).total_seconds()
+        return age >= self.min_age
+    
+    def forget(self, name: str):
+        """Файл обработан - его состояние больше не нужно"""
+        with self._lock:
+            self._seen.pop(name.lower(), None)
+
+# Глобальное состояние готовности файлов между прогонами
+readiness = ReadinessTracker()
+
+class InputScheduler:
+    """Порядок и темп подачи файлов в обработку.
+    
+    Листинг упорядочивается окнами по window элементов (по размеру, если задан order), а суммарный
+    размер файлов в обработке ограничен max_bytes: пока крупный файл не помещается в предел, вперёд
+    пропускаются подходящие мелкие. Файл крупнее предела запускается, когда обработка пуста.
+    """
+    
+    def __init__(self, order: str = SCHEDULE_ORDER, window: int = SCHEDULE_WINDOW,
+                 max_bytes: int = SCHEDULE_MAX_BYTES_IN_FLIGHT):
+        self.order = order
+        self.window = window
+        self.max_bytes = max_bytes
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._in_flight_files = 0
+    
+    def schedule(self, entries: Iterable[DirEntry]) -> Iterator[DirEntry]:
+        """Файлы в порядке запуска; блокируется, пока предел max_bytes занят"""
+        entries = iter(entries)
+        if self.order == 'listing' and not self.max_bytes:
+            # Без сортировки и предела окно не нужно - сохраняем полностью потоковую подачу
+            for entry in entries:
+                with self._cond:
+                    self._in_flight += entry.size
+                    self._in_flight_files += 1
+                yield entry
+            return
+        while True:
+            window = list(itertools.islice(entries, self.window))
+            if not window:
+                return
+            if self.order == 'largest_first':
+                window.sort(key=lambda entry: entry.size, reverse=True)
+            elif self.order == 'smallest_first':
+                window.sort(key=lambda entry: entry.size)
+            yield from self._admit(window)
+    
+    def _admit(self, window: List[DirEntry]) -> Iterator[DirEntry]:
+        while window:
+            with self._cond:
+                while True:
+                    index = next((i for i, entry in enumerate(window) if self._fits(entry.size)), None)
+                    if index is not None:
+                        break
+                    self._cond.wait()
+                entry = window.pop(index)
+                self._in_flight += entry.size
+                self._in_flight_files += 1
+            yield entry
+    
+    def _fits(self, size: int) -> bool:
+        return not self.max_bytes or self._in_flight == 0 or self._in_flight + size <= self.max_bytes
+    
+    def release(self, size: int):
+        """Файл размера size закончил обработку (успешно или с ошибкой)"""
+        with self._cond:
+            self._in_flight -= size
+            self._in_flight_files -= 1
+            if self.max_bytes:
+                self._cond.notify_all()
+    
+    def in_flight(self) -> Tuple[int, int]:
+        """Байт и файлов в обработке сейчас"""
+        with self._cond:
+            return self._in_flight, self._in_flight_files
+
+# Прогоны обработки, идущие сейчас: по ним /metrics показывает очереди и объём файлов в обработке
+_active_runs = set()
+_active_runs_lock = threading.Lock()
+
+def track_run(run, active: bool = True):
+    """Регистрация прогона (ProcessingPipeline или AsyncProcessingEngine) на время его работы"""
+    with _active_runs_lock:
+        if active:
+            _active_runs.add(run)
+        else:
+            _active_runs.discard(run)
+
+def _collect_runs(values) -> dict:
+    """Сумма значений values(run) -> {метки: значение} по всем идущим прогонам"""
+    with _active_runs_lock:
+        runs = list(_active_runs)
+    totals = {}
+    for run in runs:
+        for key, value in values(run).items():
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+metrics.gauge('smb_processor_queue_depth', 'Файлы, ожидающие стадию конвейера (batch - набираемый пакет)',
+              ('queue',), collect=lambda: _collect_runs(
+                  lambda run: {(name,): depth for name, depth in run.queue_depths().items()}))
+metrics.gauge('smb_processor_in_flight_bytes', 'Суммарный размер файлов в обработке',
+              collect=lambda: _collect_runs(lambda run: {(): run.scheduler.in_flight()[0]}) or {(): 0})
+metrics.gauge('smb_processor_in_flight_files', 'Файлов в обработке',
+              collect=lambda: _collect_runs(lambda run: {(): run.scheduler.in_flight()[1]}) or {(): 0})
+
+@dataclass
+class FileTask:
+    """Файл, проходящий через стадии конвейера"""
+    name: str
+    path: str
+    output_path: str
+    client: Optional[StorageBackend] = None
+    chunks: Optional[CountingIterator] = None
+    prefetched: List[bytes] = field(default_factory=list)
+    buffered: bool = False
+    body: object = None
+    size: int = 0
+    info: dict = field(default_factory=dict)
+    delivered: bool = False
+    dedup_claim: Optional[str] = None
+    scheduled_size: int = 0
+    batchable: bool = False
+    headers: Optional[dict] = None
+    upload_name: Optional[str] = None
+    listed: bool = False
+    
+    @classmethod
+    def from_entry(cls, entry: DirEntry, input_path: str, output_path: str) -> 'FileTask':
+        # Размер и время изменения из листинга позволяют проверить журнал, не открывая файл
+        listed = entry.mtime is not None
+        return cls(
+            name=entry.name,
+            path=f"{input_path}\\{entry.name}",
+            output_path=f"{output_path}\\{entry.name}",
+            scheduled_size=entry.size,
+            info={'size': entry.size, 'mtime': entry.mtime} if listed else {},
+            listed=listed
+        )
+    
+    def close(self):
+        """Закрытие открытого на SMB файла и снятие закрепления хеша, если файл так и не был отправлен"""
+        if self.chunks is not None:
+            self.chunks.close()
+        if self.dedup_claim is not None:
+            dedup_cache.release(self.dedup_claim)
+            self.dedup_claim = None
+
+class PipelineStats:
+    """Потокобезопасные счётчики одного прогона обработки"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.total = 0
+        self.processed = 0
+        self.failed = 0
+        self.bytes = 0
+        self.api_connections = 0
+        self.api_handshake_sec = 0.0
+        self.api_transfer_sec = 0.0
+        self.api_requests = 0
+        self.dedup_hits = 0
+        self.dedup_misses = 0
+        self.deferred = 0
+        # Файлы, оставленные в input, пока API недоступен (открыт предохранитель)
+        self.deferred_api = 0
+        self.api_retries = 0
+        self.dead_lettered = 0
+        self.memory_peak_bytes = None
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+    
+    def add(self, name: str, value: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+        # Итоги по файлам видны в /metrics сразу, а не по окончании прогона
+        if name in ('processed', 'failed', 'deferred', 'deferred_api', 'dead_lettered'):
+            file_results.inc(value, result=name)
+        elif name == 'bytes':
+            processed_bytes.inc(value)
+        elif name == 'api_retries':
+            api_retry_count.inc(value)
+    
+    def add_upload(self, timing: UploadTiming):
+        """Учёт времени запроса к API (у пакета - один раз на весь пакет)"""
+        self.add('api_connections', timing.new_connections)
+        self.add('api_handshake_sec', timing.handshake_sec)
+        self.add('api_transfer_sec', timing.transfer_sec)
+    
+    def finish(self):
+        first = self.finished_at is None
+        self.finished_at = time.monotonic()
+        if tracemalloc.is_tracing():
+            # Пик общий для процесса: при одновременных заданиях включает память соседних
+            self.memory_peak_bytes = tracemalloc.get_traced_memory()[1]
+        if first:
+            # finish() вызывают и движок, и задание - прогон учитывается один раз
+            runs_finished.inc()
+            run_files.observe(self.total)
+            run_seconds.observe(self.finished_at - self.started_at)
+    
+    def to_dict(self) -> dict:
+        duration = (self.finished_at or time.monotonic()) - self.started_at
+        return {
+            'total': self.total,
+            'processed': self.processed,
+            'failed': self.failed,
+            'deferred': self.deferred,
+            'deferred_api': self.deferred_api,
+            'dead_lettered': self.dead_lettered,
+            'bytes': self.bytes,
+            'duration_sec': round(duration, 3),
+            'files_per_sec': round(self.processed / duration, 2) if duration > 0 else 0.0,
+            'mb_per_sec': round(self.bytes / duration / (1024 * 1024), 2) if duration > 0 else 0.0,
+            'api_requests': self.api_requests,
+            'api_connections': self.api_connections,
+            'api_handshake_sec': round(self.api_handshake_sec, 3),
+            'api_transfer_sec': round(self.api_transfer_sec, 3),
+            'api_retries': self.api_retries,
+            'dedup_hits': self.dedup_hits,
+            'dedup_misses': self.dedup_misses,
+            'memory_peak_bytes': self.memory_peak_bytes,
+        }
+
+# Шаги обработки одного файла, общие для обоих движков. Движки различаются только тем, где
+# выполняются блокирующие вызовы: в потоках стадий конвейера или в пулах потоков asyncio
+
+def check_ledger(task: FileTask) -> bool:
+    """Файл уже доставлен на API в прошлом запуске - помечается delivered, его остаётся только перенести.
+    
+    Для файлов из листинга вызывается до чтения (размер и время изменения из листинга),
+    для имён без них (режим наблюдения) - после открытия, по ответу на CREATE.
+    """
+    if ledger.get_stage(task.path, task.info['size'], task.info['mtime']) is None:
+        return False
+    logger.info(f'[PROCESS] Файл {task.name} уже отправлен ранее, повторная отправка пропущена')
+    task.delivered = True
+    task.size = task.info['size']
+    task.prefetched = []
+    return True
+
+def read_head(task: FileTask):
+    """Чтение начала файла в task.prefetched через task.client; небольшие файлы читаются целиком.
+    
+    Ошибки пробрасываются вызывающему, подключение возвращает в пул он же.
+    """
+    task.chunks = CountingIterator(task.client.iter_file_chunks(task.path, info=task.info), dedup_cache.hasher())
+    limit = buffer_limit(task.name)
+    for chunk in task.chunks:
+        task.prefetched.append(chunk)
+        if task.chunks.bytes_read > limit:
+            return
+    task.buffered = True
+
+def check_read(task: FileTask) -> bool:
+    """Решение по прочитанному началу файла; False - файл не прочитан.
+    
+    Файл не из листинга проверяется здесь по журналу (check_ledger).
+    """
+    if not task.listed and check_ledger(task):
+        return True
+    if not task.chunks.bytes_read:
+        logger.error(f'[PROCESS] Ошибка чтения файла {task.name}')
+        return False
+    if task.buffered:
+        logger.info(f'[PROCESS] Файл {task.name} прочитан, размер {task.chunks.bytes_read} байт')
+    return True
+
+def prepare_upload(task: FileTask, stats: PipelineStats, batching: bool):
+    """Подготовка тела запроса: целиком для прочитанных файлов, генератором для крупных.
+    
+    Прочитанный целиком файл проверяется по кешу дедупликации (может ждать отправки такого же
+    файла) и при необходимости перекодируется в пуле процессов; batching - файл пойдёт в пакет.
+    """
+    if task.delivered:
+        return
+    task.upload_name = api_filename(task.name)
+    if task.buffered:
+        # Хеш известен только для прочитанных целиком файлов; крупные лишь запоминаются после отправки
+        skip, task.body = dedup_resolve(task.name, task.chunks, stats)
+        if skip:
+            task.delivered = True
+            task.size = task.chunks.bytes_read
+            ledger.mark(task.path, task.info['size'], task.info['mtime'], ProcessedLedger.STAGE_UPLOADED,
+                        task.chunks.digest)
+        elif task.body is None:
+            task.dedup_claim = task.chunks.digest
+            data = task.prefetched
+            if needs_reencode(task.name):
+                task.upload_name, data = cpu_pool.reencode(task.upload_name, task.prefetched)
+            task.batchable = batching
+            if task.batchable:
+                task.body = batch_part(task.upload_name, data)
+            else:
+                task.body = payload_bytes(task.upload_name, data)
+                task.headers = payload_headers(task.upload_name)
+    else:
+        task.body = iter_payload_body(task.upload_name, itertools.chain(task.prefetched, task.chunks))
+        task.headers = payload_headers(task.upload_name)
+    task.prefetched = []
+
+def body_for_attempt(task: FileTask, attempt: int):
+    """Тело запроса для попытки отправки: потоковое тело для повтора строится заново из SMB"""
+    if attempt == 0 or isinstance(task.body, bytes):
+        return task.body
+    task.chunks.close()
+    task.chunks = CountingIterator(task.client.iter_file_chunks(task.path), dedup_cache.hasher())
+    return iter_payload_body(task.upload_name, task.chunks)
+
+def mark_uploaded(task: FileTask, timing: UploadTiming, stats: PipelineStats):
+    """Учёт доставленного на API файла в журнале, кеше дедупликации и счётчиках"""
+    task.size = task.chunks.bytes_read
+    content_hash = task.chunks.digest
+    ledger.mark(task.path, task.info['size'], task.info['mtime'], ProcessedLedger.STAGE_UPLOADED, content_hash)
+    if content_hash is not None:
+        dedup_cache.add(content_hash, api_filename(task.name))
+        task.dedup_claim = None
+    stats.add_upload(timing)
+    logger.info(f'[PROCESS] Файл {task.name} успешно отправлен на API, размер {task.size} байт '
+                f'(соединение {timing.handshake_sec * 1000:.0f} мс, передача {timing.transfer_sec * 1000:.0f} мс)')
+
+def batch_label(batch: List[FileTask]) -> str:
+    return f'{batch[0].name} (пакет из {len(batch)})'
+
+def batch_request(batch: List[FileTask]) -> Tuple[bytes, dict]:
+    """Тело и заголовки пакетного запроса; части тела отдельных файлов после этого не нужны"""
+    logger.info(f'[PROCESS] Отправка пакета из {len(batch)} изображений на API...')
+    body, content_type = batch_body([(task.upload_name, task.body) for task in batch])
+    for task in batch:
+        task.body = None
+    return body, {'Content-Type': content_type}
+
+def batch_results(batch: List[FileTask], body: bytes, timing: UploadTiming) -> list:
+    """Итог отправленного пакета по файлам: UploadTiming для принятого файла или исключение.
+    
+    Время запроса достаётся первому принятому файлу, чтобы пакет учитывался в счётчиках один раз.
+    """
+    logger.info(f'[PROCESS] Пакет из {len(batch)} файлов ({len(body)} байт) отправлен на API '
+                f'(соединение {timing.handshake_sec * 1000:.0f} мс, передача {timing.transfer_sec * 1000:.0f} мс)')
+    results = []
+    for task, error in zip(batch, batch_item_errors(timing.response, [task.upload_name for task in batch])):
+        if error is BATCH_ITEM_UNCONFIRMED:
+            results.append(BatchItemUnconfirmed(f'API не подтвердил приём файла {task.name}'))
+            continue
+        if error is not None:
+            results.append(BatchItemError(f'API не принял файл {task.name}: {error}'))
+            continue
+        results.append(timing)
+        timing = UploadTiming()
+    return results
+
+def finalize_task(pool: SMBConnectionPool, task: FileTask) -> bool:
+    """Перенос файла в output (rename на сервере, без повторной передачи данных)"""
+    logger.info(f'[PROCESS] Перенос файла в папку output: {task.name}')
+    try:
+        with pool.connection() as client:
+            moved_path = client.move(task.path, task.output_path, SMB_MOVE_ON_CONFLICT)
+    except Exception as e:
+        logger.error(f'[PROCESS] Ошибка при переносе файла {task.name}: {e}')
+        return False
+    if not moved_path:
+        logger.error(f'[PROCESS] Ошибка при переносе файла {task.name} в output')
+        return False
+    ledger.mark(task.path, task.info['size'], task.info['mtime'], ProcessedLedger.STAGE_MOVED)
+    logger.info(f'[PROCESS] Файл {task.name} перемещён в {moved_path}')
+    return True
+
+class ProcessingPipeline:
+    """Конвейер обработки: чтение -> кодирование -> отправка -> перенос.
+    
+    Каждая стадия обслуживается своим пулом потоков, стадии связаны ограниченными
+    очередями: медленная стадия притормаживает предыдущие (backpressure), а не
+    накапливает файлы в памяти.
+    """
+    
+    def __init__(self, pool: SMBConnectionPool, input_path: str, output_path: str,
+                 readers: int = PIPELINE_READERS, encoders: int = PIPELINE_ENCODERS,
+                 uploaders: int = PIPELINE_UPLOADERS, finalizers: int = PIPELINE_FINALIZERS,
+                 queue_size: int = PIPELINE_QUEUE_SIZE, stats: Optional[PipelineStats] = None,
+                 scheduler: Optional[InputScheduler] = None, batch_size: int = API_BATCH_SIZE,
+                 batch_max_bytes: int = API_BATCH_MAX_BYTES):
+        self.pool = pool
+        self.input_path = input_path
+        self.output_path = output_path
+        self.scheduler = scheduler or InputScheduler()
+        self.batch_size = batch_size
+        self.batch_max_bytes = batch_max_bytes
+        self.stages = [
+            ('read', self._read, readers),
+            ('encode', self._encode, encoders),
+            ('upload', self._upload, uploaders),
+            ('finalize', self._finalize, finalizers),
+        ]
+        self.queue_size = queue_size
+        self.stats = stats or PipelineStats()
+        self._queues = []
+    
+    def queue_depths(self) -> dict:
+        """Сколько задач ждёт каждую стадию"""
+        return {stage: stage_queue.qsize() for (stage, _, _), stage_queue in zip(self.stages, self._queues)}
+    
+    def run(self, entries: Iterable[DirEntry]) -> PipelineStats:
+        """Прогон файлов через все стадии; возвращается после завершения последнего файла"""
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        stage_threads = []
+            
+        for index, (stage, func, workers) in enumerate(self.stages):
+            out_queue = queues[index + 1] if index + 1 < len(queues) else None
+            batching = stage == 'upload' and self.batch_size > 1
+            threads = [
+                threading.Thread(
+                    target=self._batch_worker if batching else self._worker,
+                    args=(stage, func, queues[index], out_queue),
+                    name=f'pipeline-{stage}-{n}',
+                    daemon=True
+                )
+                for n in range(workers)
+            ]
+            for thread in threads:
+                thread.start()
+            stage_threads.append(threads)
+        
+        self._queues = queues
+        track_run(self)
+        try:
+            # put() блокируется, пока стадия чтения не освободит место в очереди
+            for entry in self.scheduler.schedule(entries):
+                if api_breaker.is_open():
+                    # API недоступен - файл даже не читаем, он останется в input до следующего прогона
+                    self.scheduler.release(entry.size)
+                    self.stats.add('deferred_api')
+                    continue
+                queues[0].put(FileTask.from_entry(entry, self.input_path, self.output_path))
+        finally:
+            # Останавливаем стадии по очереди: следующая получает сигнал только после опустошения предыдущей
+            for index, threads in enumerate(stage_threads):
+                for _ in threads:
+                    queues[index].put(None)
+                for thread in threads:
+                    thread.join()
+            track_run(self, active=False)
+        
+        self.stats.finish()
+        return self.stats
+    
+    def _worker(self, stage: str, func, in_queue: queue.Queue, out_queue: Optional[queue.Queue]):
+        """Цикл потока стадии: берёт задачу, обрабатывает, передаёт дальше"""
+        while True:
+            task = in_queue.get()
+            if task is None:
+                break
+            self._handle(stage, func, task, out_queue)
+    
+    def _batch_worker(self, stage: str, func, in_queue: queue.Queue, out_queue: Optional[queue.Queue]):
+        """Цикл потока отправки в пакетном режиме.
+        
+        Прочитанные целиком файлы собираются в пакет до batch_size файлов или batch_max_bytes байт;
+        неполный пакет отправляется, если следующий файл не пришёл за API_BATCH_LINGER секунд.
+        Крупные файлы и файлы, которые отправлять не нужно, проходят стадию по одному.
+        """
+        carry = []
+        while True:
+            task = carry.pop() if carry else in_queue.get()
+            if task is None:
+                break
+            if not task.batchable:
+                self._handle(stage, func, task, out_queue)
+                continue
+            
+            batch = [task]
+            batch_bytes = len(task.body)
+            names = {task.upload_name}
+            deadline = time.monotonic() + API_BATCH_LINGER
+            while len(batch) < self.batch_size:
+                try:
+                    task = in_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if (task is None or not task.batchable or batch_bytes + len(task.body) > self.batch_max_bytes
+                        or task.upload_name in names):
+                    # Файл в пакет не помещается (или имя уже есть в пакете) - он будет первым в следующей итерации
+                    carry.append(task)
+                    break
+                batch.append(task)
+                batch_bytes += len(task.body)
+                names.add(task.upload_name)
+            self._upload_batch(batch, out_queue)
+    
+    def _handle(self, stage: str, func, task: FileTask, out_queue: Optional[queue.Queue]):
+        """Обработка задачи функцией стадии и передача её дальше"""
+        try:
+            ok = func(task)
+        except FileNotReady as e:
+            self._defer(task, e)
+            return
+        except Exception as e:
+            logger.error(f'[PROCESS] Ошибка на стадии {stage} для файла {task.name}: {e}')
+            ok = False
+        self._complete(task, ok, out_queue)
+    
+    def _complete(self, task: FileTask, ok: bool, out_queue: Optional[queue.Queue]):
+        """Передача задачи следующей стадии либо учёт её результата"""
+        if not ok:
+            self._release(task)
+            self.scheduler.release(task.scheduled_size)
+            self.stats.add('failed')
+            return
+        
+        if out_queue is not None:
+            out_queue.put(task)
+        else:
+            self.scheduler.release(task.scheduled_size)
+            readiness.forget(task.name)
+            self.stats.add('processed')
+            self.stats.add('bytes', task.size)
+    
+    def _defer(self, task: FileTask, reason: Exception):
+        logger.info(f'[PROCESS] {reason}, файл отложен до следующего прогона')
+        self._release(task)
+        self.scheduler.release(task.scheduled_size)
+        self.stats.add('deferred_api' if isinstance(reason, APIUnavailable) else 'deferred')
+    
+    def _release(self, task: FileTask, broken: bool = False):
+        """Закрытие файла задачи и возврат её SMB подключения в пул"""
+        task.close()
+        if task.client is not None:
+            self.pool.release(task.client, broken=broken)
+            task.client = None
+    
+    def _read(self, task: FileTask) -> bool:
+        """Открытие файла и чтение первых блоков; небольшие файлы читаются целиком.
+            
+        Для крупных файлов подключение остаётся за задачей до конца отправки.
+        """
+        if task.listed and check_ledger(task):
+            return True
+        logger.info(f'[PROCESS] Чтение файла: {task.path}')
+        task.client = self.pool.acquire()
+        try:
+            read_head(task)
+        except Exception as e:
+            self._release(task, broken=is_connection_error(e))
+            raise_if_busy(task.name, e)
+            logger.error(f'[PROCESS] Ошибка чтения файла {task.name}: {e}')
+            return False
+        if not check_read(task):
+            return False
+        if task.buffered or task.delivered:
+            # Файл прочитан целиком или уже отправлен ранее - подключение больше не нужно
+            self._release(task)
+        return True
+    
+    def _encode(self, task: FileTask) -> bool:
+        """Подготовка тела запроса (prepare_upload)"""
+        prepare_upload(task, self.stats, self.batch_size > 1)
+        return True
+    
+    def _upload(self, task: FileTask) -> bool:
+        """Отправка на API"""
+        if task.delivered:
+            return True
+        logger.info(f'[PROCESS] Отправка изображения {task.name} на API ({API_PAYLOAD_FORMAT})...')
+        broken = False
+        try:
+            timing = upload_with_retry(task.name, lambda attempt: body_for_attempt(task, attempt), self.stats,
+                                       task.headers)
+            mark_uploaded(task, timing, self.stats)
+            return True
+        except requests.RequestException as e:
+            logger.error(f'[PROCESS] Ошибка при отправке файла {task.name}: {e}')
+            self._dead_letter(task, e)
+            return False
+        except FileNotReady:
+            raise
+        except Exception as e:
+            logger.error(f'[PROCESS] Ошибка чтения файла {task.name} во время отправки: {e}')
+            broken = is_connection_error(e)
+            return False
+        finally:
+            task.body = None
+            self._release(task, broken=broken)
+    
+    def _upload_batch(self, batch: List[FileTask], out_queue: Optional[queue.Queue]):
+        """Отправка пакета одним запросом и разбор результата по каждому файлу"""
+        label = batch_label(batch)
+        try:
+            body, headers = batch_request(batch)
+            timing = upload_with_retry(label, lambda attempt: body, self.stats, headers)
+        except FileNotReady as e:
+            for task in batch:
+                self._defer(task, e)
+            return
+        except Exception as e:
+            logger.error(f'[PROCESS] Ошибка при отправке пакета {label}: {e}')
+            for task in batch:
+                if isinstance(e, requests.RequestException):
+                    self._dead_letter(task, e)
+                self._complete(task, False, out_queue)
+            return
+        
+        for task, result in zip(batch, batch_results(batch, body, timing)):
+            if isinstance(result, UploadTiming):
+                mark_uploaded(task, result, self.stats)
+                self._complete(task, True, out_queue)
+                continue
+            logger.error(f'[PROCESS] {result}')
+            self._dead_letter(task, result)
+            self._complete(task, False, out_queue)
+    
+    def _dead_letter(self, task: FileTask, error: requests.RequestException):
+        """Перенос не принятого API файла в SMB_DEAD_LETTER_DIR, если это нужно"""
+        if not should_dead_letter(error):
+            return
+        # Файл закрываем до переноса: открытый на чтение файл нельзя переименовать
+        self._release(task)
+        move_to_dead_letter(self.pool, task, error, self.stats)
+    
+    def _finalize(self, task: FileTask) -> bool:
+        """Перенос файла в output (finalize_task)"""
+        return finalize_task(self.pool, task)
+
+def iter_input_images(input_path: str, recursive: bool = SMB_INPUT_RECURSIVE) -> Iterator[DirEntry]:
+    """Проверка записи в input и потоковое получение изображений для обработки.
+    
+    Имена отдаются по мере чтения страниц листинга, так что конвейер начинает работу до его
+    окончания. Пока генератор не исчерпан или не закрыт, за ним закреплено подключение из пула.
+    """
+    found = 0
+    try:
+        with smb_pool.connection() as smb_client:
+            # Тест записи
+            test_file = f"{input_path}\\.__smb_test__.txt"
+            test_data = b'test'
+            
+            logger.info(f'[PROCESS] Проверка записи: создание тестового файла {test_file}')
+            if smb_client.write_file(test_file, test_data):
+                logger.info('[PROCESS] Тестовый файл создан')
+                
+                logger.info(f'[PROCESS] Удаление тестового файла {test_file}')
+                if smb_client.delete_file(test_file):
+                    logger.info('[PROCESS] Тестовый файл удалён')
+            
+            # Получение списка файлов
+            logger.info(f'[PROCESS] Чтение списка файлов из {input_path}')
+            patterns = [f'*{ext}' for ext in IMAGE_EXTENSIONS] if SMB_LIST_SERVER_FILTER else None
+            for entry in smb_client.walk(input_path, recursive, patterns):
+                if entry.is_dir:
+                    continue
+                found += 1
+                # Фильтрация изображений (при серверном фильтре - страховка от совпадений по коротким именам)
+                if is_image_file(entry.name):
+                    yield entry
+    except Exception as e:
+        logger.error(f'Ошибка получения списка файлов из {input_path}: {e}')
+    logger.info(f'[PROCESS] Найдено файлов: {found}')
+
+def input_images(stats: 'PipelineStats', file_names: Optional[List[str]] = None) -> Optional[Iterator[DirEntry]]:
+    """Изображения для прогона: переданные имена или потоковый листинг input; None - обрабатывать нечего.
+    
+    Для переданных имён размер неизвестен (0), планировщик ставит их в порядке передачи.
+    """
+    if file_names is None:
+        images = iter_input_images(SMB_INPUT_DIR)
+        if smb_pool.size < 2:
+            # Единственное подключение занято листингом - конвейеру нужен полный список заранее
+            images = iter(list(images))
+    else:
+        images = iter([DirEntry(name=f, size=0, mtime=None, is_dir=False) for f in file_names if is_image_file(f)])
+    
+    first = next(images, None)
+    if first is None:
+        return None
+    
+    def stream():
+        # stats.total растёт по мере поступления имён из листинга
+        try:
+            for entry in itertools.chain([first], images):
+                if not readiness.is_ready(entry):
+                    logger.info(f'[PROCESS] Файл {entry.name} ещё изменяется, отложен до следующего прогона')
+                    stats.add('deferred')
+                    continue
+                stats.add('total')
+                yield entry
+        finally:
+            close = getattr(images, 'close', None)
+            if close:
+                close()
+    
+    return stream()
+
+def run_result(stats: PipelineStats) -> dict:
+    """Ответ /process по итогам прогона"""
+    logger.info(f'[PROCESS] Итоги: {stats.to_dict()}')
+    if stats.failed:
+        return {'message': 'Обработка завершена с ошибками', **stats.to_dict()}
+    if stats.deferred_api:
+        return {'message': 'Обработка прервана: API недоступен, неотправленные файлы оставлены в input',
+                **stats.to_dict()}
+    if stats.deferred:
+        return {'message': 'Обработка завершена, файлы, которые ещё записываются, отложены', **stats.to_dict()}
+    return {'message': 'Все изображения отправлены и перемещены в output', **stats.to_dict()}
+
+def process_files(stats: Optional[PipelineStats] = None, file_names: Optional[List[str]] = None):
+    """Основная функция обработки файлов.
+    
+    stats - счётчики, которые видны снаружи во время прогона; file_names - обработать только
+    эти файлы из input (режим наблюдения) вместо полного обхода папки.
+    """
+    logger.info('[PROCESS] Запуск обработки файлов из SMB')
+    
+    input_path = SMB_INPUT_DIR
+    output_path = SMB_OUTPUT_DIR
+    
+    try:
+        stats = stats or PipelineStats()
+        image_files = input_images(stats, file_names)
+        
+        if image_files is None:
+            logger.info(' Нет изображений для обработки')
+            return {'message': 'Нет изображений для обработки'}
+        
+        # Обработка изображений конвейером: листинг, чтение, кодирование, отправка и перенос идут параллельно
+        pipeline = ProcessingPipeline(smb_pool, input_path, output_path, stats=stats)
+        try:
+            return run_result(pipeline.run(image_files))
+        finally:
+            image_files.close()
+        
+    except Exception as error:
+        logger.error(f'[PROCESS] Ошибка выполнения процесса: {error}')
+        raise error
+
+class AsyncProcessingEngine:
+    """Асинхронный движок обработки на asyncio.
+    
+    Блокирующие вызовы smbprotocol выполняются в отдельном пуле потоков, отправка на API
+    идёт через httpx.AsyncClient (или через общий APIUploader в пуле потоков, если httpx
+    не установлен). Одновременно в обработке до max_in_flight файлов в одном процессе.
+    Решения по файлу (журнал, дедупликация, пакеты, повторы, dead letter) - общие с конвейером.
+    """
+    
+    def __init__(self, pool: SMBConnectionPool, input_path: str, output_path: str,
+                 max_in_flight: int = ASYNC_MAX_IN_FLIGHT, stats: Optional[PipelineStats] = None,
+                 scheduler: Optional[InputScheduler] = None, batch_size: int = API_BATCH_SIZE,
+                 batch_max_bytes: int = API_BATCH_MAX_BYTES):
+        self.pool = pool
+        self.input_path = input_path
+        self.output_path = output_path
+        self.scheduler = scheduler or InputScheduler()
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+        self.batch_max_bytes = batch_max_bytes
+        self.stats = stats or PipelineStats()
+        # Половина потоков может ждать подключения из пула, вторая половина всегда свободна для I/O
+        self.smb_executor = ThreadPoolExecutor(max_workers=pool.size * 2, thread_name_prefix='smb-io')
+        self.upload_executor = None if httpx else ThreadPoolExecutor(
+            max_workers=API_POOL_SIZE, thread_name_prefix='api-upload')
+        self._smb_slots = None
+        self._http = None
+        self._group = None
+        # Текущий набираемый пакет: (задача, future результата)
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_timer = None
+    
+    def queue_depths(self) -> dict:
+        """Файлы, ожидающие отправки в набираемом пакете (очередей между стадиями нет)"""
+        return {'batch': len(self._batch)}
+    
+    async def run(self, entries: Iterable[DirEntry]) -> PipelineStats:
+        """Обработка всех файлов; возвращается после завершения последнего.
+        
+        Файлы и отправки пакетов - задачи одной asyncio.TaskGroup: завершённые задачи она не
+        хранит, а при ошибке, прервавшей прогон, отменяет оставшиеся.
+        """
+        loop = asyncio.get_running_loop()
+        self._smb_slots = asyncio.Semaphore(self.pool.size)
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        track_run(self)
+        try:
+            if httpx is not None:
+                self._http = httpx.AsyncClient(
+                    http2=API_HTTP2,
+                    timeout=API_TIMEOUT,
+                    limits=httpx.Limits(max_connections=API_POOL_SIZE, max_keepalive_connections=API_POOL_SIZE)
+                )
+            # Потоковый листинг SMB и ожидание предела планировщика блокируют - следующий файл
+            # получаем вне цикла событий
+            scheduled = self.scheduler.schedule(entries)
+            try:
+                async with asyncio.TaskGroup() as group:
+                    self._group = group
+                    while True:
+                        entry = await loop.run_in_executor(None, next, scheduled, None)
+                        if entry is None:
+                            break
+                        if api_breaker.is_open():
+                            # API недоступен - файл даже не читаем, он останется в input до следующего прогона
+                            self.scheduler.release(entry.size)
+                            self.stats.add('deferred_api')
+                            continue
+                        await in_flight.acquire()
+                        task = FileTask.from_entry(entry, self.input_path, self.output_path)
+                        group.create_task(self._process_one(task, in_flight))
+            except BaseExceptionGroup as errors:
+                # Наружу - сама ошибка, из-за которой группа отменила оставшиеся файлы
+                raise errors.exceptions[0]
+        finally:
+            self._group = None
+            if self._batch_timer is not None:
+                self._batch_timer.cancel()
+                self._batch_timer = None
+            track_run(self, active=False)
+            if self._http is not None:
+                await self._http.aclose()
+            self.smb_executor.shutdown(wait=False)
+            if self.upload_executor is not None:
+                self.upload_executor.shutdown(wait=False)
+        self.stats.finish()
+        return self.stats
+    
+    async def _smb(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.smb_executor, func, *args)
+    
+    async def _acquire(self) -> StorageBackend:
+        await self._smb_slots.acquire()
+        try:
+            return await self._smb(self.pool.acquire)
+        except Exception:
+            self._smb_slots.release()
+            raise
+    
+    def _release(self, client: StorageBackend, broken: bool = False):
+        self.pool.release(client, broken=broken)
+        self._smb_slots.release()
+    
+    async def _release_task(self, task: FileTask, broken: bool = False):
+        """Закрытие файла задачи и возврат её подключения в пул"""
+        await self._smb(task.close)
+        if task.client is not None:
+            self._release(task.client, broken=broken)
+            task.client = None
+    
+    async def _process_one(self, task: FileTask, in_flight: asyncio.Semaphore):
+        try:
+            if await self._process(task):
+                readiness.forget(task.name)
+                self.stats.add('processed')
+                self.stats.add('bytes', task.size)
+            else:
+                self.stats.add('failed')
+        except FileNotReady as e:
+            logger.info(f'[PROCESS] {e}, файл отложен до следующего прогона')
+            self.stats.add('deferred_api' if isinstance(e, APIUnavailable) else 'deferred')
+        except Exception as e:
+            logger.error(f'[PROCESS] Ошибка обработки файла {task.name}: {e}')
+            self.stats.add('failed')
+        finally:
+            self.scheduler.release(task.scheduled_size)
+            in_flight.release()
+    
+    async def _process(self, task: FileTask) -> bool:
+        if task.listed and check_ledger(task):
+            return await self._finish(task)
+        logger.info(f'[PROCESS] Чтение файла: {task.path}')
+        task.client = await self._acquire()
+        broken = False
+        try:
+            try:
+                await self._smb(read_head, task)
+            except Exception as e:
+                broken = is_connection_error(e)
+                raise_if_busy(task.name, e)
+                logger.error(f'[PROCESS] Ошибка чтения файла {task.name}: {e}')
+                return False
+            if not check_read(task):
+                return False
+            if task.buffered or task.delivered:
+                # Файл прочитан целиком или уже отправлен ранее - подключение возвращаем сразу, до отправки
+                await self._release_task(task)
+            # Поиск в кеше дедупликации может ждать отправки такого же файла - вне цикла событий
+            await asyncio.get_running_loop().run_in_executor(
+                None, prepare_upload, task, self.stats, self.batch_size > 1)
+            
+            if not task.delivered:
+                try:
+                    timing = await self._upload_file(task)
+                except requests.RequestException as e:
+                    logger.error(f'[PROCESS] Ошибка при отправке файла {task.name}: {e}')
+                    if should_dead_letter(e):
+                        # Файл закрываем до переноса: открытый на чтение файл нельзя переименовать
+                        await self._release_task(task)
+                        await self._dead_letter(task, e)
+                    return False
+                except FileNotReady:
+                    raise
+                except Exception as e:
+                    logger.error(f'[PROCESS] Ошибка чтения файла {task.name} во время отправки: {e}')
+                    broken = is_connection_error(e)
+                    return False
+                mark_uploaded(task, timing, self.stats)
+        finally:
+            task.body = None
+            await self._release_task(task, broken=broken)
+        
+        return await self._finish(task)
+    
+    async def _finish(self, task: FileTask) -> bool:
+        """Перенос отправленного файла в output (finalize_task в пуле потоков SMB)"""
+        await self._smb_slots.acquire()
+        try:
+            return await self._smb(finalize_task, self.pool, task)
+        finally:
+            self._smb_slots.release()
+    
+    async def _dead_letter(self, task: FileTask, error: Exception):
+        await self._smb_slots.acquire()
+        try:
+            await self._smb(move_to_dead_letter, self.pool, task, error, self.stats)
+        finally:
+            self._smb_slots.release()
+    
+    async def _upload_file(self, task: FileTask) -> UploadTiming:
+        """Отправка файла: частью пакета или отдельным запросом с повторами"""
+        if task.batchable:
+            return await self._upload_in_batch(task)
+        logger.info(f'[PROCESS] Отправка изображения {task.name} на API ({API_PAYLOAD_FORMAT})...')
+        # Потоковое тело одноразовое - для повтора файл читается из SMB заново
+        return await self._upload_with_retry(
+            task.name, lambda attempt: self._smb(body_for_attempt, task, attempt), task.headers)
+    
+    async def _upload_in_batch(self, task: FileTask) -> UploadTiming:
+        """Добавление файла в набираемый пакет; возвращается после отправки пакета.
+        
+        Пакет уходит при batch_size файлах или batch_max_bytes байтах, неполный - через
+        API_BATCH_LINGER секунд после первого файла. Отказ API по файлу - BatchItemError.
+        """
+        loop = asyncio.get_running_loop()
+        if self._batch and (self._batch_bytes + len(task.body) > self.batch_max_bytes
+                            or any(queued.upload_name == task.upload_name for queued, _ in self._batch)):
+            # Результаты API сопоставляются по имени - одинаковые имена отправляются разными пакетами
+            self._flush_batch()
+        future = loop.create_future()
+        self._batch.append((task, future))
+        self._batch_bytes += len(task.body)
+        if len(self._batch) >= self.batch_size or self._batch_bytes >= self.batch_max_bytes:
+            self._flush_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = loop.call_later(API_BATCH_LINGER, self._flush_batch)
+        return await future
+    
+    def _flush_batch(self):
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        batch, self._batch, self._batch_bytes = self._batch, [], 0
+        if not batch:
+            return
+        try:
+            self._group.create_task(self._send_batch(batch))
+        except RuntimeError:
+            # Группа уже отменяет задачи (прогон прерван) - пакет не отправляется
+            for _, future in batch:
+                future.cancel()
+    
+    async def _send_batch(self, batch: list):
+        tasks = [task for task, _ in batch]
+        label = batch_label(tasks)
+        try:
+            body, headers = batch_request(tasks)
+            
+            async def make_body(attempt: int):
+                return body
+            
+            timing = await self._upload_with_retry(label, make_body, headers)
+        except Exception as e:
+            logger.error(f'[PROCESS] Ошибка при отправке пакета {label}: {e}')
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for (_, future), result in zip(batch, batch_results(tasks, body, timing)):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+    
+    async def _upload_with_retry(self, name: str, make_body, headers: Optional[dict] = None) -> UploadTiming:
+        """Асинхронный вариант upload_with_retry(); make_body - корутина, возвращающая тело попытки"""
+        attempt = 0
+        while True:
+            try:
+                with api_breaker.guard():
+                    timing = await self._post(await make_body(attempt), headers)
+            except requests.RequestException as e:
+                delay = retry_delay(name, attempt, e, self.stats)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self.stats.add('api_requests')
+            return timing
+    
+    async def _post(self, body, headers: Optional[dict] = None) -> UploadTiming:
+        """Отправка тела; потоковое тело читается из SMB в пуле потоков, не блокируя цикл событий"""
+        headers = headers or {'Content-Type': 'application/json'}
+        if self._http is None:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.upload_executor, upload_body, body, headers)
+        if API_CONTENT_ENCODING:
+            # Сжатие готового тела - работа CPU, выполняется вне цикла событий
+            body, headers = await asyncio.get_running_loop().run_in_executor(None, compress_body, body, headers)
+        
+        if not isinstance(body, bytes):
+            body = self._aiter_body(body)
+        trace = HttpxHandshakeTrace()
+        started = time.perf_counter()
+        try:
+            response = await self._http.post(
+                API_URL,
+                content=body,
+                headers=headers,
+                extensions={'trace': trace.async_trace}
+            )
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            observe_api_response(started, e)
+            raise map_httpx_error(e) from e
+        observe_api_response(started, response.status_code)
+        return trace.timing(time.perf_counter() - started, response.content)
+    
+    async def _aiter_body(self, body: Iterator[bytes]):
+        """Асинхронная обёртка над синхронным генератором тела (чтение SMB + base64 в пуле потоков)"""
+        while True:
+            part = await self._smb(next, body, None)
+            if part is None:
+                break
+            yield part
+
+async def process_files_async(stats: Optional[PipelineStats] = None, file_names: Optional[List[str]] = None):
+    """Асинхронный вариант process_files() на AsyncProcessingEngine"""
+    logger.info('[PROCESS] Запуск асинхронной обработки файлов из SMB')
+    
+    input_path = SMB_INPUT_DIR
+    output_path = SMB_OUTPUT_DIR
+    
+    try:
+        stats = stats or PipelineStats()
+        loop = asyncio.get_running_loop()
+        image_files = await loop.run_in_executor(None, input_images, stats, file_names)
+        
+        if image_files is None:
+            logger.info(' Нет изображений для обработки')
+            return {'message': 'Нет изображений для обработки'}
+        
+        engine = AsyncProcessingEngine(smb_pool, input_path, output_path, stats=stats)
+        try:
+            return run_result(await engine.run(image_files))
+        finally:
+            await loop.run_in_executor(None, image_files.close)
+        
+    except Exception as error:
+        logger.error(f'[PROCESS] Ошибка выполнения процесса: {error}')
+        raise error
+
+def _timestamp(value: Optional[float]) -> Optional[str]:
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(value)) if value else None
+
+class ProcessJob:
+    """Задание на обработку папки input, выполняемое в фоне"""
+    
+    def __init__(self, engine: str, file_names: Optional[List[str]] = None):
+        self.id = uuid.uuid4().hex
+        self.engine = engine
+        self.file_names = file_names
+        self.status = 'queued'
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.stats = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+    
+    def run(self):
+        self.status = 'running'
+        self.started_at = time.time()
+        self.stats = PipelineStats()
+        try:
+            if self.engine == 'async':
+                self.result = asyncio.run(process_files_async(self.stats, self.file_names))
+            else:
+                self.result = process_files(self.stats, self.file_names)
+            self.status = 'done'
+        except Exception as e:
+            self.error = str(e)
+            self.status = 'failed'
+        finally:
+            self.stats.finish()
+            self.finished_at = time.time()
+            self.done.set()
+    
+    def to_dict(self) -> dict:
+        data = {
+            'id': self.id,
+            'status': self.status,
+            'engine': self.engine,
+            'trigger': 'watch' if self.file_names is not None else 'scan',
+            'created_at': _timestamp(self.created_at),
+            'started_at': _timestamp(self.started_at),
+            'finished_at': _timestamp(self.finished_at),
+        }
+        if self.stats is not None:
+            data.update(self.stats.to_dict())
+        if self.result is not None:
+            data['message'] = self.result.get('message')
+        if self.error is not None:
+            data['error'] = self.error
+        return data
+
+class JobManager:
+    """Очередь заданий /process с защитой от параллельных запусков (single-flight).
+    
+    Пока задание в очереди или выполняется, повторные вызовы /process получают его же id,
+    а не запускают второй обход той же папки.
+    """
+    
+    def __init__(self, history_size: int = JOB_HISTORY_SIZE):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='process-job')
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._history = deque()
+        self._history_size = history_size
+        self._active = None
+    
+    def submit(self, engine: str, file_names: Optional[List[str]] = None):
+        """Постановка задания; возвращает (задание, True если присоединились к уже активному)"""
+        with self._lock:
+            if self._active is not None and not self._active.done.is_set():
+                return self._active, True
+            job = ProcessJob(engine, file_names)
+            self._jobs[job.id] = job
+            self._history.append(job.id)
+            while len(self._history) > self._history_size:
+                self._jobs.pop(self._history.popleft(), None)
+            self._active = job
+        self._executor.submit(job.run)
+        logger.info(f'[PROCESS] Задание {job.id} поставлено в очередь (движок {engine})')
+        return job, False
+    
+    def get(self, job_id: str) -> Optional[ProcessJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+    
+    def recent(self) -> List[ProcessJob]:
+        with self._lock:
+            return [self._jobs[job_id] for job_id in reversed(self._history) if job_id in self._jobs]
+
+# Фоновые задания обработки
+job_manager = JobManager()
+
+class InputWatcher:
+    """Режим демона: непрерывная обработка новых файлов в SMB_INPUT_DIR.
+    
+    Держит открытой папку input и выставляет SMB2 CHANGE_NOTIFY; созданные и переименованные
+    файлы сразу уходят в обработку. Если сервер не поддерживает уведомления, переходит
+    на опрос: сначала дешёвая проверка времени изменения папки, листинг - только если оно изменилось.
+    """
+    
+    COMPLETION_FILTER = (CompletionFilter.FILE_NOTIFY_CHANGE_FILE_NAME |
+                         CompletionFilter.FILE_NOTIFY_CHANGE_SIZE |
+                         CompletionFilter.FILE_NOTIFY_CHANGE_LAST_WRITE)
+    INTERESTING_ACTIONS = (FileAction.FILE_ACTION_ADDED,
+                           FileAction.FILE_ACTION_MODIFIED,
+                           FileAction.FILE_ACTION_RENAMED_NEW_NAME)
+    
+    def __init__(self, pool: SMBConnectionPool, jobs: JobManager, input_path: str = SMB_INPUT_DIR,
+                 debounce: float = WATCH_DEBOUNCE, poll_interval: float = WATCH_POLL_INTERVAL,
+                 full_rescan_every: int = WATCH_FULL_RESCAN_EVERY, recursive: bool = SMB_INPUT_RECURSIVE,
+                 retry_interval: float = READY_RETRY_INTERVAL):
+        self.pool = pool
+        self.jobs = jobs
+        self.input_path = input_path
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.full_rescan_every = full_rescan_every
+        self.recursive = recursive
+        self.retry_interval = retry_interval
+        self.mode = None
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='input-watcher', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+    
+    def _run(self):
+        logger.info(f'[WATCH] Наблюдение за папкой {self.input_path}')
+        # Файлы, появившиеся до запуска, обрабатываются обычным полным обходом
+        self._dispatch(None)
+        
+        failures = 0
+        self.mode = 'notify'
+        while not self._stop.is_set():
+            try:
+                # Ошибки обоих режимов проходят через одну повторную попытку с задержкой
+                if self.mode == 'notify':
+                    self._watch_notify()
+                else:
+                    self._watch_poll()
+                failures = 0
+            except Exception as e:
+                if self.mode == 'notify' and isinstance(e, (SMBResponseException, NotImplementedError)):
+                    logger.warning(f'[WATCH] CHANGE_NOTIFY недоступен ({e}), переход на опрос каждые {self.poll_interval} с')
+                    self.mode = 'poll'
+                    continue
+                failures += 1
+                delay = min(SMB_RECONNECT_BACKOFF_MAX, SMB_RECONNECT_BACKOFF * (2 ** min(failures, 16)))
+                logger.error(f'[WATCH] Ошибка наблюдения: {e}, повтор через {delay:.1f} с')
+                self._stop.wait(delay)
+    
+    def _watch_notify(self):
+        """Цикл CHANGE_NOTIFY на открытой папке; возвращается только при остановке.
+        
+        Папка открыта на отдельном подключении вне пула: прогон, запущенный из цикла, ждёт
+        завершения и сам берёт подключения пула - при SMB_POOL_SIZE=1 общее подключение
+        привело бы к взаимной блокировке.
+        """
+        with self.pool.dedicated() as client:
+            dir_open = client.open_directory(self.input_path)
+            try:
+                retry = False
+                while not self._stop.is_set():
+                    changed = self._wait_changes(dir_open, timeout=self.retry_interval if retry else None)
+                    if changed is None:
+                        if retry:
+                            # В прошлом прогоне были отложенные (ещё записывающиеся) файлы - повторяем
+                            retry = self._dispatch(None)
+                        continue
+                    # Накапливаем изменения, пока поток событий не затихнет на debounce секунд
+                    while not self._stop.is_set():
+                        more = self._wait_changes(dir_open, timeout=self.debounce)
+                        if more is None:
+                            break
+                        changed = 'rescan' if 'rescan' in (changed, more) else changed | more
+                    retry = self._dispatch(None if changed == 'rescan' else changed)
+            finally:
+                dir_open.close()
+    
+    def _wait_changes(self, dir_open: Open, timeout: Optional[float]):
+        """Один запрос CHANGE_NOTIFY: множество имён изображений, 'rescan' при переполнении буфера или None по таймауту"""
+        watcher = FileSystemWatcher(dir_open)
+        # Во вложенных папках изменения отслеживаются вместе с корнем; имена приходят относительными путями
+        watcher.start(self.COMPLETION_FILTER, flags=ChangeNotifyFlags.SMB2_WATCH_TREE if self.recursive else 0)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not watcher.response_event.wait(timeout=1):
+            if self._stop.is_set() or (deadline is not None and time.monotonic() >= deadline):
+                watcher.cancel()
+                watcher.response_event.wait(timeout=5)
+                return None
+        
+        actions = watcher.result
+        if actions is None:
+            return None
+        if not actions:
+            # STATUS_NOTIFY_ENUM_DIR: сервер не смог сохранить все изменения
+            return 'rescan'
+        return {
+            action['file_name'].get_value()
+            for action in actions
+            if action['action'].get_value() in self.INTERESTING_ACTIONS
+            and is_image_file(action['file_name'].get_value())
+        }
+    
+    def _watch_poll(self):
+        """Опрос для серверов без CHANGE_NOTIFY; возвращается только при остановке"""
+        known = set()
+        last_mtime = None
+        cycle = 0
+        retry = False
+        while not self._stop.wait(self.poll_interval):
+            cycle += 1
+            # После прогона с отложенными файлами повторяем все файлы папки, даже если она не менялась
+            full_rescan = retry or cycle % self.full_rescan_every == 0
+            with self.pool.connection() as client:
+                # Время изменения корня не отражает изменений во вложенных папках - при обходе его не проверяем
+                mtime = None if self.recursive else client.directory_mtime(self.input_path)
+                if mtime is not None and mtime == last_mtime and not full_rescan:
+                    continue
+                names = {
+                    entry.name for entry in client.walk(self.input_path, self.recursive)
+                    if not entry.is_dir and is_image_file(entry.name)
+                }
+            last_mtime = mtime
+            # Полный цикл - повторяем и оставшиеся в input файлы (например, после ошибок отправки)
+            new_names = names if full_rescan else names - known
+            known = names
+            retry = self._dispatch(new_names) if new_names else False
+    
+    def _dispatch(self, names: Optional[set]) -> bool:
+        """Передача файлов в обработку; None - полный обход папки.
+        
+        Ждёт завершения задания; True - часть файлов отложена и прогон нужно повторить.
+        """
+        file_names = None if names is None else sorted(names)
+        if file_names is not None:
+            logger.info(f'[WATCH] Новые файлы: {len(file_names)}')
+        while not self._stop.is_set():
+            job, coalesced = self.jobs.submit(PROCESS_ENGINE, file_names)
+            job.done.wait()
+            if not coalesced:
+                return bool(job.stats and (job.stats.deferred or job.stats.deferred_api))
+            # Выполнялось чужое задание - наши файлы в него не вошли, запускаем своё следом
+        return False
+
+@app.route('/process', methods=['GET'])
+def process_endpoint():
+    """Endpoint для обработки файлов: ставит задание в фон и сразу возвращает его id"""
+    try:
+        # ?engine=async|threads переопределяет PROCESS_ENGINE для одного запуска
+        engine = request.args.get('engine', PROCESS_ENGINE).lower()
+        job, coalesced = job_manager.submit(engine)
+        
+        # ?wait=1 - дождаться завершения (прежнее синхронное поведение)
+        if request.args.get('wait', '').lower() in ('1', 'true', 'yes'):
+            job.done.wait()
+            if job.status == 'failed':
+                return jsonify({'error': job.error, **job.to_dict()}), 500
+            return jsonify({**(job.result or {}), **job.to_dict()})
+        
+        return jsonify({**job.to_dict(), 'coalesced': coalesced}), 202
+    except Exception as e:
+        logger.error(f'[PROCESS] Ошибка выполнения процесса: {e}')
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs', methods=['GET'])
+def jobs_endpoint():
+    """Список последних заданий обработки"""
+    return jsonify({'jobs': [job.to_dict() for job in job_manager.recent()]})
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_endpoint(job_id: str):
+    """Состояние и прогресс задания обработки"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Задание не найдено'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Endpoint для проверки здоровья сервиса"""
+    return jsonify({'status': 'healthy', 'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+
+metrics.gauge('smb_processor_smb_connections', 'Подключения пула SMB по состоянию', ('state',),
+              collect=lambda: {(state,): smb_pool.stats()[state] for state in ('idle', 'in_use')})
+metrics.gauge('smb_processor_api_breaker_open', 'Предохранитель отправки на API разомкнут (1) или нет (0)',
+              collect=lambda: {(): int(api_breaker.is_open())})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Метрики в текстовом формате Prometheus: задержки SMB и API, объёмы, очереди конвейера"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+if __name__ == '__main__':
     # Инициализация SMB при запуске
     initialize_smb()
     
+    # Режим демона: WATCH_MODE=1 или python app.py --watch
+    if WATCH_MODE or '--watch' in sys.argv:
+        InputWatcher(smb_pool, job_manager).start()
+    
     logger.info(f' Сервер запущен: http://localhost:{PORT}')
     app.run(host='0.0.0.0', port=PORT, debug=False)
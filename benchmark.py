@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк SMB File Processor без SMB сервера и API
+
+Файлы лежат в памяти (FakeStorage - StorageBackend с задержкой запросов и ограничением
+полосы пропускания), отправка идёт на локальный mock API с настраиваемым временем ответа.
+Каждый сценарий (распределение размеров файлов x движок) выполняется в отдельном процессе,
+чтобы пиковый RSS относился только к нему. Конфигурация app.py (PIPELINE_*, API_*, SMB_* и т.д.)
+берётся из переменных окружения, как при обычном запуске.
+
+Примеры:
+    python benchmark.py
+    python benchmark.py --distribution mixed --engine all --latency 2 --bandwidth 100 --api-delay 20
+"""
+
+import os
+import sys
+import argparse
+import asyncio
+import fnmatch
+import json
+import logging
+import math
+import random
+import subprocess
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    # Нет в Windows - пиковый RSS тогда не измеряется
+    import resource
+except ImportError:
+    resource = None
+
+# Параметры app.py, без которых он не запускается, и отключение состояния между прогонами.
+# Адрес API в дочерних процессах - mock API основного процесса
+os.environ.setdefault('SMB_HOST', 'benchmark')
+os.environ.setdefault('SMB_SHARE', 'benchmark')
+os.environ.setdefault('API_URL', 'http://127.0.0.1:9/upload')
+os.environ.setdefault('SMB_INPUT_DIR', 'input')
+os.environ.setdefault('SMB_OUTPUT_DIR', 'output')
+os.environ.setdefault('LEDGER_PATH', '')
+os.environ.setdefault('READY_CHECK', '0')
+os.environ.setdefault('WATCH_MODE', '0')
+
+# Логи app.py (по строке на файл) исказят замер - выводятся только предупреждения и ошибки
+logging.basicConfig(level=logging.INFO if '--verbose' in sys.argv else logging.WARNING,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+import app
+
+KB = 1024
+MB = 1024 * 1024
+
+# Распределения размеров файлов: число файлов по умолчанию и размер одного файла
+DISTRIBUTIONS = {
+    'small': (500, lambda rng: rng.randint(4 * KB, 64 * KB)),
+    'mixed': (200, lambda rng: int(min(16 * MB, max(KB, rng.lognormvariate(math.log(256 * KB), 1.2))))),
+    'large': (20, lambda rng: rng.randint(8 * MB, 32 * MB)),
+}
+
+ENGINES = ('threads', 'async')
+
+
+class MemoryShare:
+    """Общее для всех подключений содержимое шары и канал к серверу.
+
+    Хранятся только размеры файлов: содержимое - срезы одного случайного буфера со сдвигом
+    по имени файла, поэтому память процесса занимает конвейер, а не данные шары.
+    """
+
+    def __init__(self, latency: float = 0.0, bandwidth: float = 0.0, chunk_size: int = MB):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.chunk_size = chunk_size
+        self.files = {}
+        self.lock = threading.Lock()
+        self.started = {}
+        self.finished = {}
+        self._pattern = memoryview(os.urandom(2 * chunk_size))
+        self._link_free_at = 0.0
+
+    def add(self, path: str, size: int, mtime: datetime):
+        self.files[path] = (size, mtime)
+
+    def request(self, size: int = 0):
+        """Один запрос к серверу: задержка сети и передача size байт по общему для всех подключений каналу"""
+        delay = self.latency
+        if self.bandwidth and size:
+            with self.lock:
+                now = time.monotonic()
+                self._link_free_at = max(now, self._link_free_at) + size / self.bandwidth
+                delay += self._link_free_at - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def content(self, path: str, offset: int, length: int) -> memoryview:
+        start = (zlib.crc32(path.encode('utf-8')) + offset) % self.chunk_size
+        return self._pattern[start:start + length]
+
+    def latencies(self) -> list:
+        """Время от начала чтения файла до его переноса в output, по всем перенесённым файлам"""
+        with self.lock:
+            return sorted(self.finished[path] - self.started[path] for path in self.finished if path in self.started)
+
+
+class FakeStorage(app.StorageBackend):
+    """Подключение к MemoryShare: каждая операция - запрос с задержкой, чтение и запись - блоками по полосе"""
+
+    def __init__(self, share: MemoryShare):
+        self.share = share
+        self.connected = False
+
+    def connect(self) -> bool:
+        self.share.request()
+        self.connected = True
+        return True
+
+    def iter_directory(self, directory: str = '', pattern: str = '*', page_size=None):
+        prefix = self._clean_path(directory)
+        prefix = f"{prefix}\\" if prefix else ''
+        with self.share.lock:
+            items = [(path[len(prefix):], size, mtime) for path, (size, mtime) in self.share.files.items()
+                     if path.startswith(prefix)]
+        directories = set()
+        for index, (name, size, mtime) in enumerate(items):
+            if index % 500 == 0:
+                # Страница листинга - отдельный запрос
+                self.share.request(min(len(items) - index, 500) * 100)
+            name, nested, _ = name.partition('\\')
+            if nested:
+                if name not in directories:
+                    directories.add(name)
+                    yield app.DirEntry(name=name, size=0, mtime=mtime, is_dir=True)
+            elif fnmatch.fnmatch(name.lower(), pattern.lower()):
+                yield app.DirEntry(name=name, size=size, mtime=mtime, is_dir=False)
+
+    def make_directories(self, directory: str):
+        self.share.request()
+
+    def iter_file_chunks(self, file_path: str, chunk_size=None, max_in_flight=None, info=None):
+        path = self._clean_path(file_path)
+        with self.share.lock:
+            self.share.started.setdefault(path, time.perf_counter())
+            entry = self.share.files.get(path)
+        self.share.request()
+        if entry is None:
+            raise FileNotFoundError(path)
+        size, mtime = entry
+        if info is not None:
+            info['size'] = size
+            info['mtime'] = mtime
+        chunk_size = min(chunk_size or self.share.chunk_size, self.share.chunk_size)
+        for offset in range(0, size, chunk_size):
+            length = min(chunk_size, size - offset)
+            self.share.request(length)
+            yield self.share.content(path, offset, length)
+
+    def write_file(self, file_path: str, data, size=None, **kwargs) -> bool:
+        try:
+            path = self._clean_path(file_path)
+            self.share.request()
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                view = memoryview(data)
+                data = (view[offset:offset + self.share.chunk_size] for offset in range(0, len(view), self.share.chunk_size))
+            written = 0
+            for block in data:
+                self.share.request(len(block))
+                written += len(block)
+            with self.share.lock:
+                self.share.files[path] = (written, datetime.now(timezone.utc).replace(tzinfo=None))
+            return True
+        except Exception as e:
+            app.logger.error(f'Ошибка записи файла {file_path}: {e}')
+            return False
+
+    def delete_file(self, file_path: str) -> bool:
+        self.share.request()
+        with self.share.lock:
+            if self.share.files.pop(self._clean_path(file_path), None) is None:
+                app.logger.error(f'Ошибка удаления файла {file_path}: файл не найден')
+                return False
+        return True
+
+    def rename(self, src_path: str, dst_path: str, on_conflict: str = 'overwrite', max_suffix: int = 1000):
+        clean_src = self._clean_path(src_path)
+        clean_dst = self._clean_path(dst_path)
+        self.share.request()
+        with self.share.lock:
+            if clean_src not in self.share.files:
+                app.logger.error(f'Ошибка переименования файла {src_path}: файл не найден')
+                return None
+            target = clean_dst
+            attempt = 0
+            while target in self.share.files and on_conflict != 'overwrite':
+                attempt += 1
+                if on_conflict == 'skip' or attempt > max_suffix:
+                    app.logger.warning(f'Файл {target} уже существует, перенос {src_path} пропущен')
+                    return None
+                target = self._with_suffix(clean_dst, attempt)
+            self.share.files[target] = self.share.files.pop(clean_src)
+            self.share.finished[clean_src] = time.perf_counter()
+        return target
+
+
+class MockAPIHandler(BaseHTTPRequestHandler):
+    """Приёмник отправок: читает тело целиком и отвечает 200 через delay +- jitter секунд"""
+
+    protocol_version = 'HTTP/1.1'
+    delay = 0.0
+    jitter = 0.0
+
+    def do_POST(self):
+        received = self._read_body()
+        delay = self.delay + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        body = json.dumps({'ok': True, 'received': received}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> int:
+        """Чтение тела (Content-Length или chunked) без накопления; возвращает число байт"""
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            total = 0
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    # Завершающие заголовки (trailers) до пустой строки
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return total
+                self._skip(size)
+                self.rfile.readline()
+                total += size
+        size = int(self.headers.get('Content-Length', 0))
+        self._skip(size)
+        return size
+
+    def _skip(self, size: int):
+        while size > 0:
+            part = self.rfile.read(min(size, MB))
+            if not part:
+                raise ConnectionError('Клиент закрыл соединение посреди тела запроса')
+            size -= len(part)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mock_api(delay: float, jitter: float) -> ThreadingHTTPServer:
+    """Mock API на свободном локальном порту в фоновом потоке"""
+    handler = type('Handler', (MockAPIHandler,), {'delay': delay, 'jitter': jitter})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-api', daemon=True).start()
+    return server
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux - килобайты, macOS - байты
+    return round(peak / (MB if sys.platform == 'darwin' else KB), 1)
+
+
+def percentile(values: list, fraction: float):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(math.ceil(fraction * len(values))) - 1)]
+
+
+def run_scenario(args) -> dict:
+    """Один прогон process_files() на FakeStorage в текущем процессе"""
+    count, size_of = DISTRIBUTIONS[args.distribution]
+    count = args.files or count
+    rng = random.Random(args.seed)
+
+    share = MemoryShare(latency=args.latency / 1000, bandwidth=args.bandwidth * MB)
+    # Файлы старше READY_MIN_AGE - проверка готовности их не откладывает
+    mtime = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=1)
+    for index in range(count):
+        share.add(f"{app.SMB_INPUT_DIR}\\image_{index:06d}.jpg", size_of(rng), mtime)
+    total_bytes = sum(size for size, _ in share.files.values())
+
+    app.smb_pool = app.SMBConnectionPool(factory=lambda: FakeStorage(share))
+    baseline_rss = peak_rss_mb()
+    try:
+        if args.engine == 'async':
+            result = asyncio.run(app.process_files_async())
+        else:
+            result = app.process_files()
+    finally:
+        app.smb_pool.close()
+        app.cpu_pool.close()
+
+    latencies = share.latencies()
+    return {
+        'distribution': args.distribution,
+        'engine': args.engine,
+        'files': count,
+        'total_mb': round(total_bytes / MB, 1),
+        'processed': result.get('processed', 0),
+        'failed': result.get('failed', 0),
+        'duration_sec': result.get('duration_sec'),
+        'files_per_sec': result.get('files_per_sec'),
+        'mb_per_sec': result.get('mb_per_sec'),
+        'p50_ms': None if not latencies else round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': None if not latencies else round(percentile(latencies, 0.99) * 1000, 1),
+        'baseline_rss_mb': baseline_rss,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def print_results(results: list):
+    columns = [('distribution', 'распред.'), ('engine', 'движок'), ('files', 'файлов'), ('total_mb', 'МБ'),
+               ('failed', 'ошибок'), ('files_per_sec', 'файл/с'), ('mb_per_sec', 'МБ/с'),
+               ('p50_ms', 'p50 мс'), ('p99_ms', 'p99 мс'), ('peak_rss_mb', 'RSS МБ')]
+    rows = [[title for _, title in columns]]
+    rows += [['-' if result.get(key) is None else str(result[key]) for key, _ in columns] for result in results]
+    widths = [max(len(row[index]) for row in rows) for index in range(len(columns))]
+    for row in rows:
+        print('  '.join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк обработки на хранилище в памяти и mock API')
+    parser.add_argument('--distribution', choices=list(DISTRIBUTIONS) + ['all'], default='all',
+                        help='распределение размеров файлов')
+    parser.add_argument('--engine', choices=list(ENGINES) + ['all'], default='threads', help='движок обработки')
+    parser.add_argument('--files', type=int, default=0, help='число файлов (0 - по умолчанию для распределения)')
+    parser.add_argument('--latency', type=float, default=1.0, help='задержка одного запроса к хранилищу, мс')
+    parser.add_argument('--bandwidth', type=float, default=0.0, help='полоса канала к хранилищу, МБ/с (0 - без ограничения)')
+    parser.add_argument('--api-delay', type=float, default=10.0, help='время ответа mock API, мс')
+    parser.add_argument('--api-jitter', type=float, default=0.0, help='разброс времени ответа mock API, +- мс')
+    parser.add_argument('--seed', type=int, default=1, help='зерно генератора размеров файлов')
+    parser.add_argument('--json', action='store_true', help='вывести результаты в JSON')
+    parser.add_argument('--verbose', action='store_true', help='показывать логи app.py')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(args)))
+        return 0
+
+    server = start_mock_api(args.api_delay / 1000, args.api_jitter / 1000)
+    env = dict(os.environ, API_URL=f"http://127.0.0.1:{server.server_address[1]}/upload")
+    distributions = list(DISTRIBUTIONS) if args.distribution == 'all' else [args.distribution]
+    engines = list(ENGINES) if args.engine == 'all' else [args.engine]
+
+    if not args.json:
+        print(f"🚀 Бенчмарк: хранилище {args.latency} мс/запрос, "
+              f"{f'{args.bandwidth} МБ/с' if args.bandwidth else 'полоса без ограничения'}, "
+              f"API {args.api_delay}±{args.api_jitter} мс")
+    results = []
+    for distribution in distributions:
+        for engine in engines:
+            if not args.json:
+                print(f"⏳ {distribution} / {engine}...")
+            command = [sys.executable, os.path.abspath(__file__), '--child',
+                       '--distribution', distribution, '--engine', engine, '--files', str(args.files),
+                       '--latency', str(args.latency), '--bandwidth', str(args.bandwidth), '--seed', str(args.seed)]
+            if args.verbose:
+                command.append('--verbose')
+            completed = subprocess.run(command, env=env, stdout=subprocess.PIPE, text=True)
+            if completed.returncode != 0:
+                print(f"❌ {distribution} / {engine}: код завершения {completed.returncode}")
+                continue
+            results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+    server.shutdown()
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print()
+        print_results(results)
+    return 0 if results and not any(result['failed'] for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -28,19 +28,37 @@ def test_health_endpoint():
         return False
 
 def test_process_endpoint():
-    """Тест process endpoint"""
+    """Тест process endpoint: запуск задания и ожидание его завершения через /jobs/<id>"""
     try:
         print("📤 Отправка запроса на обработку файлов...")
         response = requests.get('http://localhost:3000/process', timeout=30)
         
-        if response.status_code == 200:
-            print("✅ Process endpoint: OK")
-            print(f"   Ответ: {response.json()}")
-            return True
-        else:
+        if response.status_code != 202:
             print(f"❌ Process endpoint: HTTP {response.status_code}")
             print(f"   Ошибка: {response.text}")
             return False
+        
+        job_id = response.json()['id']
+        print(f"✅ Process endpoint: задание {job_id} поставлено в очередь")
+        
+        # Опрос состояния задания
+        for _ in range(300):
+            job = requests.get(f'http://localhost:3000/jobs/{job_id}', timeout=5).json()
+            if job['status'] in ('done', 'failed'):
+                break
+            print(f"   ⏳ {job['status']}: обработано {job.get('processed', 0)}/{job.get('total', 0)}")
+            time.sleep(2)
+        else:
+            print("❌ Задание не завершилось за отведённое время")
+            return False
+        
+        if job['status'] == 'done':
+            print("✅ Задание выполнено")
+            print(f"   Ответ: {job}")
+            return True
+        else:
+            print(f"❌ Задание завершилось с ошибкой: {job.get('error')}")
+            return False
     except requests.RequestException as e:
         print(f"❌ Process endpoint: Ошибка подключения - {e}")
         return False
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""Общие настройки тестов: app.py читает конфигурацию из окружения при импорте"""
+
+import os
+import sys
+
+os.environ.setdefault('SMB_HOST', 'test')
+os.environ.setdefault('SMB_SHARE', 'test')
+os.environ.setdefault('API_URL', 'http://127.0.0.1:9/upload')
+os.environ.setdefault('LEDGER_PATH', '')
+os.environ.setdefault('WATCH_MODE', '0')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
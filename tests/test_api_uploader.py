@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+"""HTTP клиент API: HTTP/2 только при установленном httpx[http2]"""
+
+import requests
+
+import app
+
+
+def test_http2_without_h2_falls_back_to_requests(monkeypatch):
+    monkeypatch.setattr(app, 'h2', None)
+    uploader = app.APIUploader('http://127.0.0.1:9/upload', pool_size=1, http2=True)
+    try:
+        assert not uploader.http2
+        assert isinstance(uploader.client, requests.Session)
+    finally:
+        uploader.close()
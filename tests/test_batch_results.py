@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""Разбор ответа API на пакетную отправку"""
+
+import json
+
+import app
+
+UNCONFIRMED = app.BATCH_ITEM_UNCONFIRMED
+
+
+def test_missing_filename_entry_is_unconfirmed():
+    response = json.dumps({'results': [{'filename': 'a.jpg', 'ok': True},
+                                       {'filename': 'b.jpg', 'ok': False, 'error': 'bad image'}]})
+    errors = app.batch_item_errors(response.encode(), ['a.jpg', 'b.jpg', 'c.jpg'])
+    assert errors == [None, 'bad image', UNCONFIRMED]
+
+
+def test_short_positional_results_are_unconfirmed():
+    errors = app.batch_item_errors(json.dumps([{'status': 201}, {'status': 500}]).encode(),
+                                   ['a.jpg', 'b.jpg', 'c.jpg'])
+    assert errors == [None, 'статус 500', UNCONFIRMED]
+
+
+def test_response_without_results_accepts_all():
+    assert app.batch_item_errors(b'', ['a.jpg', 'b.jpg']) == [None, None]
+
+
+def test_duplicate_names_are_not_merged():
+    # a.bmp и a.tiff после перекодирования оба называются a.webp
+    response = json.dumps([{'filename': 'a.webp', 'ok': True}])
+    assert app.batch_item_errors(response.encode(), ['a.webp', 'a.webp']) == [UNCONFIRMED, UNCONFIRMED]
+
+
+def test_unconfirmed_file_is_neither_accepted_nor_dead_lettered(monkeypatch):
+    monkeypatch.setattr(app, 'SMB_DEAD_LETTER_DIR', 'dead')
+    tasks = [app.FileTask(name=name, path=f'input\\{name}', output_path=f'output\\{name}', upload_name=name)
+             for name in ('a.jpg', 'b.jpg')]
+    timing = app.UploadTiming(response=json.dumps([{'filename': 'a.jpg', 'ok': True}]).encode())
+    accepted, missing = app.batch_results(tasks, b'', timing)
+    assert isinstance(accepted, app.UploadTiming)
+    assert isinstance(missing, app.BatchItemUnconfirmed)
+    assert not app.should_dead_letter(missing)
+    assert app.api_retry.next_delay(0, missing) is None
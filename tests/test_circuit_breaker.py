@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Пробный запрос предохранителя завершается при любой ошибке, а не только при ошибке API"""
+
+import asyncio
+import types
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def half_open(monkeypatch):
+    """Предохранитель, у которого пауза уже истекла: следующий запрос - пробный"""
+    breaker = app.CircuitBreaker(threshold=1, reset_timeout=60)
+    breaker.state = 'open'
+    breaker._opened_at = -1000.0
+    monkeypatch.setattr(app, 'api_breaker', breaker)
+    return breaker
+
+
+def failing_body(attempt):
+    """Потоковое тело, чтение которого из хранилища обрывается"""
+    yield b'{"image": "'
+    raise OSError('ошибка чтения SMB')
+
+
+def consume(body, headers=None):
+    for _ in body:
+        pass
+    return app.UploadTiming()
+
+
+def test_probe_released_when_body_fails(monkeypatch, half_open):
+    monkeypatch.setattr(app, 'upload_body', consume)
+    with pytest.raises(OSError):
+        app.upload_with_retry('a.jpg', failing_body)
+    assert half_open.state == 'half_open'
+    # Следующий запрос снова пробный, а не отклонён как при застрявшем _probing
+    assert half_open.before_request() is True
+
+
+def test_probe_released_when_async_body_fails(half_open):
+    engine = app.AsyncProcessingEngine(types.SimpleNamespace(size=1), 'input', 'output')
+    
+    async def post(body, headers=None):
+        return consume(body)
+    
+    async def make_body(attempt):
+        return failing_body(attempt)
+    
+    engine._post = post
+    try:
+        with pytest.raises(OSError):
+            asyncio.run(engine._upload_with_retry('a.jpg', make_body))
+    finally:
+        engine.smb_executor.shutdown()
+        if engine.upload_executor is not None:
+            engine.upload_executor.shutdown()
+    assert half_open.before_request() is True
+
+
+def test_probe_success_closes_breaker(monkeypatch, half_open):
+    monkeypatch.setattr(app, 'upload_body', lambda body, headers=None: app.UploadTiming())
+    app.upload_with_retry('a.jpg', lambda attempt: b'{}')
+    assert half_open.state == 'closed'
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Пул процессов для CPU работы: результат совпадает с кодированием в потоке"""
+
+import io
+from multiprocessing import resource_tracker, shared_memory
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def pool():
+    cpu_pool = app.CPUPool(workers=1, min_bytes=1)
+    yield cpu_pool
+    cpu_pool.close()
+
+
+def test_pool_does_not_fork(pool):
+    assert pool.executor()._mp_context.get_start_method() != 'fork'
+
+
+def test_json_body_matches_inline_encoding(pool):
+    chunks = [b'\x00\x01\x02' * 1000, b'\xff' * 7, b'tail']
+    size = sum(len(chunk) for chunk in chunks)
+    assert pool.json_body('day.jpg', chunks, size) == b''.join(app.iter_json_body('day.jpg', chunks))
+
+
+def test_attach_does_not_register_block(monkeypatch):
+    block = shared_memory.SharedMemory(create=True, size=16)
+    registered = []
+    monkeypatch.setattr(resource_tracker, 'register', lambda name, rtype: registered.append(name))
+    try:
+        attached = app._attach_shared(block.name)
+        attached.close()
+        assert registered == []
+    finally:
+        block.close()
+        block.unlink()
+
+
+def test_reencode_in_pool(pool, monkeypatch):
+    Image = pytest.importorskip('PIL.Image')
+    monkeypatch.setattr(app, 'IMAGE_REENCODE_FORMAT', 'jpeg')
+    source = io.BytesIO()
+    Image.new('RGB', (64, 64), (200, 30, 30)).save(source, format='BMP')
+    name, chunks = pool.reencode('a.bmp', [source.getvalue()])
+    assert name == 'a.jpg'
+    with Image.open(io.BytesIO(b''.join(chunks))) as image:
+        assert image.format == 'JPEG'
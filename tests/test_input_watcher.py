@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Режим наблюдения: ошибки опроса не останавливают наблюдение, прогоны не ждут его подключения"""
+
+import threading
+import time
+
+import pytest
+
+import app
+
+
+class FakeJob:
+    def __init__(self):
+        self.done = threading.Event()
+        self.done.set()
+        self.stats = None
+
+
+class FakeJobs:
+    """Вместо JobManager: запоминает переданные в обработку имена"""
+    
+    def __init__(self):
+        self.submitted = []
+    
+    def submit(self, engine, file_names=None):
+        self.submitted.append(file_names)
+        return FakeJob(), False
+
+
+class FlakyStorage(app.StorageBackend):
+    """Хранилище без CHANGE_NOTIFY, у которого первые листинги падают"""
+    
+    def __init__(self, state):
+        self.state = state
+    
+    def connect(self):
+        self.connected = True
+        return True
+    
+    def iter_directory(self, directory='', pattern='*', page_size=None):
+        self.state['listings'] += 1
+        if self.state['listings'] <= self.state['failures']:
+            raise OSError(5, 'Input/output error')
+        yield app.DirEntry(name='a.jpg', size=1, mtime=None, is_dir=False)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(app, 'SMB_RECONNECT_BACKOFF', 0.01)
+    monkeypatch.setattr(app, 'SMB_RECONNECT_BACKOFF_MAX', 0.05)
+
+
+def start_watcher(pool, jobs, input_path='input'):
+    watcher = app.InputWatcher(pool, jobs, input_path=input_path, poll_interval=0.01,
+                               full_rescan_every=1, recursive=False)
+    watcher.start()
+    return watcher
+
+
+def test_watcher_survives_poll_errors():
+    state = {'listings': 0, 'failures': 3}
+    pool = app.SMBConnectionPool(size=1, factory=lambda: FlakyStorage(state), idle_timeout=0)
+    jobs = FakeJobs()
+    watcher = start_watcher(pool, jobs)
+    try:
+        assert wait_for(lambda: ['a.jpg'] in jobs.submitted)
+        assert watcher.mode == 'poll'
+        assert watcher._thread.is_alive()
+    finally:
+        watcher.stop()
+    assert state['listings'] > state['failures']
+
+
+def test_local_mount_watcher_survives_missing_input(tmp_path):
+    input_dir = tmp_path / 'input'
+    pool = app.SMBConnectionPool(size=1, factory=lambda: app.LocalMountClient(str(tmp_path)), idle_timeout=0)
+    jobs = FakeJobs()
+    # Папки input нет (например, шара отмонтирована) - опрос падает с FileNotFoundError
+    watcher = start_watcher(pool, jobs)
+    try:
+        assert wait_for(lambda: watcher.mode == 'poll')
+        time.sleep(0.2)
+        assert watcher._thread.is_alive()
+        
+        input_dir.mkdir()
+        (input_dir / 'b.jpg').write_bytes(b'b')
+        assert wait_for(lambda: ['b.jpg'] in jobs.submitted)
+        assert watcher._thread.is_alive()
+    finally:
+        watcher.stop()
+
+
+class NotifyStorage(app.StorageBackend):
+    """Хранилище с CHANGE_NOTIFY: открытая папка - заглушка, изменения подставляет тест"""
+    
+    def __init__(self, state):
+        self.state = state
+    
+    def connect(self):
+        self.connected = True
+        return True
+    
+    def disconnect(self):
+        self.state['disconnected'] += 1
+        self.connected = False
+    
+    def open_directory(self, directory):
+        return self
+    
+    def close(self):
+        pass
+    
+    def iter_directory(self, directory='', pattern='*', page_size=None):
+        return iter(())
+
+
+class PoolJobs(FakeJobs):
+    """Задание, как настоящий прогон, берёт подключение из пула"""
+    
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+        self.errors = []
+    
+    def submit(self, engine, file_names=None):
+        try:
+            with self.pool.connection(timeout=1):
+                pass
+        except Exception as e:
+            self.errors.append(e)
+        return super().submit(engine, file_names)
+
+
+def test_notify_watcher_does_not_hold_pool_connection(monkeypatch):
+    state = {'disconnected': 0}
+    pool = app.SMBConnectionPool(size=1, factory=lambda: NotifyStorage(state), idle_timeout=0)
+    changes = iter([{'c.jpg'}])
+    
+    def wait_changes(self, dir_open, timeout):
+        time.sleep(0.01)
+        return next(changes, None)
+    
+    monkeypatch.setattr(app.InputWatcher, '_wait_changes', wait_changes)
+    jobs = PoolJobs(pool)
+    watcher = app.InputWatcher(pool, jobs, input_path='input', debounce=0.01, recursive=False)
+    watcher.start()
+    try:
+        assert wait_for(lambda: ['c.jpg'] in jobs.submitted)
+        assert watcher.mode == 'notify'
+    finally:
+        watcher.stop()
+    # При SMB_POOL_SIZE=1 прогон получил подключение, пока наблюдение держало папку открытой
+    assert jobs.errors == []
+    # Отдельное подключение наблюдения закрыто при остановке
+    assert wait_for(lambda: state['disconnected'] >= 1)
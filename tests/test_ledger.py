@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Журнал обработки: расположение файла, ключ, не зависящий от хранилища, проверка до чтения"""
+
+import os
+
+from smbprotocol.structure import DateTimeField
+
+import app
+
+
+def test_mount_mtime_matches_smb_create_time():
+    # Время изменения файла на шаре: FILETIME в ответе SMB CREATE и st_mtime_ns через CIFS клиент ядра
+    filetime = 133500000001234567
+    field = DateTimeField()
+    field.set_value(filetime)
+    ns = (filetime - DateTimeField.EPOCH_FILETIME) * 100
+    assert app.mtime_from_ns(ns) == field.get_value()
+
+
+def test_ledger_key_is_shared_between_backends(tmp_path):
+    path = tmp_path / 'data' / 'ledger.db'
+    ledger = app.ProcessedLedger(str(path))
+    assert ledger.enabled
+    assert os.path.isdir(tmp_path / 'data')
+    
+    mtime_ns = 1700000000123456789
+    smb_mtime = app.mtime_from_ns(mtime_ns)
+    ledger.mark('input\\a.jpg', 10, smb_mtime, app.ProcessedLedger.STAGE_UPLOADED)
+    
+    (tmp_path / 'input').mkdir()
+    file_path = tmp_path / 'input' / 'a.jpg'
+    file_path.write_bytes(b'0123456789')
+    os.utime(file_path, ns=(mtime_ns, mtime_ns))
+    client = app.LocalMountClient(str(tmp_path))
+    assert client.connect()
+    info = {}
+    assert b''.join(client.iter_file_chunks('input/a.jpg', info=info)) == b'0123456789'
+    assert ledger.get_stage('input\\a.jpg', info['size'], info['mtime']) == app.ProcessedLedger.STAGE_UPLOADED
+    ledger.close()
+
+
+class NoReadClient(app.LocalMountClient):
+    """Смонтированная шара, на которой чтение файлов - ошибка теста"""
+    
+    reads = []
+    
+    def iter_file_chunks(self, file_path, *args, **kwargs):
+        self.reads.append(file_path)
+        return super().iter_file_chunks(file_path, *args, **kwargs)
+
+
+def test_delivered_file_is_moved_without_reading(tmp_path, monkeypatch):
+    ledger = app.ProcessedLedger(str(tmp_path / 'ledger.db'))
+    monkeypatch.setattr(app, 'ledger', ledger)
+    (tmp_path / 'input').mkdir()
+    (tmp_path / 'output').mkdir()
+    (tmp_path / 'input' / 'a.jpg').write_bytes(b'0123456789')
+    
+    pool = app.SMBConnectionPool(size=2, factory=lambda: NoReadClient(str(tmp_path)), idle_timeout=0)
+    with pool.connection() as client:
+        entries = list(client.iter_directory('input'))
+    ledger.mark('input\\a.jpg', entries[0].size, entries[0].mtime, app.ProcessedLedger.STAGE_UPLOADED)
+    
+    NoReadClient.reads = []
+    stats = app.ProcessingPipeline(pool, 'input', 'output').run(entries)
+    pool.close()
+    ledger.close()
+    assert stats.processed == 1
+    assert NoReadClient.reads == []
+    assert (tmp_path / 'output' / 'a.jpg').exists()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Хранилище на смонтированной шаре: чтение, перенос и копирование между точками монтирования"""
+
+import errno
+import shutil
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def share(tmp_path):
+    (tmp_path / 'input' / 'day').mkdir(parents=True)
+    (tmp_path / 'output').mkdir()
+    client = app.LocalMountClient(str(tmp_path))
+    assert client.connect()
+    return client
+
+
+def test_read_in_chunks(share, tmp_path):
+    data = bytes(range(256)) * 10
+    (tmp_path / 'input' / 'a.jpg').write_bytes(data)
+    info = {}
+    chunks = list(share.iter_file_chunks('input\\a.jpg', chunk_size=1000, info=info))
+    assert [len(chunk) for chunk in chunks] == [1000, 1000, 560]
+    assert b''.join(chunks) == data
+    assert info['size'] == len(data)
+
+
+def test_rename_suffix_and_nested_folder(share, tmp_path):
+    (tmp_path / 'input' / 'day' / 'a.jpg').write_bytes(b'new')
+    (tmp_path / 'output' / 'day').mkdir()
+    (tmp_path / 'output' / 'day' / 'a.jpg').write_bytes(b'old')
+    assert share.rename('input\\day\\a.jpg', 'output\\day\\a.jpg', 'suffix') == 'output\\day\\a (1).jpg'
+    assert (tmp_path / 'output' / 'day' / 'a.jpg').read_bytes() == b'old'
+    assert (tmp_path / 'output' / 'day' / 'a (1).jpg').read_bytes() == b'new'
+
+
+def cross_device(*args, **kwargs):
+    raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+
+def test_move_across_mounts_copies(share, tmp_path, monkeypatch):
+    (tmp_path / 'input' / 'a.jpg').write_bytes(b'data')
+    monkeypatch.setattr(app.LocalMountClient, 'rename', cross_device)
+    assert share.move('input\\a.jpg', 'output\\a.jpg') == 'output\\a.jpg'
+    assert (tmp_path / 'output' / 'a.jpg').read_bytes() == b'data'
+    assert not (tmp_path / 'input' / 'a.jpg').exists()
+    assert not (tmp_path / 'output' / 'a.jpg.partial').exists()
+
+
+def test_failed_copy_keeps_source_and_leaves_no_partial(share, tmp_path, monkeypatch):
+    (tmp_path / 'input' / 'a.jpg').write_bytes(b'data')
+    monkeypatch.setattr(app.LocalMountClient, 'rename', cross_device)
+    
+    def broken_copy(source, destination):
+        with open(destination, 'wb') as file:
+            file.write(b'da')
+        raise OSError(errno.EIO, 'Input/output error')
+    
+    monkeypatch.setattr(shutil, 'copyfile', broken_copy)
+    assert share.move('input\\a.jpg', 'output\\a.jpg') is None
+    assert (tmp_path / 'input' / 'a.jpg').read_bytes() == b'data'
+    assert list((tmp_path / 'output').iterdir()) == []
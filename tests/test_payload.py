@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""Тело запроса к API: имя файла без вложенных папок input"""
+
+import json
+
+import app
+
+
+def make_task(name, data, buffered):
+    task = app.FileTask(name=name, path=f'input\\{name}', output_path=f'output\\{name}')
+    task.chunks = app.CountingIterator(iter([data]))
+    task.buffered = buffered
+    if buffered:
+        task.prefetched = list(task.chunks)
+    return task
+
+
+def test_recursive_name_is_sent_as_basename():
+    task = make_task('day\\a.jpg', b'abc', buffered=True)
+    app.prepare_upload(task, app.PipelineStats(), batching=False)
+    assert task.upload_name == 'a.jpg'
+    assert json.loads(task.body)['filename'] == 'a.jpg'
+
+
+def test_streamed_recursive_name_is_sent_as_basename():
+    task = make_task('day\\b.jpg', b'abc', buffered=False)
+    app.prepare_upload(task, app.PipelineStats(), batching=False)
+    assert json.loads(b''.join(task.body))['filename'] == 'b.jpg'
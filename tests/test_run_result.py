@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+"""Итоговое сообщение прогона различает причины, по которым файлы остались в input"""
+
+import app
+
+
+def test_deferred_by_open_breaker_is_reported_separately():
+    stats = app.PipelineStats()
+    stats.add('deferred_api', 3)
+    result = app.run_result(stats)
+    assert result['deferred_api'] == 3
+    assert result['deferred'] == 0
+    assert 'API недоступен' in result['message']
+
+
+def test_files_still_being_written():
+    stats = app.PipelineStats()
+    stats.add('deferred')
+    result = app.run_result(stats)
+    assert result['deferred_api'] == 0
+    assert 'ещё записываются' in result['message']
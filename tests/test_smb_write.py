@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Запись файла на SMB: оборванная запись не оставляет файл с нулями в конце"""
+
+import types
+
+import pytest
+
+import app
+
+
+class FakeOpen:
+    """Open над словарём файлов вместо сервера: запросы выполняются при получении ответа"""
+    
+    files = {}
+    
+    def __init__(self, tree, path):
+        self.tree_connect = tree
+        self.path = path
+        self.file_id = path.encode()
+        self.delete_pending = False
+    
+    def create(self, disposition, access, share_access=None, send=True):
+        def receive(message):
+            if disposition == app.CreateDisposition.FILE_OVERWRITE_IF:
+                self.files[self.path] = bytearray()
+            elif self.path not in self.files:
+                raise FileNotFoundError(self.path)
+        return 'create', receive
+    
+    def write(self, data, offset, send=True):
+        def receive(message):
+            content = self.files[self.path]
+            content[offset:offset + len(data)] = data
+            return len(data)
+        return 'write', receive
+    
+    def set_info(self, info):
+        if isinstance(info, app.FileDispositionInformation):
+            self.delete_pending = True
+        else:
+            size = info['end_of_file'].get_value()
+            content = self.files[self.path]
+            content[:] = content[:size].ljust(size, b'\0')
+    
+    def close(self, send=True):
+        if self.delete_pending:
+            self.files.pop(self.path, None)
+
+
+class FakeConnection:
+    max_write_size = 4
+    supports_multi_credit = False
+    sequence_window = {'low': 0, 'high': 100}
+    
+    def send(self, message, session_id=None, tree_id=None):
+        return message
+    
+    def receive(self, message):
+        _, file_open, info = message
+        file_open.set_info(info)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, 'SMB_COMPOUND', False)
+    monkeypatch.setattr(app, 'Open', FakeOpen)
+    FakeOpen.files = {}
+    smb = app.SMBClient()
+    smb.connection = FakeConnection()
+    smb.tree = types.SimpleNamespace(session=types.SimpleNamespace(session_id=1), tree_connect_id=1)
+    smb.connected = True
+    smb._set_info_request = lambda file_open, info: (('set_info', file_open, info), smb.connection.receive)
+    return smb
+
+
+def broken_stream():
+    yield b'abcd'
+    yield b'efgh'
+    raise OSError('ошибка чтения исходного файла')
+
+
+def test_interrupted_write_removes_preallocated_file(client):
+    assert not client.write_file('output\\a.jpg', broken_stream(), size=12)
+    assert 'output\\a.jpg' not in FakeOpen.files
+
+
+def test_complete_write(client):
+    assert client.write_file('output\\a.jpg', iter([b'abcd', b'efgh', b'ij']), size=10)
+    assert FakeOpen.files['output\\a.jpg'] == b'abcdefghij'
+
+
+def test_local_interrupted_write_removes_file(tmp_path):
+    local = app.LocalMountClient(str(tmp_path))
+    assert local.connect()
+    assert not local.write_file('a.jpg', broken_stream())
+    assert not (tmp_path / 'a.jpg').exists()